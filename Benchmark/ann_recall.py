@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.util import top_k_dot, l2_normalize
+from Model.embedding_store import EmbeddingStore
+from Model.ann_index import IVFIndex
+
+
+def recall_at_k(exact_indices, ann_indices):
+    '''
+    ANN 結果中包含多少比例的 exact top_k
+    '''
+    hits = [len(set(e[e >= 0]) & set(a[a >= 0])) / max(1, (e >= 0).sum()) for e, a in zip(exact_indices, ann_indices)]
+    return float(np.mean(hits))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 IVF ANN index 與 exact search 的 recall@k 及查詢速度')
+    parser.add_argument('--store_dir', default='./reference/processed_insurance/embedding_store')
+    parser.add_argument('--category', default='insurance', help='使用哪一類題目作為 query (faq / insurance)')
+    parser.add_argument('--question_path', default='./preliminary_test/questions_preliminary.json')
+    parser.add_argument('--synthetic', type=int, default=0, help='不載入模型，改用 N 筆加上雜訊的 corpus 向量作為 query')
+    parser.add_argument('--top_k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    store = EmbeddingStore.load(args.store_dir)
+    embeddings = np.asarray(store.embeddings, dtype=np.float32)
+
+    if args.synthetic:
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(embeddings), args.synthetic)
+        query_embeddings = l2_normalize(embeddings[rows] + rng.normal(scale=0.05, size=(len(rows), embeddings.shape[1])))
+    else:
+        from Model.encoder import get_encoder
+        model = get_encoder(store.manifest['model_name'], args.device, backend=store.encoder_backend)
+        with open(args.question_path, 'rb') as f:
+            questions = [q_dict for q_dict in json.load(f)['questions'] if q_dict['category'] == args.category]
+        query_embeddings = l2_normalize(model.encode(['query: ' + q_dict['query'] for q_dict in questions]))
+
+    start = time.perf_counter()
+    exact_indices, _ = top_k_dot(embeddings, query_embeddings, args.top_k)
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = IVFIndex.build(embeddings, args.nlist)
+    build_time = time.perf_counter() - start
+
+    n = len(query_embeddings)
+    print(f'{len(embeddings)} vectors, {n} queries, nlist={index.nlist} (build {build_time:.2f}s)')
+    print(f'exact      : recall@{args.top_k}=1.0000, {exact_time / n * 1000:.3f} ms/query')
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        ann_indices, _ = index.search(query_embeddings, args.top_k, nprobe)
+        ann_time = time.perf_counter() - start
+        print(f'nprobe={nprobe:<4d}: recall@{args.top_k}={recall_at_k(exact_indices, ann_indices):.4f}, {ann_time / n * 1000:.3f} ms/query')
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Model'))
+from finance_bm25_index import FinanceBM25Index, SparseBM25
+
+
+def same_ranking(expected, actual, tolerance=1e-4):
+    '''
+    比較兩個 (sorted_file_names, sorted_scores) 是否相同
+    分數只允許浮點誤差；同分 (四捨五入後相同) 的頁面順序可互換
+
+    [expected]: BM25Okapi 的結果
+    [actual]: SparseBM25 的結果
+    [tolerance]: 分數容許誤差
+    '''
+    expected_names, expected_scores = expected
+    actual_names, actual_scores = actual
+    if len(expected_names) != len(actual_names):
+        return False
+    if any(abs(e - a) > tolerance for e, a in zip(expected_scores, actual_scores)):
+        return False
+
+    # 依分數分組後比較每組的頁面集合
+    def groups(names, scores):
+        grouped = {}
+        for name, score in zip(names, scores):
+            grouped.setdefault(round(score, 4), set()).add(name)
+        return grouped
+    return groups(expected_names, expected_scores) == groups(actual_names, actual_scores)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='檢查 SparseBM25 與 BM25Okapi 的排序結果是否相同，並比較每題耗時')
+    parser.add_argument('--question_path', default='./preliminary_test/questions_preliminary.json')
+    parser.add_argument('--rewrite_question_path', default='./preliminary_test/finance_query_rewrite.json')
+    parser.add_argument('--index_path', default='./reference/processed_finance/bm25_index.npz')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[1, 3, 10], help='檢查 top_k 的結果與完整排序的前 top_k 筆完全相同 (包含同分頁面的順序)')
+    args = parser.parse_args()
+
+    with open(args.question_path, 'rb') as f:
+        qs_ref = json.load(f)
+    with open(args.rewrite_question_path, 'rb') as f:
+        qs_rewrite = {int(key): value for key, value in json.load(f).items()}
+
+    index = FinanceBM25Index.load(args.index_path)
+    bm25 = SparseBM25(index)
+    finance_questions = [q_dict for q_dict in qs_ref['questions'] if q_dict['category'] == 'finance']
+    queries = [qs_rewrite[q_dict['qid']] for q_dict in finance_questions]
+    candidate_lists = [q_dict['source'] for q_dict in finance_questions]
+
+    start = time.perf_counter()
+    expected = [index.retrieve(qs, candidate_ids) for qs, candidate_ids in zip(queries, candidate_lists)]
+    okapi_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = bm25.retrieve_batch(queries, candidate_lists)
+    sparse_time = time.perf_counter() - start
+
+    mismatched = [q_dict['qid'] for q_dict, e, a in zip(finance_questions, expected, actual) if not same_ranking(e, a)]
+    for top_k in args.top_k:
+        truncated = bm25.retrieve_batch(queries, candidate_lists, top_k)
+        mismatched.extend(q_dict['qid'] for q_dict, full, t in zip(finance_questions, actual, truncated)
+                          if (tuple(full[0][:top_k]), tuple(full[1][:top_k])) != (tuple(t[0]), tuple(t[1])))
+    mismatched = sorted(set(mismatched))
+
+    n = max(len(finance_questions), 1)
+    print(f'BM25Okapi   : {okapi_time:.3f}s ({okapi_time / n * 1000:.2f} ms/query)')
+    print(f'SparseBM25  : {sparse_time:.3f}s ({sparse_time / n * 1000:.2f} ms/query)')
+    print(f'Mismatched qids ({len(mismatched)}/{len(finance_questions)}): {mismatched}')
+    sys.exit(1 if mismatched else 0)
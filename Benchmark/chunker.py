@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+import pdfplumber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.util import detect_headers, get_chunks_by_headers
+
+
+def get_chunks_by_headers_two_pass(pdf_loc, page_infos = None, min_length = 8):
+    """
+    原本的 chunker: 先以 detect_headers 開啟PDF找出header，再開啟一次PDF抽取文字行，
+    並以巢狀迴圈逐一比對 header (作為正確性與速度比較的基準)
+    """
+    headers = detect_headers(pdf_loc, page_infos)
+    chunks = []
+
+    with pdfplumber.open(pdf_loc) as pdf:
+        pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
+
+        all_lines = []
+        for page in pages:
+            lines = page.extract_text_lines()
+            if not lines:
+                continue
+
+            heights = [round(line['bottom'] - line['top'], 1) for line in lines]
+            height_counter = Counter(heights)
+            major_height = height_counter.most_common(1)[0][0]
+            if heights[0] < major_height * 0.90:
+                lines = lines[1:]
+
+            if len(lines) > 1:
+                lines = lines[:-1]
+
+            all_lines.extend(line['text'] for line in lines)
+
+        current_chunk = []
+        current_header = None
+
+        for line in all_lines:
+            is_header = False
+            for header in headers:
+                if header['text'] == line:
+                    if current_chunk and len(''.join(current_chunk)) >= min_length:
+                        chunks.append({
+                            'header': current_header,
+                            'content': '\n'.join(current_chunk)
+                        })
+                    current_chunk = []
+                    current_header = line
+                    is_header = True
+                    break
+
+            if not is_header:
+                current_chunk.append(line)
+
+        if current_chunk and len(''.join(current_chunk)) >= min_length:
+            chunks.append({
+                'header': current_header,
+                'content': '\n'.join(current_chunk)
+            })
+
+    return chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 single-pass chunker 與原本 two-pass chunker 的輸出與速度')
+    parser.add_argument('--source_path', default='./reference/insurance')
+    parser.add_argument('--limit', type=int, default=None, help='只比較前 N 份PDF')
+    args = parser.parse_args()
+
+    files = sorted(file for file in os.listdir(args.source_path) if file.endswith('.pdf'))[:args.limit]
+    two_pass_time = single_pass_time = 0.0
+    mismatched = []
+    for file in files:
+        pdf_loc = os.path.join(args.source_path, file)
+
+        start = time.perf_counter()
+        expected = get_chunks_by_headers_two_pass(pdf_loc)
+        two_pass_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = get_chunks_by_headers(pdf_loc)
+        single_pass_time += time.perf_counter() - start
+
+        if expected != actual:
+            mismatched.append(file)
+
+    print(f'{len(files)} PDFs')
+    print(f'two-pass    : {two_pass_time:.2f}s')
+    print(f'single-pass : {single_pass_time:.2f}s ({two_pass_time / max(single_pass_time, 1e-9):.2f}x)')
+    print(f'Mismatched ({len(mismatched)}): {mismatched}')
+    sys.exit(1 if mismatched else 0)
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.encoder import (DEFAULT_MODEL_NAME, DEFAULT_CACHE_DIR, ENCODER_BACKENDS, ONNX_MIN_COSINE,
+                           LazyEncoder, OnnxEncoder, compare_embeddings)
+
+
+def load_sentences(question_path, limit=None):
+    '''
+    回傳所有題目的 query (加上 e5 的 'query: ' 前綴)
+    '''
+    with open(question_path, 'rb') as f:
+        questions = json.load(f)['questions']
+    return ['query: ' + q_dict['query'] for q_dict in questions][:limit]
+
+
+def build_encoder(backend, model_name, cache_dir, num_threads):
+    '''
+    每個 (backend, thread 數量) 各自建立 encoder (不使用 get_encoder 的共用 encoder)
+    '''
+    if backend == 'torch':
+        return LazyEncoder(model_name, 'cpu', cache_dir, num_threads)
+    return OnnxEncoder(model_name, cache_dir, backend == 'onnx-int8', num_threads)
+
+
+def measure(encoder, sentences, batch_size, repeat):
+    '''
+    回傳 (embeddings, 最佳的 queries/sec)，第一次 encode 為預熱不計時
+    '''
+    encoder.load()
+    embeddings = encoder.encode(sentences[:batch_size], batch_size=batch_size)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        embeddings = encoder.encode(sentences, batch_size=batch_size)
+        best = min(best, time.perf_counter() - start)
+    return embeddings, len(sentences) / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 SentenceTransformer (torch) 與 ONNX (float32 / dynamic int8) encoder 在 CPU 上的 queries/sec 與 embedding 誤差')
+    parser.add_argument('--model_name', default=DEFAULT_MODEL_NAME)
+    parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR, help='模型需已下載至此資料夾 (不連網)')
+    parser.add_argument('--question_path', default='./preliminary_test/questions_preliminary.json')
+    parser.add_argument('--limit', type=int, default=None, help='只使用前 N 題')
+    parser.add_argument('--backends', nargs='+', choices=ENCODER_BACKENDS, default=list(ENCODER_BACKENDS))
+    parser.add_argument('--threads', type=int, nargs='+', default=[0], help='CPU thread 數量，0 則使用各 backend 的預設值')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3, help='重複量測取最佳值')
+    args = parser.parse_args()
+
+    sentences = load_sentences(args.question_path, args.limit)
+    print(f'{len(sentences)} queries, batch size {args.batch_size}')
+    # 以 torch backend 的 embedding 作為比較基準
+    reference = build_encoder('torch', args.model_name, args.cache_dir, None)
+    reference_embeddings = reference.encode(sentences, batch_size=args.batch_size)
+    del reference
+
+    failed = []
+    print(f'{"backend":<10} {"threads":>7} {"queries/sec":>12} {"min cosine":>11} {"max abs diff":>13}')
+    for backend in args.backends:
+        for num_threads in args.threads:
+            encoder = build_encoder(backend, args.model_name, args.cache_dir, num_threads or None)
+            embeddings, qps = measure(encoder, sentences, args.batch_size, args.repeat)
+            worst, _, max_diff = compare_embeddings(reference_embeddings, embeddings)
+            flag = ''
+            if backend in ONNX_MIN_COSINE and worst < ONNX_MIN_COSINE[backend]:
+                flag = f'  !! below {ONNX_MIN_COSINE[backend]}'
+                failed.append((backend, num_threads))
+            print(f'{backend:<10} {num_threads or "default":>7} {qps:12.1f} {worst:11.6f} {max_diff:13.6f}{flag}')
+            del encoder
+
+    print(f'Out of tolerance: {failed}')
+    sys.exit(1 if failed else 0)
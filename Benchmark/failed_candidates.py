@@ -0,0 +1,79 @@
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.embedding_store import EmbeddingStore
+from Model.insurance import retrieve_insurance
+from Model.quantization import QuantizedEmbeddings
+from store_update import HashEncoder, read_chunks
+
+
+class HashModel:
+    '''
+    以 HashEncoder 模擬 encoder 的 encode 介面 (字串回傳單一向量)
+    去除 'query: ' 前綴，與 chunk 文字相同的 query 會得到相同的向量
+    '''
+
+    def __init__(self, dim):
+        self.encoder = HashEncoder(dim)
+
+    def encode(self, sentences, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+        return self.encoder([sentence.removeprefix('query: ') for sentence in sentences])
+
+
+def read_or_fail(path):
+    '''
+    模擬無法解析的PDF
+    '''
+    if path.endswith('.bad'):
+        raise ValueError('unparseable document')
+    return read_chunks(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='檢查 candidate 中包含解析失敗 (不在 embedding store 中) 的文件時，其他題目與其他 candidate 仍可正常檢索')
+    parser.add_argument('--docs', type=int, default=20)
+    parser.add_argument('--dim', type=int, default=64)
+    args = parser.parse_args()
+
+    model = HashModel(args.dim)
+    failed_doc = args.docs - 1
+    with tempfile.TemporaryDirectory() as folder:
+        sources = {}
+        for doc_id in range(args.docs):
+            sources[doc_id] = os.path.join(folder, f'{doc_id}.bad' if doc_id == failed_doc else f'{doc_id}.txt')
+            with open(sources[doc_id], 'w', encoding='utf8') as f:
+                f.write('\n'.join(f'doc {doc_id} chunk {i}' for i in range(5)))
+        store = EmbeddingStore.update(os.path.join(folder, 'store'), sources, read_or_fail, model.encode, 'hash-encoder')
+        print(f'failures: {[failure["doc_id"] for failure in store.manifest["failures"]]}, doc_ids: {len(store.doc_ids)}')
+
+        # 以某份文件的 chunk 作為 query，candidate 中包含解析失敗的文件
+        questions = [{'qid': doc_id, 'query': f'doc {doc_id} chunk 2', 'source': [failed_doc, doc_id, (doc_id + 1) % failed_doc]}
+                     for doc_id in range(failed_doc)]
+        expected = [q_dict['qid'] for q_dict in questions]
+        quantized = QuantizedEmbeddings.build(store.embeddings, 'int8')
+
+        failed = []
+        runs = {
+            'batch': dict(),
+            'per-question': dict(batch_mode=False),
+            'int8': dict(quantized=quantized, rescore_k=0),
+            'int8 +rescore': dict(quantized=quantized, rescore_k=10),
+        }
+        for name, kwargs in runs.items():
+            try:
+                retrieved = retrieve_insurance(model, store, questions, **kwargs)
+                correct = sum(r == e for r, e in zip(retrieved, expected))
+                print(f'{name:<14}: {correct}/{len(questions)} correct')
+                if correct != len(questions):
+                    failed.append(name)
+            except Exception as e:
+                print(f'{name:<14}: {type(e).__name__}: {e}')
+                failed.append(name)
+
+    print(f'Failed: {failed}')
+    sys.exit(1 if failed else 0)
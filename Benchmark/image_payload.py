@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.util import encode_image, load_docs, ImagePayloadCache, build_image_payload_store
+
+
+def load_docs_listdir(image_folder, c_ids, use_first_stage, truncate_num):
+    '''
+    原本的 load_docs: 每個 c_id 掃描一次資料夾，並每次重新讀檔、編碼 (作為正確性與速度比較的基準)
+    '''
+    result_dict = {}
+
+    def sort_key(filename):
+        parts = os.path.splitext(filename)[0].split('_p')
+        return (int(parts[0]), int(parts[1]))
+
+    all_files = []
+    for c_id in c_ids:
+        for filename in os.listdir(image_folder):
+            if filename.startswith(f"{c_id}" if use_first_stage else f"{c_id}_p") and filename.endswith('.jpg'):
+                all_files.append(filename)
+    if use_first_stage and len(all_files) > truncate_num:
+        all_files = all_files[:truncate_num]
+    all_files.sort(key=sort_key)
+
+    for filename in all_files:
+        image_path = os.path.join(image_folder, filename)
+        if os.path.isfile(image_path):
+            result_dict[os.path.splitext(filename)[0]] = encode_image(image_path)
+    return list(result_dict.values()), list(result_dict.keys())
+
+
+def make_fixture(image_folder, n_docs, pages_per_doc, image_bytes):
+    '''
+    建立假的影像 (雜訊 JPEG，檔案大小約為 image_bytes)，每份文件最多 9 頁 (避免原本 prefix 比對把 "1_p1" 與 "1_p10" 視為同一頁)
+    '''
+    side = int(image_bytes ** 0.5)
+    for c_id in range(n_docs):
+        for p in range(1, pages_per_doc + 1):
+            Image.frombytes('L', (side, side), os.urandom(side * side)).save(os.path.join(image_folder, f'{c_id}_p{p}.jpg'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 load_docs 的檔名索引 + payload cache 與原本逐一掃描資料夾的輸出與速度')
+    parser.add_argument('--docs', type=int, default=1000)
+    parser.add_argument('--pages_per_doc', type=int, default=5)
+    parser.add_argument('--image_bytes', type=int, default=100_000)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--candidates', type=int, default=20)
+    parser.add_argument('--truncate_num', type=int, default=12)
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_folder = os.path.join(tmp_dir, 'images')
+        os.makedirs(image_folder)
+        make_fixture(image_folder, args.docs, args.pages_per_doc, args.image_bytes)
+        # 題目間重複出現的熱門頁面 (不重複抽樣: 第一階段的排序中每一頁只出現一次，load_docs 對重複頁面的處理與原本不同)
+        all_pages = [f'{c_id}_p{p}' for c_id in range(args.docs) for p in range(1, args.pages_per_doc + 1)]
+        hot_pages = random.sample(all_pages, min(len(all_pages), args.candidates * 3))
+        queries = [random.sample(hot_pages, min(len(hot_pages), args.candidates)) for _ in range(args.questions)]
+
+        start = time.perf_counter()
+        expected = [load_docs_listdir(image_folder, c_ids, True, args.truncate_num) for c_ids in queries]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cache = ImagePayloadCache(image_folder)
+        actual = [load_docs(image_folder, c_ids, True, args.truncate_num, cache) for c_ids in queries]
+        cache_time = time.perf_counter() - start
+
+        store_dir = os.path.join(tmp_dir, 'store')
+        build_image_payload_store(image_folder, store_dir)
+        start = time.perf_counter()
+        store_cache = ImagePayloadCache(image_folder, store_dir=store_dir)
+        stored = [load_docs(image_folder, c_ids, True, args.truncate_num, store_cache) for c_ids in queries]
+        store_time = time.perf_counter() - start
+
+    cache.report()
+    print(f'{args.questions} questions, {args.docs * args.pages_per_doc} images')
+    print(f'listdir + encode : {legacy_time:.2f}s')
+    print(f'index + LRU      : {cache_time:.2f}s ({legacy_time / max(cache_time, 1e-9):.1f}x)')
+    print(f'index + store    : {store_time:.2f}s ({legacy_time / max(store_time, 1e-9):.1f}x)')
+    same = expected == actual == stored
+    print(f'Same output: {same}')
+    sys.exit(0 if same else 1)
@@ -0,0 +1,83 @@
+import os
+import sys
+import argparse
+import subprocess
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# module --> import 時不應載入的套件 (只應在第一次使用時才載入)
+TARGETS = {
+    'Model.util': ['numpy', 'sklearn', 'pdfplumber', 'PIL'],
+    'Model.faq': ['sentence_transformers', 'torch', 'sklearn', 'pdfplumber', 'PIL'],
+    'Model.insurance': ['sentence_transformers', 'torch', 'sklearn', 'pdfplumber', 'PIL'],
+    'Model.encoder': ['sentence_transformers', 'torch', 'numpy', 'onnxruntime', 'transformers'],
+    'Model.retrieval_engine': ['sentence_transformers', 'torch', 'sklearn', 'pdfplumber', 'PIL', 'numpy', 'scipy', 'jieba', 'rank_bm25'],
+    'main': ['sentence_transformers', 'torch', 'sklearn', 'pdfplumber', 'PIL', 'numpy', 'scipy', 'jieba', 'rank_bm25'],
+}
+
+
+def import_time(module, python=sys.executable):
+    '''
+    以 python -X importtime 在新的 process 中 import module，回傳 [(self_us, cumulative_us, depth, name)]
+
+    [module]: module 名稱，例如 Model.util
+    [python]: python 執行檔
+    '''
+    result = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO_ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr[-2000:]}')
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return entries
+
+
+def report(module, entries, forbidden, top_n):
+    '''
+    印出 module 的 import 時間與最耗時的套件，回傳被載入的禁止套件
+    '''
+    cumulative = {name: cumulative_us for _, cumulative_us, _, name in entries}
+    loaded = {name.split('.')[0] for _, _, _, name in entries}
+    violations = sorted(set(forbidden) & loaded)
+    # module 本身的 import 子樹 (-X importtime 中子module列在 parent 之前、縮排較深) 中最耗時的套件
+    children = []
+    target = max((i for i, entry in enumerate(entries) if entry[3] == module), default=None)
+    if target is not None:
+        for entry in reversed(entries[:target]):
+            if entry[2] <= entries[target][2]:
+                break
+            if entry[2] == entries[target][2] + 1:
+                children.append(entry)
+    heaviest = sorted(((cumulative_us, name) for _, cumulative_us, _, name in children), reverse=True)[:top_n]
+
+    print(f'{module:<24}: {cumulative.get(module, 0) / 1000:8.1f} ms, {len(entries)} modules'
+          + (f'  !! loads {", ".join(violations)}' if violations else ''))
+    for cumulative_us, name in heaviest:
+        print(f'    {cumulative_us / 1000:8.1f} ms  {name}')
+    return violations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='以 python -X importtime 量測各 module 的 import 時間，並檢查是否在 import 時就載入重量級套件')
+    parser.add_argument('--modules', nargs='+', default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=3, help='重複量測取最小值')
+    parser.add_argument('--top', type=int, default=5, help='每個 module 列出最耗時的套件數量')
+    parser.add_argument('--budget_ms', type=float, default=None, help='任一 module 的 import 時間超過此值即視為 regression')
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeat)]
+        entries = min(runs, key=lambda run: next((c for _, c, _, name in run if name == module), 0))
+        violations = report(module, entries, TARGETS.get(module, []), args.top)
+        total_ms = next((c for _, c, _, name in entries if name == module), 0) / 1000
+        if violations or (args.budget_ms is not None and total_ms > args.budget_ms):
+            failed.append(module)
+
+    print(f'Regressions: {failed}')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,71 @@
+import os
+import sys
+import signal
+import argparse
+import tempfile
+import subprocess
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Model')
+sys.path.insert(0, MODEL_DIR)
+from result_journal import ResultJournal, load_journal, compact_journal
+
+# 子 process: 寫入 [start, end) 的題目後，再寫入半行紀錄 (模擬寫到一半時被中斷)，通知 parent 後等待被 kill
+WRITER = '''
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from result_journal import ResultJournal
+journal = ResultJournal(sys.argv[2], resume=sys.argv[5] == 'resume')
+for qid in range(int(sys.argv[3]), int(sys.argv[4])):
+    journal.append({"qid": qid, "retrieve": qid * 10})
+journal.file.write('{"qid": 99999, "retr')
+journal.file.flush()
+print('ready', flush=True)
+time.sleep(60)
+'''
+
+
+def run_until_killed(journal_path, start, end, resume):
+    '''
+    執行 WRITER 並在其寫到一半時 SIGKILL
+    '''
+    process = subprocess.Popen([sys.executable, '-c', WRITER, MODEL_DIR, journal_path, str(start), str(end),
+                                'resume' if resume else 'new'], stdout=subprocess.PIPE, text=True)
+    for line in process.stdout:
+        if line.strip() == 'ready':
+            break
+        print(f'  writer: {line.strip()}')
+    process.send_signal(signal.SIGKILL)
+    process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='模擬 finance_anthropic.py 寫 journal 時被中斷 (最後一行寫到一半)，檢查 --resume 續跑後所有題目都在輸出中')
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--killed_after', type=int, default=20, help='每次執行寫入幾題後被中斷')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        journal_path = os.path.join(folder, 'finance.journal.jsonl')
+        output_path = os.path.join(folder, 'finance.json')
+
+        # 第一次執行: 寫入 killed_after 題後中斷，最後一行不完整
+        run_until_killed(journal_path, 0, args.killed_after, resume=False)
+        done = set(load_journal(journal_path))
+        with open(journal_path, 'rb') as f:
+            torn = not f.read().endswith(b'\n')
+        print(f'After kill: {len(done)} complete records, torn last line: {torn}')
+
+        # 續跑兩次: 第二次執行同樣在寫到一半時中斷，第三次寫完剩下的題目
+        run_until_killed(journal_path, args.killed_after, 2 * args.killed_after, resume=True)
+        done = set(load_journal(journal_path))
+        journal = ResultJournal(journal_path, resume=True)
+        for qid in range(args.questions):
+            if qid not in done:
+                journal.append({"qid": qid, "retrieve": qid * 10})
+        journal.close()
+
+        answers = compact_journal(journal_path, output_path)['answers']
+        missing = sorted(set(range(args.questions)) - {answer['qid'] for answer in answers})
+        wrong = [answer['qid'] for answer in answers if answer['retrieve'] != answer['qid'] * 10]
+        print(f'Resumed: {len(answers)}/{args.questions} answers, missing qids: {missing}, wrong: {wrong}')
+        sys.exit(1 if missing or wrong or len(answers) != args.questions else 0)
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.util import top_k_dot, get_top_k_docs_insurance, l2_normalize
+from Model.embedding_store import EmbeddingStore
+from Model.quantization import QuantizedEmbeddings
+
+
+def load_queries(args, store):
+    '''
+    回傳 (query_embeddings, candidate_lists, ground_truths)
+    FAQ 以 row 為單位 (candidate 為 row index)，Insurance 以文件為單位 (candidate 為文件編號)；ground_truths 可為 None
+    '''
+    rng = np.random.default_rng(0)
+    embeddings = store.embeddings
+    if args.synthetic:
+        # 以加上雜訊的 corpus 向量作為 query，正確答案為該向量所在的 row / 文件
+        rows = rng.choice(len(embeddings), args.synthetic)
+        query_embeddings = l2_normalize(np.asarray(embeddings[rows], dtype=np.float32)
+                                        + rng.normal(scale=args.noise, size=(len(rows), embeddings.shape[1])))
+        if args.category == 'faq':
+            truths = [int(row) for row in rows]
+            pool = np.arange(len(embeddings))
+        else:
+            truths = [store.doc_ids[np.searchsorted(store.offsets, row, side='right') - 1] for row in rows]
+            pool = np.asarray(store.doc_ids)
+        candidate_lists = []
+        for truth in truths:
+            others = [int(c) for c in rng.choice(pool, min(args.candidates, len(pool)), replace=False) if c != truth]
+            candidates = others[:args.candidates - 1] + [truth]
+            rng.shuffle(candidates)
+            candidate_lists.append(candidates)
+        return query_embeddings, candidate_lists, truths
+
+    from Model.encoder import get_encoder
+    with open(args.question_path, 'rb') as f:
+        questions = [q_dict for q_dict in json.load(f)['questions'] if q_dict['category'] == args.category]
+    model = get_encoder(store.manifest['model_name'], args.device, backend=store.encoder_backend)
+    query_embeddings = l2_normalize(model.encode(['query: ' + q_dict['query'] for q_dict in questions], batch_size=32))
+
+    ground_truths = None
+    if args.ground_truth:
+        with open(args.ground_truth, 'rb') as f:
+            answers = {answer['qid']: answer['retrieve'] for answer in json.load(f)['ground_truths']}
+        ground_truths = [answers.get(q_dict['qid']) for q_dict in questions]
+    if args.category == 'faq':
+        from Model.faq import load_faq
+        faq_positions = {faq_id: i for i, faq_id in enumerate(load_faq(args.faq_path))}
+        candidate_lists = [[faq_positions[faq_id] for faq_id in q_dict['source']] for q_dict in questions]
+        if ground_truths is not None:
+            ground_truths = [faq_positions.get(truth) for truth in ground_truths]
+    else:
+        candidate_lists = [q_dict['source'] for q_dict in questions]
+    return query_embeddings, candidate_lists, ground_truths
+
+
+def retrieve(category, store, scorer, query_embeddings, candidate_lists, rescore_k):
+    '''
+    回傳每個 query 的 top 1 (FAQ 為 row，Insurance 為文件編號)
+    [scorer]: float32 的 embeddings (baseline) 或 QuantizedEmbeddings
+    '''
+    if category == 'faq':
+        if isinstance(scorer, QuantizedEmbeddings):
+            indices, _ = scorer.search(query_embeddings, 1, candidate_lists, store.embeddings, rescore_k)
+        else:
+            indices, _ = top_k_dot(scorer, query_embeddings, 1, candidate_lists)
+        return [int(row[0]) for row in indices]
+    if isinstance(scorer, QuantizedEmbeddings):
+        docs = scorer.search_docs(query_embeddings, store.offsets, store.doc_ids, candidate_lists, 1, store.embeddings, rescore_k)
+    else:
+        docs = get_top_k_docs_insurance(scorer, store.offsets, store.doc_ids, query_embeddings, candidate_lists, 1)
+    return [doc[0] for doc in docs]
+
+
+def measure(category, store, scorer, query_embeddings, candidate_lists, rescore_k):
+    '''
+    回傳 (top 1, ms/query, 計分時的暫存記憶體峰值 bytes)
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    retrieved = retrieve(category, store, scorer, query_embeddings, candidate_lists, rescore_k)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retrieved, elapsed / len(query_embeddings) * 1000, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 float16 / int8 量化 embeddings 與 float32 的記憶體用量、檢索結果與速度')
+    parser.add_argument('--category', default='insurance', choices=['faq', 'insurance'])
+    parser.add_argument('--store_dir', default=None, help='預設為 ./reference/processed_<category>/embedding_store')
+    parser.add_argument('--question_path', default='./preliminary_test/questions_preliminary.json')
+    parser.add_argument('--faq_path', default='./reference/faq/pid_map_content.json')
+    parser.add_argument('--ground_truth', default=None, help='ground truth json ({"ground_truths": [{"qid", "retrieve"}]})，提供時另外計算正確率')
+    parser.add_argument('--synthetic', type=int, default=0, help='不載入模型，改用 N 筆加上雜訊的 corpus 向量作為 query')
+    parser.add_argument('--noise', type=float, default=0.05, help='synthetic query 的雜訊標準差')
+    parser.add_argument('--candidates', type=int, default=5, help='synthetic query 的 candidate 數量')
+    parser.add_argument('--rescore_k', type=int, nargs='+', default=[0, 5, 10])
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    store = EmbeddingStore.load(args.store_dir or f'./reference/processed_{args.category}/embedding_store')
+    query_embeddings, candidate_lists, ground_truths = load_queries(args, store)
+
+    # baseline: 整個 float32 矩陣載入記憶體
+    full = np.asarray(store.embeddings, dtype=np.float32)
+    expected, baseline_ms, baseline_peak = measure(args.category, store, full, query_embeddings, candidate_lists, 0)
+
+    def accuracy(retrieved):
+        pairs = [(r, t) for r, t in zip(retrieved, ground_truths) if t is not None] if ground_truths else []
+        return f'{np.mean([r == t for r, t in pairs]):.4f}' if pairs else '-'
+
+    n = len(query_embeddings)
+    print(f'{args.category}: {len(full)} vectors x {full.shape[1]} dims, {n} queries')
+    print(f'{"mode":<16} {"resident MB":>12} {"scoring peak MB":>16} {"agree@1":>8} {"acc@1":>7} {"ms/query":>9}')
+    print(f'{"float32":<16} {full.nbytes / 2**20:12.2f} {baseline_peak / 2**20:16.2f} {1.0:8.4f} {accuracy(expected):>7} {baseline_ms:9.3f}')
+    del full
+
+    for dtype in ('float16', 'int8'):
+        quantized = QuantizedEmbeddings.build(store.embeddings, dtype)
+        for rescore_k in args.rescore_k:
+            retrieved, ms, peak = measure(args.category, store, quantized, query_embeddings, candidate_lists, rescore_k)
+            agreement = np.mean([r == e for r, e in zip(retrieved, expected)])
+            mode = dtype + (f' +rescore{rescore_k}' if rescore_k else '')
+            print(f'{mode:<16} {quantized.nbytes / 2**20:12.2f} {peak / 2**20:16.2f} {agreement:8.4f} {accuracy(retrieved):>7} {ms:9.3f}')
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Model'))
+import finance_anthropic
+from mock_messages_api import start_mock_server
+from result_journal import ResultJournal, load_journal
+
+
+def make_fixture(image_folder, n_questions, pages_per_doc=3, docs_per_question=4, shared_questions=0):
+    '''
+    建立假的影像與第一階段結果 (影像內容不會被 mock server 解析，尺寸不同以測試 token budget)
+
+    [shared_questions]: 最後幾題沿用前面題目的第一階段結果 (相同候選影像、不同 query)，用以測試 prompt caching
+    '''
+    questions = []
+    answers = []
+    for qid in range(1, n_questions + 1):
+        questions.append({'qid': qid, 'query': f'mock query {qid}', 'category': 'finance', 'source': []})
+        if qid > n_questions - shared_questions:
+            shared = answers[(qid - 1) % (n_questions - shared_questions)]
+            answers.append({'qid': qid, 'retrieve': shared['retrieve'], 'scores': shared['scores']})
+            continue
+        retrieve, scores = [], []
+        for d in range(docs_per_question):
+            c_id = qid * 100 + d
+            for p in range(1, pages_per_doc + 1):
+                size = random.choice([(1240, 1754), (1000, 1000), (600, 800)])
+                Image.new('RGB', size, 'white').save(os.path.join(image_folder, f'{c_id}_p{p}.jpg'))
+                retrieve.append(f'{c_id}_p{p}')
+                scores.append(round(random.uniform(1, 10), 4))
+        order = sorted(range(len(retrieve)), key=lambda i: scores[i], reverse=True)
+        answers.append({'qid': qid, 'retrieve': [retrieve[i] for i in order], 'scores': [scores[i] for i in order]})
+    return questions, {'answers': answers}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='以本地 mock Messages API 測試 finance reranking 的併發、rate limit 與重試')
+    parser.add_argument('--questions', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--rate_limit_rate', type=float, default=0.1)
+    parser.add_argument('--server_error_rate', type=float, default=0.05)
+    parser.add_argument('--max_concurrency', type=int, default=8)
+    parser.add_argument('--requests_per_minute', type=int, default=600)
+    parser.add_argument('--input_tokens_per_minute', type=int, default=2_000_000)
+    parser.add_argument('--shared_questions', type=int, default=10, help='沿用前面題目候選影像的題數 (測試 prompt caching)')
+    parser.add_argument('--no_prompt_caching', action='store_true')
+    parser.add_argument('--bad_questions', type=int, default=1,
+                        help='第一階段只有一個結果的題數 (select_candidates 會失敗)，這些題目應單獨失敗，其他題目照常完成並寫入 journal')
+    args = parser.parse_args()
+
+    server = start_mock_server(latency=args.latency, rate_limit_rate=args.rate_limit_rate,
+                               server_error_rate=args.server_error_rate)
+    with tempfile.TemporaryDirectory() as image_folder:
+        questions, first_stage = make_fixture(image_folder, args.questions, shared_questions=args.shared_questions)
+        bad_qids = [q_dict['qid'] for q_dict in questions[:args.bad_questions]]
+        for answer in first_stage['answers']:
+            if answer['qid'] in bad_qids:
+                answer['retrieve'], answer['scores'] = answer['retrieve'][:1], answer['scores'][:1]
+
+        finance_anthropic.image_folder = image_folder
+        finance_anthropic.base_url = server.base_url
+        finance_anthropic.api_key = 'mock'
+        finance_anthropic.max_concurrency = args.max_concurrency
+        finance_anthropic.requests_per_minute = args.requests_per_minute
+        finance_anthropic.input_tokens_per_minute = args.input_tokens_per_minute
+        finance_anthropic.max_retries = 8
+        finance_anthropic.cache_mode = 'missing'
+        finance_anthropic.response_cache_path = os.path.join(image_folder, 'response_cache.sqlite')
+        finance_anthropic.usage_log_path = None
+        finance_anthropic.prompt_caching = not args.no_prompt_caching
+
+        journal_path = os.path.join(image_folder, 'finance.journal.jsonl')
+        journal = ResultJournal(journal_path)
+        start = time.perf_counter()
+        try:
+            results = asyncio.run(finance_anthropic.rerank_all(questions, first_stage, journal))
+        finally:
+            journal.close()
+        elapsed = time.perf_counter() - start
+        journaled = sorted(load_journal(journal_path))
+
+        # 第二次執行: 影像與查詢都相同，應全部命中 response cache，不再送出 request
+        sent_before = server.stats['requests']
+        start = time.perf_counter()
+        cached_results = asyncio.run(finance_anthropic.rerank_all(questions, first_stage))
+        cached_elapsed = time.perf_counter() - start
+        cached_requests = server.stats['requests'] - sent_before
+    server.shutdown()
+
+    cache_read_ok = args.no_prompt_caching or args.shared_questions == 0 or server.stats['cache_read_input_tokens'] > 0
+    failed = [q['qid'] for q, r in zip(questions, results) if isinstance(r, Exception)]
+    in_order = [r['qid'] for r in results if not isinstance(r, Exception)] == [q['qid'] for q in questions if q['qid'] not in failed]
+    journal_ok = journaled == [q['qid'] for q in questions if q['qid'] not in bad_qids]
+    print(f'Mock server stats: {server.stats}')
+    print(f'{len(questions)} questions in {elapsed:.2f}s (sequential lower bound ~{len(questions) * args.latency:.1f}s)')
+    print(f'Failed: {failed} (expected {bad_qids}), results in qid order: {in_order}, journaled: {len(journaled)}/{len(questions)}')
+    # 失敗的題目每次都是新的 Exception，只比較成功的結果
+    same_results = [r for r in cached_results if not isinstance(r, Exception)] == [r for r in results if not isinstance(r, Exception)]
+    cache_ok = cached_requests == 0 and same_results
+    print(f'Cached re-run: {cached_elapsed:.2f}s, {cached_requests} requests sent, same results: {same_results}')
+    sys.exit(0 if in_order and failed == bad_qids and journal_ok and cache_ok and cache_read_ok else 1)
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.util import split_content_by_length, iter_split_content_by_length
+
+
+def split_content_by_length_concat(chunks, threshold_truncate = 512):
+    '''
+    原本的 split_content_by_length: 以字串串接累積每個部分，每行都重新計算長度 (作為正確性與速度比較的基準)
+    '''
+    result = []
+    for chunk in chunks:
+        content = chunk['content']
+        header = chunk['header']
+        parts = []
+        current_part = ""
+
+        for line in content.split('\n'):
+            if line.endswith('。'):
+                current_part += line + '\n'
+                if len(current_part) >= threshold_truncate:
+                    parts.append(current_part)
+                    current_part = ""
+            else:
+                if len(current_part + line + '\n') > threshold_truncate and current_part:
+                    parts.append(current_part)
+                    current_part = line + '\n'
+                else:
+                    current_part += line + '\n'
+
+        if current_part:
+            if parts and len(current_part) < threshold_truncate / 2:
+                if len(parts[-1] + current_part) <= threshold_truncate:
+                    parts[-1] += current_part
+                else:
+                    parts.append(current_part)
+            else:
+                parts.append(current_part)
+
+        for part in parts:
+            result.append({'header': header, 'content': part})
+    return result
+
+
+def make_chunks(n_chunks, lines_per_chunk, max_line_length):
+    '''
+    產生假的 chunk: 長度不一的文字行，部分以句點結尾，並夾雜空行
+    '''
+    chunks = []
+    for i in range(n_chunks):
+        lines = []
+        for _ in range(random.randint(1, lines_per_chunk)):
+            line = '字' * random.randint(0, max_line_length)
+            if random.random() < 0.3:
+                line += '。'
+            lines.append(line)
+        chunks.append({'header': f'第{i}條' if i % 5 else None, 'content': '\n'.join(lines)})
+    return chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='比較 generator 版 split_content_by_length 與原本字串串接版本的輸出與速度')
+    parser.add_argument('--chunks', type=int, default=200)
+    parser.add_argument('--lines_per_chunk', type=int, default=2000)
+    parser.add_argument('--max_line_length', type=int, default=80)
+    parser.add_argument('--threshold', type=int, default=512)
+    args = parser.parse_args()
+
+    random.seed(0)
+    chunks = make_chunks(args.chunks, args.lines_per_chunk, args.max_line_length)
+    # 額外測試閾值很大 (單一部分很長) 的情況，原本的字串串接在此時為 quadratic
+    thresholds = [args.threshold, args.threshold * 64]
+
+    mismatched = []
+    for threshold in thresholds:
+        start = time.perf_counter()
+        expected = split_content_by_length_concat(chunks, threshold)
+        concat_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = split_content_by_length(chunks, threshold)
+        generator_time = time.perf_counter() - start
+
+        # 串流消耗: 不保留中間的列表
+        start = time.perf_counter()
+        total_length = sum(len(part['content']) for part in iter_split_content_by_length(chunks, threshold))
+        stream_time = time.perf_counter() - start
+
+        print(f'threshold={threshold}: {len(expected)} parts, {total_length} chars')
+        print(f'  string concat : {concat_time:.3f}s')
+        print(f'  generator     : {generator_time:.3f}s ({concat_time / max(generator_time, 1e-9):.2f}x)')
+        print(f'  streamed      : {stream_time:.3f}s')
+        if expected != actual:
+            mismatched.append(threshold)
+
+    print(f'Same output: {not mismatched}')
+    sys.exit(1 if mismatched else 0)
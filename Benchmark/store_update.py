@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Model.embedding_store import EmbeddingStore
+
+STORE_FILES = ('embeddings.npy', 'offsets.npy', 'chunks.json', 'manifest.json')
+
+
+def read_chunks(path):
+    '''
+    每行為一個 chunk
+    '''
+    with open(path, 'r', encoding='utf8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class HashEncoder:
+    '''
+    以文字 hash 產生固定的向量 (不需載入模型)，並記錄 encode 過的 chunk 數量
+    '''
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.encoded = 0
+
+    def __call__(self, texts):
+        self.encoded += len(texts)
+        seeds = [int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16) for text in texts]
+        return np.stack([np.random.default_rng(seed).normal(size=self.dim) for seed in seeds]).astype(np.float32)
+
+
+def file_stats(store_dir):
+    '''
+    store 中每個檔案的 (inode, mtime_ns)，檔案被重寫 (os.replace) 時會改變
+    '''
+    stats = {}
+    for name in STORE_FILES:
+        stat = os.stat(os.path.join(store_dir, name))
+        stats[name] = (stat.st_ino, stat.st_mtime_ns)
+    return stats
+
+
+def timed_update(store_dir, sources, encoder):
+    encoder.encoded = 0
+    start = time.perf_counter()
+    store = EmbeddingStore.update(store_dir, sources, read_chunks, encoder, 'hash-encoder')
+    return store, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='檢查沒有文件改變時 EmbeddingStore.update 不會重寫 store，只有改變的文件會重新 encode')
+    parser.add_argument('--docs', type=int, default=200)
+    parser.add_argument('--chunks_per_doc', type=int, default=50)
+    parser.add_argument('--dim', type=int, default=1024)
+    args = parser.parse_args()
+
+    failed = []
+    encoder = HashEncoder(args.dim)
+    with tempfile.TemporaryDirectory() as folder:
+        store_dir = os.path.join(folder, 'store')
+        sources = {}
+        for doc_id in range(args.docs):
+            sources[doc_id] = os.path.join(folder, f'{doc_id}.txt')
+            with open(sources[doc_id], 'w', encoding='utf8') as f:
+                f.write('\n'.join(f'doc {doc_id} chunk {i}' for i in range(args.chunks_per_doc)))
+
+        _, build_time = timed_update(store_dir, sources, encoder)
+        print(f'build          : {build_time:.3f}s, {encoder.encoded} chunks encoded')
+
+        # 沒有任何改變: store 的檔案都不應被重寫
+        before = file_stats(store_dir)
+        _, noop_time = timed_update(store_dir, sources, encoder)
+        rewritten = [name for name, stat in file_stats(store_dir).items() if before[name] != stat]
+        print(f'no-op update   : {noop_time:.3f}s, {encoder.encoded} chunks encoded, rewritten: {rewritten}')
+        if rewritten or encoder.encoded:
+            failed.append('no-op update')
+
+        # 只有修改時間改變 (內容相同): 只更新 manifest.json
+        os.utime(sources[0])
+        before = file_stats(store_dir)
+        _, touch_time = timed_update(store_dir, sources, encoder)
+        rewritten = [name for name, stat in file_stats(store_dir).items() if before[name] != stat]
+        print(f'touched file   : {touch_time:.3f}s, {encoder.encoded} chunks encoded, rewritten: {rewritten}')
+        if rewritten != ['manifest.json'] or encoder.encoded:
+            failed.append('touched file')
+
+        # 修改一份文件: 只重新 encode 該文件，結果與重新建立的 store 相同
+        with open(sources[1], 'a', encoding='utf8') as f:
+            f.write('\nnew chunk')
+        store, change_time = timed_update(store_dir, sources, encoder)
+        print(f'one doc changed: {change_time:.3f}s, {encoder.encoded} chunks encoded')
+        fresh, _ = timed_update(os.path.join(folder, 'fresh'), sources, encoder)
+        if (encoder.encoded == 0 or store.chunks != fresh.chunks or not np.array_equal(store.offsets, fresh.offsets)
+                or not np.allclose(store.embeddings, fresh.embeddings)):
+            failed.append('one doc changed')
+
+    print(f'Failed: {failed}')
+    sys.exit(1 if failed else 0)
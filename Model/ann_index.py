@@ -0,0 +1,186 @@
+import os
+import json
+import hashlib
+import numpy as np
+from Model.util import l2_normalize
+
+
+def spherical_kmeans(embeddings, n_clusters, n_iter=20, seed=0, batch_size=4096):
+    '''
+    以 NumPy 實作的 spherical k-means (以內積分群，centroid 正規化為長度 1)
+
+    [embeddings]: 已正規化的 embeddings，shape:(#data, #embedding dim)
+    [n_clusters]: cluster 數量
+    [n_iter]: 迭代次數
+    [seed]: 隨機種子
+    [batch_size]: 計算 assignment 時每次處理的筆數，避免一次建立 (#data, #cluster) 的大矩陣
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(embeddings))
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = assign_clusters(embeddings, centroids, batch_size)
+
+        # 依 cluster 排序後以 reduceat 加總每個 cluster 的向量
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=n_clusters)
+        non_empty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[non_empty] = np.add.reduceat(embeddings[order], starts[non_empty], axis=0)
+
+        # 空的 cluster 重新隨機選一筆資料作為 centroid
+        sums[~non_empty] = embeddings[rng.choice(len(embeddings), int((~non_empty).sum()))]
+        centroids = l2_normalize(sums)
+
+    return centroids
+
+def assign_clusters(embeddings, centroids, batch_size=4096):
+    '''
+    將每一筆 embedding 分配至內積最大的 centroid
+    '''
+    assignment = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), batch_size):
+        batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+        assignment[start:start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignment
+
+def store_signature(store):
+    '''
+    EmbeddingStore 內容的 fingerprint，store 更新 (包含換成其他 encoder backend 重新 encode) 後已建立的 ANN index 需要重建
+    '''
+    documents = json.dumps([store.manifest['model_name'], store.encoder_backend, store.manifest['documents']], sort_keys=True)
+    return hashlib.sha1(documents.encode('utf-8')).hexdigest()
+
+
+class IVFIndex:
+    '''
+    Inverted file (IVF) ANN index: 以 k-means 將 embeddings 分為 nlist 個 cluster，
+    查詢時只計算最接近的 nprobe 個 cluster 中的向量。nprobe 越大 recall 越高、速度越慢。
+    '''
+
+    def __init__(self, embeddings, centroids, list_offsets, list_ids, nprobe=8, signature=None):
+        '''
+        [embeddings]: 已正規化的 embeddings (可為 mmap)，shape:(#data, #embedding dim)
+        [centroids]: cluster centroids，shape:(nlist, #embedding dim)
+        [list_offsets]: 每個 cluster 在 list_ids 中的起始位置，shape:(nlist + 1,)
+        [list_ids]: 依 cluster 排序的 embedding row，shape:(#data,)
+        [nprobe]: 查詢時搜尋的 cluster 數量
+        [signature]: 建立 index 時的 store fingerprint
+        '''
+        self.embeddings = embeddings
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+        self.signature = signature
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, nlist=None, nprobe=8, n_iter=20, seed=0, signature=None):
+        '''
+        [embeddings]: 已正規化的 embeddings，shape:(#data, #embedding dim)
+        [nlist]: cluster 數量，None 則使用 4 * sqrt(#data)
+        [nprobe]: 查詢時搜尋的 cluster 數量
+        [n_iter]: k-means 迭代次數
+        [seed]: k-means 隨機種子
+        [signature]: store fingerprint
+        '''
+        nlist = nlist or max(1, int(4 * np.sqrt(len(embeddings))))
+        centroids = spherical_kmeans(embeddings, nlist, n_iter, seed)
+        assignment = assign_clusters(embeddings, centroids)
+        list_ids = np.argsort(assignment, kind='stable')
+        list_offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(centroids)))
+        return cls(embeddings, centroids, list_offsets, list_ids, nprobe, signature)
+
+    def save(self, index_path):
+        np.savez(index_path, centroids=self.centroids, list_offsets=self.list_offsets,
+                 list_ids=self.list_ids, signature=np.array(self.signature or ''))
+
+    @classmethod
+    def load(cls, index_path, embeddings, nprobe=8):
+        with np.load(index_path) as data:
+            return cls(embeddings, data['centroids'], data['list_offsets'], data['list_ids'],
+                       nprobe, str(data['signature']) or None)
+
+    @classmethod
+    def load_or_build(cls, store, nlist=None, nprobe=8, index_name='ivf.npz'):
+        '''
+        讀取 store 資料夾中的 IVF index，不存在或 store 已更新時重新建立
+
+        [store]: EmbeddingStore
+        [nlist]: cluster 數量
+        [nprobe]: 查詢時搜尋的 cluster 數量
+        [index_name]: index 檔名
+        '''
+        index_path = os.path.join(store.store_dir, index_name)
+        signature = store_signature(store)
+        if os.path.exists(index_path):
+            index = cls.load(index_path, store.embeddings, nprobe)
+            if index.signature == signature and (nlist is None or index.nlist == nlist):
+                return index
+        print(f'Building IVF index for {store.store_dir}')
+        index = cls.build(store.embeddings, nlist, nprobe, signature=signature)
+        index.save(index_path)
+        return index
+
+    def search(self, query_embeddings, top_k, nprobe=None):
+        '''
+        回傳 (indices, scores)，格式與 util.top_k_dot 相同
+
+        [query_embeddings]: 已正規化的 query embeddings，shape:(#query, #embedding dim) 或 (#embedding dim,)
+        [top_k]: 每個 query 取出幾筆
+        [nprobe]: 搜尋的 cluster 數量，None 則使用建立時的設定
+        '''
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+
+        # 每個 query 最接近的 nprobe 個 cluster
+        centroid_scores = query_embeddings @ self.centroids.T
+        probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe] if nprobe < self.nlist \
+            else np.tile(np.arange(self.nlist), (len(query_embeddings), 1))
+
+        top_indices = np.full((len(query_embeddings), top_k), -1, dtype=np.int64)
+        top_scores = np.full((len(query_embeddings), top_k), -np.inf, dtype=np.float32)
+        for q, probe in enumerate(probes):
+            rows = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probe])
+            if not len(rows):
+                continue
+            rows.sort()
+            scores = np.asarray(self.embeddings[rows], dtype=np.float32) @ query_embeddings[q]
+            k = min(top_k, len(rows))
+            selected = np.argpartition(-scores, k - 1)[:k] if k < len(rows) else np.arange(k)
+            selected = selected[np.argsort(-scores[selected], kind='stable')]
+            top_indices[q, :k] = rows[selected]
+            top_scores[q, :k] = scores[selected]
+        return top_indices, top_scores
+
+
+def rows_to_docs(indices, doc_offsets, doc_ids, top_k=1):
+    '''
+    將 chunk 層級的檢索結果 (依分數排序) 轉為文件層級: 每份文件取最高分的 chunk，回傳每個 query 的 top_k 份文件
+
+    [indices]: 依分數排序的 chunk row，shape:(#query, #retrieved chunks)，-1 表示無結果
+    [doc_offsets]: 每份文件在 embeddings 中的起始位置，shape:(#docs + 1,)
+    [doc_ids]: 每份文件的編號
+    [top_k]: 每個 query 回傳幾份文件
+    '''
+    results = []
+    for row_indices in indices:
+        row_indices = row_indices[row_indices >= 0]
+        doc_positions = np.searchsorted(doc_offsets, row_indices, side='right') - 1
+        docs = []
+        for position in doc_positions:
+            doc_id = doc_ids[position]
+            if doc_id not in docs:
+                docs.append(doc_id)
+                if len(docs) == top_k:
+                    break
+        results.append(docs)
+    return results
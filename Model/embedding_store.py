@@ -0,0 +1,249 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from Model.util import l2_normalize
+
+FORMAT_VERSION = 2
+
+
+def file_hash(path):
+    '''
+    計算檔案內容的 sha1
+    [path]: 檔案路徑
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def iter_chunked_documents(sources, chunk_fn, workers=1):
+    '''
+    對每份文件執行 chunk_fn，依完成順序逐一回傳 (doc_id, chunks, error)
+    單一文件失敗時 chunks 為 None、error 為錯誤訊息，不會中斷其他文件
+
+    [sources]: {doc_id: 檔案路徑}
+    [chunk_fn]: 檔案路徑 --> chunk 文字列表 (須為 module 層級的函式，才能傳給 worker process)
+    [workers]: 大於1時以 process pool 平行處理
+    '''
+    if workers and workers > 1 and len(sources) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(chunk_fn, path): doc_id for doc_id, path in sources.items()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                doc_id = futures[future]
+                try:
+                    yield doc_id, list(future.result()), None
+                except Exception as e:
+                    yield doc_id, None, f'{type(e).__name__}: {e}'
+    else:
+        for doc_id, path in tqdm(sources.items()):
+            try:
+                yield doc_id, list(chunk_fn(path)), None
+            except Exception as e:
+                yield doc_id, None, f'{type(e).__name__}: {e}'
+
+
+class EmbeddingStore:
+    '''
+    Chunk 文字與 embeddings 的持久化儲存，查詢時只需 mmap 讀取，不需重新解析PDF與encode
+
+    [store_dir]/
+        manifest.json : 模型名稱、encoder backend、dtype、每份文件的 hash 與 chunk 數量
+        embeddings.npy : 所有 chunk 的 embeddings (已 L2 正規化，連續存放)，shape:(#chunks, #embedding dim)，可 mmap 讀取
+        offsets.npy : 每份文件在 embeddings 中的起始位置，shape:(#docs + 1,)
+        chunks.json : 所有 chunk 文字，順序與 embeddings 的 row 相同
+    '''
+
+    def __init__(self, store_dir, manifest, embeddings, offsets, chunks):
+        self.store_dir = store_dir
+        self.manifest = manifest
+        self.embeddings = embeddings
+        self.offsets = offsets
+        self.chunks = chunks
+        self.doc_ids = [doc['doc_id'] for doc in manifest['documents']]
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+
+    @classmethod
+    def load(cls, store_dir, mmap=True):
+        '''
+        讀取 store，若不存在則回傳 None
+
+        [store_dir]: store 資料夾
+        [mmap]: 是否以 memory map 方式讀取 embeddings
+        '''
+        manifest_path = os.path.join(store_dir, 'manifest.json')
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf8') as f:
+            manifest = json.load(f)
+        embeddings = np.load(os.path.join(store_dir, 'embeddings.npy'), mmap_mode='r' if mmap else None)
+        offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+        with open(os.path.join(store_dir, 'chunks.json'), 'r', encoding='utf8') as f:
+            chunks = json.load(f)
+        return cls(store_dir, manifest, embeddings, offsets, chunks)
+
+    @property
+    def encoder_backend(self):
+        '''
+        建立 embeddings 時的 encoder backend (沒有記錄的舊版 store 皆以 torch 建立)
+        '''
+        return self.manifest.get('encoder_backend', 'torch')
+
+    def doc_embeddings(self, doc_id):
+        '''
+        某份文件所有 chunk 的 embeddings，shape:(#chunk, #embedding dim)
+        [doc_id]: 文件編號
+        '''
+        i = self.doc_index[doc_id]
+        return self.embeddings[self.offsets[i]:self.offsets[i + 1]]
+
+    def doc_chunks(self, doc_id):
+        '''
+        某份文件所有 chunk 的文字
+        [doc_id]: 文件編號
+        '''
+        i = self.doc_index[doc_id]
+        return self.chunks[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_dict(self):
+        '''
+        轉為 {doc_id: array(#chunk, #embedding dim)} 的格式 (每個值都是 embeddings 的 view，不會複製)
+        '''
+        return {doc_id: self.doc_embeddings(doc_id) for doc_id in self.doc_ids}
+
+    @classmethod
+    def update(cls, store_dir, sources, chunk_fn, encode_fn, model_name, dtype='float32', workers=1, encoder_backend='torch'):
+        '''
+        增量更新 store: 只有內容 hash 改變或新增的文件會重新 chunking 與 encode，已移除的文件會被刪除
+        chunking 失敗的文件會記錄在 manifest 的 failures 中 (若有舊版本則保留舊版本)，不會中斷整個更新
+        沒有任何文件新增、改變或移除 (且模型、backend、dtype 相同) 時直接回傳現有的 store，不重寫 embeddings
+
+        [store_dir]: store 資料夾
+        [sources]: {doc_id: 檔案路徑}
+        [chunk_fn]: 檔案路徑 --> chunk 文字列表
+        [encode_fn]: chunk 文字列表 --> embeddings，shape:(#chunk, #embedding dim)
+        [model_name]: embedding 模型名稱，模型或 dtype 改變時會全部重建
+        [dtype]: 'float32' 或 'float16'
+        [workers]: chunking 使用的 process 數量
+        [encoder_backend]: encode_fn 使用的 encoder backend ('torch' / 'onnx' / 'onnx-int8')，改變時會全部重建 (不同 backend 的 embedding 不完全相同)
+        '''
+        os.makedirs(store_dir, exist_ok=True)
+        old = cls.load(store_dir)
+        if old is not None and (old.manifest.get('version') != FORMAT_VERSION
+                                or old.manifest.get('model_name') != model_name
+                                or old.encoder_backend != encoder_backend
+                                or old.manifest.get('dtype') != dtype):
+            old = None
+        old_docs = {doc['doc_id']: doc for doc in old.manifest['documents']} if old is not None else {}
+
+        documents = {}
+        changed = {}
+        for doc_id in sorted(sources):
+            path = sources[doc_id]
+            stat = os.stat(path)
+            old_doc = old_docs.get(doc_id)
+            # 檔案大小與修改時間都沒變時沿用舊的 hash，不需重新讀取檔案
+            if old_doc and old_doc['size'] == stat.st_size and old_doc['mtime'] == stat.st_mtime:
+                sha1 = old_doc['sha1']
+            else:
+                sha1 = file_hash(path)
+
+            documents[doc_id] = {
+                'doc_id': doc_id,
+                'file': os.path.basename(path),
+                'sha1': sha1,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'count': old_doc['count'] if old_doc else 0,
+            }
+            if not (old_doc and old_doc['sha1'] == sha1):
+                changed[doc_id] = path
+
+        removed = set(old_docs) - set(sources)
+        if old is not None and not changed and not removed:
+            # 沒有新增/改變/移除的文件時直接沿用現有的 store，不重寫 embeddings.npy
+            # 只有檔案修改時間改變 (內容相同) 或舊的 failures 已不存在時更新 manifest.json
+            documents = [documents[doc_id] for doc_id in sorted(documents)]
+            print(f'Embedding store: 0 encoded, {len(documents)} reused, 0 removed, 0 failed')
+            if documents != old.manifest['documents'] or old.manifest.get('failures'):
+                old.manifest = dict(old.manifest, documents=documents, failures=[])
+                with open(os.path.join(store_dir, 'manifest.tmp.json'), 'w', encoding='utf8') as f:
+                    json.dump(old.manifest, f, ensure_ascii=False, indent=4)
+                os.replace(os.path.join(store_dir, 'manifest.tmp.json'), os.path.join(store_dir, 'manifest.json'))
+            return old
+
+        # 平行 chunking，每份文件完成後立即 encode
+        new_doc_chunks = {}
+        new_doc_embeddings = {}
+        failures = []
+        for doc_id, doc_chunks, error in iter_chunked_documents(changed, chunk_fn, workers):
+            if error is not None:
+                print(f'Failed to process {changed[doc_id]}: {error}')
+                failures.append({'doc_id': doc_id, 'file': os.path.basename(changed[doc_id]), 'error': error})
+                if doc_id in old_docs:
+                    documents[doc_id] = old_docs[doc_id]
+                else:
+                    del documents[doc_id]
+                continue
+            new_doc_chunks[doc_id] = doc_chunks
+            documents[doc_id]['count'] = len(doc_chunks)
+            if doc_chunks:
+                new_doc_embeddings[doc_id] = l2_normalize(encode_fn(doc_chunks)).astype(dtype)
+
+        documents = [documents[doc_id] for doc_id in sorted(documents)]
+        print(f'Embedding store: {len(new_doc_chunks)} encoded, {len(documents) - len(new_doc_chunks)} reused, '
+              f'{len(removed)} removed, {len(failures)} failed')
+
+        if new_doc_embeddings:
+            dim = next(iter(new_doc_embeddings.values())).shape[1]
+        elif old is not None:
+            dim = old.embeddings.shape[1]
+        else:
+            dim = 0
+
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([doc['count'] for doc in documents])
+
+        # 逐份文件寫入新的 embeddings (沿用的文件直接從舊的 mmap 複製)
+        tmp_embeddings_path = os.path.join(store_dir, 'embeddings.tmp.npy')
+        embeddings = np.lib.format.open_memmap(tmp_embeddings_path, mode='w+', dtype=dtype, shape=(int(offsets[-1]), dim))
+        chunks = []
+        for i, doc in enumerate(documents):
+            doc_id = doc['doc_id']
+            start, end = offsets[i], offsets[i + 1]
+            if doc_id in new_doc_chunks:
+                doc_chunks = new_doc_chunks[doc_id]
+                if doc['count']:
+                    embeddings[start:end] = new_doc_embeddings[doc_id]
+            else:
+                doc_chunks = old.doc_chunks(doc_id)
+                embeddings[start:end] = old.doc_embeddings(doc_id)
+            chunks.extend(doc_chunks)
+        embeddings.flush()
+        del embeddings
+        del old
+
+        manifest = {
+            'version': FORMAT_VERSION,
+            'model_name': model_name,
+            'encoder_backend': encoder_backend,
+            'dtype': dtype,
+            'dim': dim,
+            'documents': documents,
+            'failures': failures,
+        }
+        np.save(os.path.join(store_dir, 'offsets.tmp.npy'), offsets)
+        with open(os.path.join(store_dir, 'chunks.tmp.json'), 'w', encoding='utf8') as f:
+            json.dump(chunks, f, ensure_ascii=False)
+        with open(os.path.join(store_dir, 'manifest.tmp.json'), 'w', encoding='utf8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+        os.replace(tmp_embeddings_path, os.path.join(store_dir, 'embeddings.npy'))
+        os.replace(os.path.join(store_dir, 'offsets.tmp.npy'), os.path.join(store_dir, 'offsets.npy'))
+        os.replace(os.path.join(store_dir, 'chunks.tmp.json'), os.path.join(store_dir, 'chunks.json'))
+        os.replace(os.path.join(store_dir, 'manifest.tmp.json'), os.path.join(store_dir, 'manifest.json'))
+
+        return cls.load(store_dir)
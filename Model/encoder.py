@@ -0,0 +1,290 @@
+import os
+import threading
+
+DEFAULT_MODEL_NAME = 'intfloat/multilingual-e5-large'
+DEFAULT_CACHE_DIR = './Model/cache' # repo for storing HuggingFace Model
+ENCODER_BACKENDS = ('torch', 'onnx', 'onnx-int8')
+# 與 SentenceTransformer 的 embedding (正規化後) 最低的 cosine similarity
+ONNX_MIN_COSINE = {'onnx': 0.9999, 'onnx-int8': 0.98}
+# export 後用來檢查 embedding 是否與 SentenceTransformer 一致的句子
+VERIFY_SENTENCES = [
+    'query: 如何申請保險理賠？',
+    'query: 2023年第3季的營業收入是多少？',
+    'passage: 被保險人於契約有效期間內因疾病或傷害住院診療時，本公司依約定給付保險金。',
+    'query: How do I reset my online banking password?',
+]
+
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+class LazyEncoder:
+    '''
+    SentenceTransformer 的 lazy wrapper: 建立時不載入模型 (也不 import sentence_transformers / torch)，
+    第一次 encode 時才載入。embedding store 已是最新時，只需要 encode query，啟動時不必等待模型載入
+    '''
+
+    def __init__(self, model_name, device, cache_dir, num_threads=None):
+        '''
+        [num_threads]: torch 的 CPU thread 數量 (torch.set_num_threads，整個 process 共用)，None 則使用 torch 預設值
+        '''
+        self.model_name = model_name
+        self.device = device
+        self.cache_dir = cache_dir
+        self.num_threads = num_threads
+        self.backend = 'torch'
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    if self.num_threads:
+                        import torch
+                        torch.set_num_threads(self.num_threads)
+                    print(f'Loading {self.model_name} on {self.device}')
+                    self._model = SentenceTransformer(self.model_name, trust_remote_code=True,
+                                                      cache_folder=self.cache_dir, device=self.device)
+        return self._model
+
+    def load(self):
+        '''
+        立即載入模型 (常駐服務啟動時預熱，避免第一個 request 等待)
+        '''
+        return self.model
+
+    def encode(self, sentences, **kwargs):
+        return self.model.encode(sentences, **kwargs)
+
+
+def onnx_model_dir(model_name, cache_dir):
+    '''
+    ONNX 模型的存放位置: <cache_dir>/onnx/<model_name>
+    '''
+    return os.path.join(cache_dir, 'onnx', model_name.strip('/').replace('/', '--'))
+
+
+def compare_embeddings(reference, candidate):
+    '''
+    比較兩組 embeddings (各自正規化後)，回傳 (最低 cosine similarity, 平均 cosine similarity, 最大絕對誤差)
+    [reference]: shape:(#sentence, #embedding dim)
+    [candidate]: shape:(#sentence, #embedding dim)
+    '''
+    import numpy as np
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosine = (reference * candidate).sum(axis=1)
+    return float(cosine.min()), float(cosine.mean()), float(np.abs(reference - candidate).max())
+
+
+def export_onnx(model_name, cache_dir, onnx_dir=None, min_cosine=ONNX_MIN_COSINE):
+    '''
+    從 cache_dir 讀取 SentenceTransformer (不連網)，將 transformer 輸出 token embeddings 的部分 export 為 ONNX (model.onnx)，
+    再以 dynamic int8 量化 MatMul 的權重 (model_int8.onnx)；tokenizer 與 pooling 設定一併存入 onnx_dir
+    兩個模型的 embedding 與 SentenceTransformer 比較，低於 min_cosine 則 raise RuntimeError
+
+    [model_name]: HuggingFace 模型名稱 (需已下載至 cache_dir)
+    [cache_dir]: 模型的快取資料夾
+    [onnx_dir]: 輸出資料夾，None 則為 onnx_model_dir(model_name, cache_dir)
+    [min_cosine]: {backend: 最低 cosine similarity}
+    '''
+    import json
+    import inspect
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    onnx_dir = onnx_dir or onnx_model_dir(model_name, cache_dir)
+    os.makedirs(onnx_dir, exist_ok=True)
+    print(f'Exporting {model_name} to ONNX: {onnx_dir}')
+    model = SentenceTransformer(model_name, cache_folder=cache_dir, device='cpu', local_files_only=True)
+    transformer, pooling = model[0], model[1]
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    features = transformer.tokenize(VERIFY_SENTENCES)
+    # 新版 torch 預設使用需要 onnxscript 的 dynamo exporter
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer.auto_model).eval(),
+            (features['input_ids'], features['attention_mask']),
+            os.path.join(onnx_dir, 'model.onnx'),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['token_embeddings'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                          'attention_mask': {0: 'batch', 1: 'sequence'},
+                          'token_embeddings': {0: 'batch', 1: 'sequence'}},
+            opset_version=14,
+            **kwargs,
+        )
+    # 只量化 MatMul (embedding lookup 保持 float32，誤差較小)
+    quantize_dynamic(os.path.join(onnx_dir, 'model.onnx'), os.path.join(onnx_dir, 'model_int8.onnx'),
+                     op_types_to_quantize=['MatMul'], weight_type=QuantType.QInt8)
+    transformer.tokenizer.save_pretrained(onnx_dir)
+
+    config = {
+        'model_name': model_name,
+        'max_seq_length': model.max_seq_length,
+        'pooling': pooling.get_pooling_mode_str(),
+        'normalize': any(type(module).__name__ == 'Normalize' for module in model),
+        'min_cosine': {},
+    }
+    reference = model.encode(VERIFY_SENTENCES, convert_to_numpy=True)
+    for backend in ('onnx', 'onnx-int8'):
+        encoder = OnnxEncoder(model_name, cache_dir, quantize=backend == 'onnx-int8', onnx_dir=onnx_dir, config=config)
+        worst, mean, max_diff = compare_embeddings(reference, encoder.encode(VERIFY_SENTENCES))
+        print(f'{backend}: min cosine {worst:.6f}, mean cosine {mean:.6f}, max abs diff {max_diff:.6f}')
+        if worst < min_cosine[backend]:
+            raise RuntimeError(f'{backend} embeddings differ from SentenceTransformer: min cosine {worst:.6f} < {min_cosine[backend]}')
+        config['min_cosine'][backend] = worst
+    # config 最後寫入，檢查失敗時下次會重新 export
+    with open(os.path.join(onnx_dir, 'encoder_config.json'), 'w', encoding='utf8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+    return onnx_dir
+
+
+class OnnxEncoder:
+    '''
+    以 onnxruntime 在 CPU 上執行的 encoder，encode 的介面與輸出與 SentenceTransformer 相同 (同樣的 pooling / normalize)
+    onnx_dir 中沒有 export 過的模型時，第一次載入會從 cache_dir 讀取 SentenceTransformer 並 export (不連網)
+    同一個 batch 內 pad 到最長的句子，encode 前先依 token 長度排序，讓長度相近的句子在同一個 batch
+    '''
+
+    def __init__(self, model_name, cache_dir, quantize=True, num_threads=None, onnx_dir=None, config=None):
+        '''
+        [model_name]: HuggingFace 模型名稱
+        [cache_dir]: 模型的快取資料夾
+        [quantize]: True: 使用 dynamic int8 量化的模型 (model_int8.onnx)；False: float32 (model.onnx)
+        [num_threads]: onnxruntime intra-op thread 數量，None 則使用 onnxruntime 預設值 (所有實體核心)
+        [onnx_dir]: ONNX 模型資料夾，None 則為 onnx_model_dir(model_name, cache_dir)
+        [config]: export 時的設定 (pooling 等)，None 則讀取 onnx_dir 中的 encoder_config.json
+        '''
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.quantize = quantize
+        self.backend = 'onnx-int8' if quantize else 'onnx'
+        self.num_threads = num_threads
+        self.onnx_dir = onnx_dir or onnx_model_dir(model_name, cache_dir)
+        self.config = config
+        self._session = None
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._session is not None
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import json
+                    import onnxruntime as ort
+                    from transformers import AutoTokenizer
+                    if self.config is None:
+                        config_path = os.path.join(self.onnx_dir, 'encoder_config.json')
+                        if not os.path.exists(config_path):
+                            export_onnx(self.model_name, self.cache_dir, self.onnx_dir)
+                        with open(config_path, 'rb') as f:
+                            self.config = json.load(f)
+                    if self.config['pooling'] not in ('mean', 'cls', 'max'):
+                        raise ValueError(f'Unsupported pooling mode {self.config["pooling"]!r}')
+                    path = os.path.join(self.onnx_dir, 'model_int8.onnx' if self.quantize else 'model.onnx')
+                    print(f'Loading {path} (onnxruntime, {self.num_threads or "default"} threads)')
+                    options = ort.SessionOptions()
+                    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+                    options.intra_op_num_threads = self.num_threads or 0
+                    options.inter_op_num_threads = 1
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.onnx_dir, local_files_only=True)
+                    self._session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        return self._session
+
+    def load(self):
+        '''
+        立即載入模型 (常駐服務啟動時預熱，避免第一個 request 等待)
+        '''
+        return self.session
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        '''
+        回傳 numpy embeddings，sentences 為字串時回傳 shape:(#embedding dim,)，否則為 shape:(#sentence, #embedding dim)
+        [sentences]: 字串或字串列表
+        [batch_size]: 每次送入模型的句子數量
+        [normalize_embeddings]: 是否正規化 (模型本身含 Normalize 時一律正規化)
+        '''
+        import numpy as np
+        session = self.session
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        # 與 SentenceTransformer 相同: 去除前後空白後截斷至 max_seq_length
+        input_ids = self._tokenizer([str(s).strip() for s in sentences], truncation=True,
+                                    max_length=self.config['max_seq_length'])['input_ids']
+        order = sorted(range(len(input_ids)), key=lambda i: -len(input_ids[i]))
+        embeddings = [None] * len(input_ids)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            length = len(input_ids[batch[0]])
+            ids = np.full((len(batch), length), self._tokenizer.pad_token_id, dtype=np.int64)
+            mask = np.zeros((len(batch), length), dtype=np.int64)
+            for row, i in enumerate(batch):
+                ids[row, :len(input_ids[i])] = input_ids[i]
+                mask[row, :len(input_ids[i])] = 1
+            token_embeddings = session.run(None, {'input_ids': ids, 'attention_mask': mask})[0]
+            if self.config['pooling'] == 'cls':
+                pooled = token_embeddings[:, 0]
+            elif self.config['pooling'] == 'max':
+                pooled = np.where(mask[:, :, None] > 0, token_embeddings, -1e9).max(axis=1)
+            else:
+                pooled = (token_embeddings * mask[:, :, None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1e-9)
+            for row, i in enumerate(batch):
+                embeddings[i] = pooled[row]
+        embeddings = np.stack(embeddings).astype(np.float32) if embeddings else np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings or self.config['normalize']:
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+def get_encoder(model_name=DEFAULT_MODEL_NAME, device=None, cache_dir=DEFAULT_CACHE_DIR, backend=None, num_threads=None):
+    '''
+    回傳 process 內共用的 encoder，相同 (model_name, device, cache_dir, backend, num_threads) 只會建立 (載入) 一次
+
+    [model_name]: HuggingFace 模型名稱
+    [device]: 例如 'cpu'、'cuda:1'，None 則使用環境變數 EMBEDDING_DEVICE (預設 cpu)
+    [cache_dir]: 模型的下載/快取資料夾
+    [backend]: 'torch': SentenceTransformer；'onnx' / 'onnx-int8': onnxruntime (只支援 CPU，從 cache_dir 讀取模型，不連網)
+               None 則使用環境變數 EMBEDDING_BACKEND (預設 torch)
+    [num_threads]: CPU thread 數量，None 則使用環境變數 EMBEDDING_THREADS (未設定則為各 backend 的預設值)
+    '''
+    device = device or os.environ.get('EMBEDDING_DEVICE', 'cpu')
+    backend = backend or os.environ.get('EMBEDDING_BACKEND', 'torch')
+    num_threads = num_threads or int(os.environ.get('EMBEDDING_THREADS', 0)) or None
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f'Unsupported encoder backend {backend!r}, expected one of {ENCODER_BACKENDS}')
+    if backend != 'torch' and device != 'cpu':
+        raise ValueError(f'The {backend} backend only runs on cpu, got device {device!r}')
+    key = (model_name, device, cache_dir, backend, num_threads)
+    with _encoders_lock:
+        if key not in _encoders:
+            if backend == 'torch':
+                _encoders[key] = LazyEncoder(model_name, device, cache_dir, num_threads)
+            else:
+                _encoders[key] = OnnxEncoder(model_name, cache_dir, backend == 'onnx-int8', num_threads)
+        return _encoders[key]
@@ -1,20 +1,20 @@
+import os
 import json
-from sentence_transformers import SentenceTransformer
-from Model.util import get_top_k_indices
+import time
+from Model.util import get_top_k_indices, get_top_k_indices_batch, l2_normalize
+from Model.encoder import get_encoder
+from Model.embedding_store import EmbeddingStore
+from Model.ann_index import IVFIndex
+from Model.quantization import QuantizedEmbeddings
 
-cache_dir= './Model/cache' # repo for storing HuggingFace Model
 
-'''Load the embedding model'''
-model_name = 'intfloat/multilingual-e5-large'
-print(model_name)
-model = SentenceTransformer(model_name, trust_remote_code=True, cache_folder=cache_dir, device='cuda:1')
-
-
-'''Preprocess FAQ data'''
-faq_path = '../reference/faq/pid_map_content.json'
-print('Loading FAQ json')
-with open(faq_path, 'rb') as f_s:
-    key_to_source_dict = json.load(f_s)
+def load_faq(faq_path):
+    '''
+    讀取 FAQ json，回傳 {faq_id: 合併後的問答文字}
+    [faq_path]: pid_map_content.json 路徑
+    '''
+    with open(faq_path, 'rb') as f_s:
+        key_to_source_dict = json.load(f_s)
     faq_dict = {}
     for key, qas in key_to_source_dict.items():
         faq_key = int(key)
@@ -24,37 +24,121 @@ with open(faq_path, 'rb') as f_s:
             answer_text = ' '.join(qa['answers'])
             content_parts.append(f"question: {qa['question']} answer: {answer_text}")
         faq_dict[faq_key] = ' '.join(content_parts)
+    return faq_dict
+
+def load_faq_store(model, model_name, faq_path, store_dir):
+    '''
+    讀取/更新 FAQ embeddings (已正規化) 的 store，只有 pid_map_content.json 或 encoder backend 改變時才重新encode
+    回傳 (store, faq_ids)，faq_ids[i] 為 store 中第 i 個 row 的 FAQ 編號
+
+    [model]: encoder (Model.encoder.get_encoder 或 SentenceTransformer)
+    [model_name]: embedding 模型名稱
+    [faq_path]: pid_map_content.json 路徑
+    [store_dir]: store 資料夾
+    '''
+    faq_dict = load_faq(faq_path)
+    faq_store = EmbeddingStore.update(
+        store_dir,
+        {0: faq_path},
+        lambda path: list(faq_dict.values()),
+        lambda texts: model.encode(["passage:" + text for text in texts]),
+        model_name,
+        encoder_backend=getattr(model, 'backend', 'torch'),
+    )
+    return faq_store, list(faq_dict.keys())
+
+def retrieve_faq(model, faq_store, faq_ids, questions, retrieval_mode='candidates', batch_mode=True, encode_batch_size=32, ivf_index=None,
+                 quantized=None, rescore_k=None):
+    '''
+    對每個 FAQ 問題檢索最相關的 FAQ，回傳每題的 FAQ 編號列表 (top 1)
+
+    [model]: encoder (Model.encoder.get_encoder 或 SentenceTransformer)
+    [faq_store]: FAQ 的 EmbeddingStore
+    [faq_ids]: store row --> FAQ 編號
+    [questions]: 題目 dict 列表 (需有 query，candidates 模式需有 source)
+    [retrieval_mode]: 'candidates' / 'exact' / 'ann' (需提供 ivf_index，只適用於 batch_mode)
+    [batch_mode]: True: 一次encode所有query並批次檢索；False: 逐題encode與檢索
+    [encode_batch_size]: query encode 時的 batch size
+    [ivf_index]: IVFIndex
+    [quantized]: QuantizedEmbeddings，提供時 (candidates / exact 模式) 以量化後的 embeddings 計分
+    [rescore_k]: 量化計分後，以 store 中 float32 的 embeddings 重新計分的 candidate 數量，None 或 0 則不重新計分
+    '''
+    faq_embeddings = faq_store.embeddings
+    # FAQ 編號 --> store 中的 row (編號不一定是從 0 開始的連續整數)
+    faq_positions = {faq_id: i for i, faq_id in enumerate(faq_ids)}
+    if not batch_mode:
+        retrieved = []
+        for q_dict in questions:
+            # Embed the query
+            query_embedding = model.encode('query: ' + q_dict['query'])
+            candidate_faq_embeddings = faq_embeddings[[faq_positions[faq_id] for faq_id in q_dict['source']]]
+            retrieved_indexes = get_top_k_indices(candidate_faq_embeddings, query_embedding, 1)
+            retrieved.append([q_dict['source'][i] for i in retrieved_indexes])
+        return retrieved
+
+    # Embed all queries at once
+    query_embeddings = model.encode(['query: ' + q_dict['query'] for q_dict in questions], batch_size=encode_batch_size)
+    if retrieval_mode == 'ann':
+        top_k_indices, _ = ivf_index.search(l2_normalize(query_embeddings), 1)
+        retrieved = [[int(i) for i in row if i >= 0] for row in top_k_indices]
+    else:
+        candidate_lists = [[faq_positions[faq_id] for faq_id in q_dict['source']] for q_dict in questions] if retrieval_mode == 'candidates' else None
+        if quantized is not None:
+            top_k_indices, _ = quantized.search(l2_normalize(query_embeddings), 1, candidate_lists, faq_embeddings, rescore_k)
+            retrieved = [[int(i) for i in row if i >= 0] for row in top_k_indices]
+        else:
+            retrieved = get_top_k_indices_batch(faq_embeddings, query_embeddings, candidate_lists, 1)
+    return [[faq_ids[i] for i in retrieved_indexes] for retrieved_indexes in retrieved]
+
+
+if __name__ == "__main__":
+    cache_dir= './Model/cache' # repo for storing HuggingFace Model
+    device = os.environ.get('EMBEDDING_DEVICE', 'cpu') # 例如 'cuda:1'
+    encoder_backend = os.environ.get('EMBEDDING_BACKEND', 'torch') # 'torch': SentenceTransformer；'onnx' / 'onnx-int8': onnxruntime (只支援 CPU)
+
+    '''Load the embedding model'''
+    # 第一次 encode 時才載入模型
+    model_name = 'intfloat/multilingual-e5-large'
+    print(model_name)
+    model = get_encoder(model_name, device, cache_dir, encoder_backend)
+
+    '''Embed FAQ data'''
+    # embeddings (已正規化) 儲存於store中，只有 pid_map_content.json 改變時才重新encode
+    faq_path = '../reference/faq/pid_map_content.json'
+    store_dir_faq = './reference/processed_faq/embedding_store'
+    print('Loading FAQ json')
+    faq_store, faq_ids = load_faq_store(model, model_name, faq_path, store_dir_faq)
+
+    '''Load user QUERY'''
+    query_path = '.preliminary_test/questions_preliminary.json'
+    ## Load question json to dict
+    print('Loading QUERY')
+    with open(query_path, 'rb') as f:
+        query_ref = json.load(f)
+
+    '''For all query, get most relavant FAQ in embedding space'''
+    batch_mode = True # True: 一次encode所有query並批次檢索；False: 逐題encode與檢索
+    encode_batch_size = 32 # query encode 時的 batch size
+    retrieval_mode = 'candidates' # 'candidates': 只在題目提供的source中檢索；'exact': 搜尋全部FAQ；'ann': 以IVF index近似搜尋全部FAQ (只適用於 batch_mode)
+    ann_nlist = None # IVF cluster 數量，None 則使用 4 * sqrt(#faq)
+    ann_nprobe = 8 # 查詢時搜尋的 cluster 數量，越大 recall 越高、速度越慢
+    quantization = None # None: 以 float32 計分；'float16' / 'int8': 以量化後常駐記憶體的 embeddings 計分 (只適用於 batch_mode)
+    rescore_k = 10 # 量化計分後，以 float32 重新計分的 candidate 數量 (0 則不重新計分)
 
-'''Embed FAQ data'''
-faq_texts = ["passage:" + text for text in faq_dict.values()]
-faq_embeddings = model.encode(faq_texts)
-
-
-'''Load user QUERY'''
-query_path = '.preliminary_test/questions_preliminary.json'
-## Load question json to dict
-print('Loading QUERY')
-with open(query_path, 'rb') as f:
-    query_ref = json.load(f)
-
-'''For all query, get most relavant FAQ in embedding space'''
-answer_dict = {"answers": []}
-for q_dict in query_ref['questions']:
-    if q_dict['category'] == 'finance':
-        continue
-    elif q_dict['category'] == 'insurance':
-        continue
-    elif q_dict['category'] == 'faq':
-        # Embed the query 
-        query_embedding = model.encode('query: ' + q_dict['query'])
-        candidate_faq_embeddings = faq_embeddings[q_dict['source']]
-        retrieved_indexes = get_top_k_indices(candidate_faq_embeddings, query_embedding, 1)
-        real_retrieved_indexes = [q_dict['source'][i] for i in retrieved_indexes]
+    faq_questions = [q_dict for q_dict in query_ref['questions'] if q_dict['category'] == 'faq']
+    ivf_index = IVFIndex.load_or_build(faq_store, ann_nlist, ann_nprobe) if retrieval_mode == 'ann' else None
+    quantized = QuantizedEmbeddings.load_or_build(faq_store, quantization) if quantization else None
+    answer_dict = {"answers": []}
+    start_time = time.perf_counter()
+    retrieved = retrieve_faq(model, faq_store, faq_ids, faq_questions, retrieval_mode, batch_mode, encode_batch_size, ivf_index,
+                             quantized, rescore_k)
+    for q_dict, real_retrieved_indexes in zip(faq_questions, retrieved):
         answer_dict['answers'].append({"qid": q_dict['qid'], "retrieve": real_retrieved_indexes})
         print(f'qid : {q_dict["qid"]}, retrieved index : {real_retrieved_indexes}')
+    print(f'Retrieval wall-clock ({"batched" if batch_mode else "per-question"}): {time.perf_counter() - start_time:.2f}s for {len(faq_questions)} queries')
 
 
-'''Store the answer to json file'''
-output_path = './preliminary_test/pred/faq.json'
-with open(output_path, 'w', encoding='utf8') as f:
-    json.dump(answer_dict, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+    '''Store the answer to json file'''
+    output_path = './preliminary_test/pred/faq.json'
+    with open(output_path, 'w', encoding='utf8') as f:
+        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
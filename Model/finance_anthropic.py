@@ -1,69 +1,90 @@
-import anthropic
+import os
 import re
 import json
-from util import load_docs
+import time
+import asyncio
+import argparse
+import anthropic
+from collections import Counter
+from util import load_docs, get_image_payload_cache, build_image_payload_store
 from prompt_template import system_prompt
+from rerank_client import AsyncRerankClient, estimate_input_tokens
+from response_cache import ResponseCache, hash_image, request_key
+from result_journal import ResultJournal, load_journal, compact_journal
 
 
-# Use Anthropic API to get the prediction results
-def extract_output_format_regex(text):
-    pattern = r'<output_format>(.*?)</output_format>'
-    match = re.search(pattern, text, re.DOTALL)  
-    if match:
-        return match.group(1).strip()
-    else:
-        return text
-
 image_folder = './reference/processed_finance/processed_finance_image_resize'
 use_first_stage = True
 bm25_threshold = 0.30
+truncate_num = 12 # 最多只給模型top-12影像，避免過多資訊
+image_token_budget = 19200 # 每個 request 影像 tokens 的上限 (每張約 (width * height) / 750，12 張 1.15MP 影像約 19200)，依BM25分數優先選取；None 則只依 truncate_num 截斷
+image_cache_max_bytes = 512 * 1024 * 1024 # 已編碼影像的記憶體 LRU 上限 (同一頁面常出現在多題中)
+use_image_store = False # True 則預先將所有影像編碼成 base64 存於 image_store_dir (只處理新增或改變的影像)
+image_store_dir = './reference/processed_finance/image_payload_store'
 first_stage_path = './preliminary_test/bm25_rewrite.json'
+question_path = './preliminary_test/questions_preliminary.json'
+output_path = './preliminary_test/pred/finance.json'
+journal_path = './preliminary_test/pred/finance.journal.jsonl' # 每完成一題即 append，可用 --resume 續跑
 
+# Anthropic API
+api_key = os.environ.get('ANTHROPIC_API_KEY', "put your Anthropic API key here")
+base_url = os.environ.get('ANTHROPIC_BASE_URL') # 可指向本地 mock server (python3 Model/mock_messages_api.py)
+model_name = "claude-3-5-sonnet-20241022"
+max_tokens = 2046
+temperature = 0
 
-# Load input questions
-print('Loading QUERY')
-question_path = './preliminary_test/questions_preliminary.json'
-with open(question_path, 'rb') as f:
-    qs_ref = json.load(f) 
+# Prompt caching: system prompt 與在多題中重複出現的候選影像組合標記為可快取的 prefix
+prompt_caching = True
+usage_log_path = './preliminary_test/pred/finance_usage.json' # 每個 request 的 usage (含 cache 讀寫 tokens) 與 latency
 
-# Answer dict for storing answer
-answer_dict = {"answers": []}
-output_path = './preliminary_test/pred/finance.json'
+# 併發與 rate limit 設定
+max_concurrency = 8 # 同時進行的 request 數量
+requests_per_minute = 50
+input_tokens_per_minute = 40000
+max_retries = 5
 
-client = anthropic.Anthropic(
-    api_key= "put your Anthropic API key here"
-    )
+# 回應 cache: 調整 bm25_threshold / truncate_num 後重跑時，影像與查詢相同的題目不再重送
+cache_mode = 'missing' # 'missing': 只送出 cache 未命中的 request；'refresh': 全部重送並更新 cache；'off': 不使用 cache
+response_cache_path = './preliminary_test/finance_response_cache.sqlite'
+response_cache_max_bytes = 64 * 1024 * 1024
 
-print('Loading first stage results')
-with open(first_stage_path, 'rb') as f:
-    first_stage_retrieved = json.load(f)
 
+# Use Anthropic API to get the prediction results
+def extract_output_format_regex(text):
+    pattern = r'<output_format>(.*?)</output_format>'
+    match = re.search(pattern, text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    else:
+        return text
 
-for q_dict in qs_ref['questions']:
-    if q_dict['category'] != 'finance':
-        continue
-    print(f'============回答第{q_dict['qid']}題============')
-    user_query = q_dict['query']
+def select_candidates(answer):
+    '''
+    Thresholding: 使用BM25之分數，只保留分數大於 "排名第二影像之BM25分數* bm25_threshold"
+    [answer]: 第一階段 (BM25) 某一題的結果
+    '''
+    threshold = bm25_threshold * answer["scores"][1]
+    top_count = sum(score > threshold for score in answer["scores"])
+    top_count = min(top_count, len(answer["retrieve"]))
+
+    c_ids = answer["retrieve"][:top_count]
+    return [str(c_id) for c_id in c_ids]
+
+def build_system():
+    '''
+    生成 system prompt，prompt_caching 時標記為可快取的 prefix (所有 request 共用)
+    '''
+    if not prompt_caching:
+        return system_prompt
+    return [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
 
-    c_ids = None
-    for answer in first_stage_retrieved["answers"]:
-        if answer["qid"] == q_dict['qid']:
-            '''
-            Thresholding: 使用BM25之分數，只保留分數大於 "排名第二影像之BM25分數* bm25_threshold"
-            ''' 
-            threshold = bm25_threshold * answer["scores"][1]
-            top_count = sum(score > threshold for score in answer["scores"])
-            top_count = min(top_count, len(answer["retrieve"]))
-
-            c_ids = answer["retrieve"][:top_count]
-            str_c_ids = [str(c_id) for c_id in c_ids]
-            print("選取的 c_ids:", str_c_ids)
-            break
-    
-    base64_images, filenames = load_docs(image_folder, str_c_ids, use_first_stage, truncate_num=12) # 最多只給模型top-12影像，避免過多資訊
-    print(f"sorted filenams: {filenames}")
-
-    '''生成user prompt'''
+def build_user_content(base64_images, filenames, user_query, cache_images=False):
+    '''
+    生成user prompt: 依序放入編號過的影像，最後放入使用者查詢
+
+    [cache_images]: 是否將影像部分 (system prompt + 所有影像) 標記為可快取的 prefix，
+                    影像依 (c_id, 頁碼) 排序，相同的候選影像組合會產生相同的 prefix
+    '''
     user_content = []
     for idx, (base64_img, filename) in enumerate(zip(base64_images, filenames), 1):
         # 影像編號
@@ -81,30 +102,20 @@ for q_dict in qs_ref['questions']:
             }
         })
 
+    if cache_images and base64_images:
+        user_content[-1]["cache_control"] = {"type": "ephemeral"}
+
     # 使用者查詢(query)
     user_content.append({
         "type": "text",
         "text": f"query: {user_query}"
     })
+    return user_content
 
-    '''Call API'''
-    message = client.messages.create(
-        model="claude-3-5-sonnet-20241022",
-        max_tokens=2046,
-        temperature=0,
-        system=system_prompt, # 放入定義好的 system prompt
-        messages=[
-            {
-                "role": "user",
-                "content": user_content
-            }
-        ]
-    )
-
-    text_content = message.content[0].text
-    print(text_content)
-
-    '''後處理模型輸出'''
+def map_top_1(text_content, filenames):
+    '''
+    後處理模型輸出，將模型回答的影像編號 map 回原本的影像檔名
+    '''
     output_format = extract_output_format_regex(text_content)
     try:
         output_dict = json.loads(output_format)
@@ -123,13 +134,143 @@ for q_dict in qs_ref['questions']:
     except (ValueError, IndexError):
         print(f"無法找到對應的檔案名稱，模型返回值：{top_1_value}")
         top_1_value_map = top_1_value
+    return top_1_value_map
 
-    '''將答案將入answer_dict，並儲存成json檔案'''
-    answer_dict['answers'].append({
-        "qid": q_dict['qid'], 
-        "retrieve": top_1_value_map
-    })
-    # 立即更新 JSON 文件
-    with open(output_path, 'w', encoding='utf8') as f:
-                    json.dump(answer_dict, f, ensure_ascii=False, indent=4) 
+async def answer_question(rerank_client, q_dict, first_stage_answer, response_cache=None, payload_cache=None, cache_images=False):
+    '''
+    對一題finance問題進行 reranking，回傳 {"qid", "retrieve"}
+
+    [rerank_client]: AsyncRerankClient
+    [q_dict]: 問題
+    [first_stage_answer]: 第一階段 (BM25) 該題的結果
+    [response_cache]: ResponseCache，None 則每題都呼叫 API
+    [payload_cache]: ImagePayloadCache，None 則使用 image_folder 對應的共用 cache
+    [cache_images]: 是否將影像部分標記為可快取的 prefix (候選影像組合在其他題目中也會出現時)
+    '''
+    user_query = q_dict['query']
+    str_c_ids = select_candidates(first_stage_answer)
+    print(f"qid {q_dict['qid']} 選取的 c_ids: {str_c_ids}")
+    if payload_cache is None:
+        payload_cache = get_image_payload_cache(image_folder, image_cache_max_bytes, image_store_dir if use_image_store else None)
+
+    # 讀取影像 (disk I/O 放到 thread 中，不阻塞其他 request)
+    base64_images, filenames = await asyncio.to_thread(load_docs, image_folder, str_c_ids, use_first_stage, truncate_num,
+                                                     payload_cache, image_token_budget)
+    image_tokens = await asyncio.to_thread(lambda: [payload_cache.image_tokens(filename) for filename in filenames])
+    print(f"qid {q_dict['qid']} sorted filenams: {filenames}")
+    user_content = build_user_content(base64_images, filenames, user_query, prompt_caching and cache_images)
+    estimated_tokens = estimate_input_tokens(system_prompt, user_content, image_tokens)
+    print(f"qid {q_dict['qid']} 估計 input tokens: {estimated_tokens} (影像 {len(filenames)} 張，{sum(image_tokens)} tokens)")
+
+    key = request_key(model_name, system_prompt, [hash_image(img) for img in base64_images], user_query, temperature, max_tokens)
+    text_content = response_cache.get(key) if response_cache is not None and cache_mode == 'missing' else None
+
+    if text_content is None:
+        '''Call API'''
+        message = await rerank_client.create(
+            estimated_tokens,
+            tag=q_dict['qid'],
+            model=model_name,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=build_system(), # 放入定義好的 system prompt
+            messages=[
+                {
+                    "role": "user",
+                    "content": user_content
+                }
+            ]
+        )
+        text_content = message.content[0].text
+        if response_cache is not None:
+            response_cache.put(key, text_content)
+
+    print(f'============第{q_dict["qid"]}題============')
+    print(text_content)
+
+    return {"qid": q_dict['qid'], "retrieve": map_top_1(text_content, filenames)}
+
+async def rerank_all(questions, first_stage_retrieved, journal=None):
+    '''
+    併發處理所有finance問題，回傳結果的順序與 questions 相同
+
+    [questions]: finance 問題列表
+    [first_stage_retrieved]: 第一階段 (BM25) 的結果
+    [journal]: ResultJournal，每題完成時立即寫入
+    '''
+    first_stage_answers = {answer["qid"]: answer for answer in first_stage_retrieved["answers"]}
+    client = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0)
+    rerank_client = AsyncRerankClient(client, max_concurrency, requests_per_minute, input_tokens_per_minute, max_retries)
+    response_cache = ResponseCache(response_cache_path, response_cache_max_bytes) if cache_mode != 'off' else None
+    if use_image_store:
+        build_image_payload_store(image_folder, image_store_dir)
+    payload_cache = get_image_payload_cache(image_folder, image_cache_max_bytes, image_store_dir if use_image_store else None)
+    # 只有在多題中重複出現的候選組合才值得寫入 prompt cache (寫入的 tokens 單價較高)
+    # 第一階段結果有問題的題目 (沒有結果、只有一個候選) 在這裡先略過，於 handle 中單獨失敗，不影響其他題目
+    def candidates_of(q_dict):
+        try:
+            return tuple(select_candidates(first_stage_answers[q_dict['qid']]))
+        except (KeyError, IndexError):
+            return None
+    candidate_counts = Counter(candidates for candidates in map(candidates_of, questions) if candidates is not None)
+
+    async def handle(q_dict):
+        first_stage_answer = first_stage_answers[q_dict['qid']]
+        cache_images = candidate_counts[tuple(select_candidates(first_stage_answer))] > 1
+        result = await answer_question(rerank_client, q_dict, first_stage_answer, response_cache, payload_cache, cache_images)
+        if journal is not None:
+            journal.append(result)
+        return result
+
+    try:
+        results = await rerank_client.run_all(questions, handle)
+    finally:
+        payload_cache.report()
+        if response_cache is not None:
+            response_cache.report()
+            response_cache.close()
+    print(f'API retries: {rerank_client.retries}')
+    print(f'API usage: {rerank_client.usage_summary()}')
+    if usage_log_path:
+        with open(usage_log_path, 'w', encoding='utf8') as f:
+            json.dump({'summary': rerank_client.usage_summary(), 'requests': rerank_client.usage_log}, f, indent=4)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='跳過 journal 中已完成的題目，只處理剩下的題目')
+    args = parser.parse_args()
+
+    # Load input questions
+    print('Loading QUERY')
+    with open(question_path, 'rb') as f:
+        qs_ref = json.load(f)
+
+    print('Loading first stage results')
+    with open(first_stage_path, 'rb') as f:
+        first_stage_retrieved = json.load(f)
+
+    finance_questions = sorted((q_dict for q_dict in qs_ref['questions'] if q_dict['category'] == 'finance'),
+                               key=lambda q_dict: q_dict['qid'])
+
+    if args.resume:
+        done_qids = set(load_journal(journal_path))
+        finance_questions = [q_dict for q_dict in finance_questions if q_dict['qid'] not in done_qids]
+        print(f'Resume: {len(done_qids)} questions already in journal, {len(finance_questions)} remaining')
+
+    journal = ResultJournal(journal_path, resume=args.resume)
+    start_time = time.perf_counter()
+    try:
+        results = asyncio.run(rerank_all(finance_questions, first_stage_retrieved, journal))
+    finally:
+        journal.close()
+    print(f'Reranking wall-clock: {time.perf_counter() - start_time:.2f}s for {len(finance_questions)} queries')
+
+    for q_dict, result in zip(finance_questions, results):
+        if isinstance(result, Exception):
+            print(f"第{q_dict['qid']}題失敗：{type(result).__name__}: {result}")
 
+    '''將 journal 依 qid 順序整理成answer_dict，並儲存成json檔案'''
+    answer_dict = compact_journal(journal_path, output_path)
+    print(f'{len(answer_dict["answers"])} answers written to {output_path}')
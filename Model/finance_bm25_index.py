@@ -0,0 +1,373 @@
+import os
+import numpy as np
+from scipy.sparse import csr_matrix
+from tqdm import tqdm
+from token_cache import TokenCache
+
+
+def parse_page_name(name):
+    '''
+    從 one-page PDF 檔名中提取 c_id 和頁碼
+    ex: 123_p4 --> (123, 4)
+
+    [name]: 不含副檔名的檔名
+    '''
+    parts = name.split('_p')
+    if len(parts) == 2:
+        return (int(parts[0]), int(parts[1]))
+    else:
+        raise ValueError('Do not contain _pxx')
+
+def page_signature(path):
+    '''
+    one-page PDF 的 fingerprint (檔案大小與修改時間)，前處理新增/改變頁面後與索引中記錄的不同
+    [path]: pdf檔案路徑
+    '''
+    stat = os.stat(path)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+def source_signatures(source_path):
+    '''
+    回傳資料夾中所有 one-page PDF 的 {檔名 (不含副檔名): page_signature}
+    [source_path]: 儲存所有 one-page PDF 的資料夾
+    '''
+    return {os.path.splitext(file)[0]: page_signature(os.path.join(source_path, file))
+            for file in os.listdir(source_path) if file.endswith('.pdf')}
+
+def extract_text(pdf_loc):
+    '''
+    讀取PDF中所有頁面的文字 (與 finance_bm25_rank.read_pdf 相同的抽取方式)
+    [pdf_loc]: pdf檔案路徑
+    '''
+    import pdfplumber
+    pdf_text = ''
+    with pdfplumber.open(pdf_loc) as pdf:
+        for page in pdf.pages:
+            text = page.extract_text()
+            if text:
+                pdf_text += text
+    return pdf_text
+
+
+class FinanceBM25Index:
+    '''
+    Finance one-page PDF 的離線 BM25 索引
+
+    每一頁只需抽取文字、分詞一次，所有 token 以 vocab id 的形式存成一個扁平陣列 (tokens)，
+    並以 token_offsets 標記每一頁的起訖位置。頁面依 (c_id, 頁碼) 排序，
+    同一個 c_id 的頁面是連續的，查詢時只需取出 candidate 的頁面進行計分。
+    '''
+
+    def __init__(self, names, vocab, tokens, token_offsets, signatures=None):
+        '''
+        [names]: 每一頁的檔名 (不含副檔名)，ex: 123_p4
+        [vocab]: 所有出現過的 token
+        [tokens]: 所有頁面 token 的 vocab id，依頁面順序串接，shape:(#tokens,)
+        [token_offsets]: 每一頁在 tokens 中的起訖位置，shape:(#pages + 1,)
+        [signatures]: 建立索引時每一頁的 page_signature，None 則視為與目前的 PDF 不一致
+        '''
+        self.names = list(names)
+        self.signatures = list(signatures) if signatures is not None else None
+        self.vocab = list(vocab)
+        self.tokens = np.asarray(tokens, dtype=np.int32)
+        self.token_offsets = np.asarray(token_offsets, dtype=np.int64)
+
+        # 詞頻統計: 每頁長度、每個 token 出現在多少頁 (document frequency)
+        self.doc_len = np.diff(self.token_offsets)
+        self.df = self._document_frequency()
+
+        # c_id --> 該 c_id 所有頁面的 row 範圍 [start, end)
+        self.c_ids = np.array([parse_page_name(name)[0] for name in self.names], dtype=np.int64)
+        self.id_ranges = {}
+        for row, c_id in enumerate(self.c_ids.tolist()):
+            start, _ = self.id_ranges.get(c_id, (row, row))
+            self.id_ranges[c_id] = (start, row + 1)
+
+
+    def _document_frequency(self):
+        if not self.vocab:
+            return np.zeros(0, dtype=np.int32)
+        page_of_token = np.repeat(np.arange(len(self.names)), self.doc_len)
+        unique_pairs = np.unique(page_of_token.astype(np.int64) * len(self.vocab) + self.tokens)
+        return np.bincount(unique_pairs % len(self.vocab), minlength=len(self.vocab)).astype(np.int32)
+
+    @classmethod
+    def build(cls, source_path, token_cache=None, workers=1, previous=None):
+        '''
+        抽取並分詞資料夾中所有 one-page PDF，建立索引
+
+        [source_path]: 儲存所有 one-page PDF 的資料夾
+        [token_cache]: TokenCache，內容沒有改變的頁面不需重新分詞
+        [workers]: 大於1時以 process pool 平行分詞 cache 中沒有的頁面
+        [previous]: 舊的索引，signature 沒有改變的頁面直接沿用其 token，不需重新抽取文字
+        '''
+        token_cache = token_cache if token_cache is not None else TokenCache()
+        signatures = source_signatures(source_path)
+        names = sorted(signatures, key=parse_page_name)
+
+        previous_rows = {}
+        if previous is not None and previous.signatures is not None:
+            previous_rows = {name: row for row, (name, signature) in enumerate(zip(previous.names, previous.signatures))
+                             if signatures.get(name) == signature}
+        changed = [name for name in names if name not in previous_rows]
+        texts = [extract_text(os.path.join(source_path, f'{name}.pdf')) for name in tqdm(changed)]
+        changed_tokens = dict(zip(changed, token_cache.tokenize_many(texts, workers)))
+        page_tokens = (changed_tokens[name] if name in changed_tokens else previous.page_tokens(previous_rows[name]) for name in names)
+
+        vocab_ids = {}
+        tokens = []
+        token_offsets = [0]
+        for page in page_tokens:
+            for token in page:
+                tokens.append(vocab_ids.setdefault(token, len(vocab_ids)))
+            token_offsets.append(len(tokens))
+
+        return cls(names, list(vocab_ids), tokens, token_offsets, [signatures[name] for name in names])
+
+    def is_stale(self, source_path):
+        '''
+        索引建立後 source_path 中是否有新增、移除或改變的頁面
+        [source_path]: 儲存所有 one-page PDF 的資料夾
+        '''
+        if self.signatures is None:
+            return True
+        return dict(zip(self.names, self.signatures)) != source_signatures(source_path)
+
+    def save(self, index_path):
+        '''
+        以壓縮的 .npz 格式儲存索引
+        [index_path]: 索引檔案路徑
+        '''
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        np.savez_compressed(
+            index_path,
+            names=np.array(self.names),
+            vocab=np.array(self.vocab),
+            tokens=self.tokens,
+            token_offsets=self.token_offsets,
+            doc_len=self.doc_len,
+            df=self.df,
+            signatures=np.array(self.signatures if self.signatures is not None else []),
+        )
+
+    @classmethod
+    def load(cls, index_path):
+        '''
+        讀取 save() 儲存的索引
+        [index_path]: 索引檔案路徑
+        '''
+        with np.load(index_path) as data:
+            # 舊版索引沒有記錄 signature
+            signatures = data['signatures'].tolist() if 'signatures' in data.files and len(data['signatures']) else None
+            return cls(data['names'].tolist(), data['vocab'].tolist(), data['tokens'], data['token_offsets'], signatures)
+
+    def candidate_rows(self, candidate_ids):
+        '''
+        取得所有 candidate c_id 的頁面 row，依索引順序排列
+
+        [candidate_ids]: 可能與user query相關的所有檔案名稱 (c_id)
+        '''
+        rows = []
+        for c_id in sorted({int(c_id) for c_id in candidate_ids}):
+            if c_id in self.id_ranges:
+                start, end = self.id_ranges[c_id]
+                rows.extend(range(start, end))
+        return rows
+
+    def page_tokens(self, row):
+        '''
+        取得某一頁分詞後的 token
+        [row]: 頁面在索引中的 row
+        '''
+        token_ids = self.tokens[self.token_offsets[row]:self.token_offsets[row + 1]]
+        return [self.vocab[i] for i in token_ids]
+
+    def retrieve(self, qs, candidate_ids, token_cache=None):
+        '''
+        只對 candidate 頁面計算 BM25 分數並排序，回傳格式與 finance_bm25_rank.BM25_retrieve 相同
+
+        [qs]: 使用者query
+        [candidate_ids]: 可能與user query相關的所有檔案名稱 (c_id)
+        [token_cache]: TokenCache，用於 query 分詞
+        '''
+        rows = self.candidate_rows(candidate_ids)
+        if not rows:
+            return [], []
+
+        from rank_bm25 import BM25Okapi
+        token_cache = token_cache if token_cache is not None else TokenCache()
+        bm25 = BM25Okapi([self.page_tokens(row) for row in rows])
+        scores = bm25.get_scores(token_cache.tokenize(qs))
+
+        # 根據得分排序，從高到低
+        sorted_docs = sorted(zip((self.names[row] for row in rows), scores), key=lambda x: x[1], reverse=True)
+        sorted_file_names, sorted_scores = zip(*[(name, round(score, 4)) for name, score in sorted_docs])
+
+        return sorted_file_names, sorted_scores
+
+
+class SparseBM25:
+    '''
+    以 CSR term-document matrix 實作的向量化 BM25，公式與 rank_bm25.BM25Okapi 相同
+
+    scope='candidates': IDF 與平均文件長度只以 candidate 頁面計算，排序結果與對 candidate 建立 BM25Okapi 相同
+    scope='corpus': 使用整個語料預先計算好的 IDF 與長度正規化，計分只需一次 masked 矩陣乘法
+    '''
+
+    def __init__(self, index, k1=1.5, b=0.75, epsilon=0.25, token_cache=None):
+        '''
+        [index]: FinanceBM25Index
+        [k1], [b], [epsilon]: BM25Okapi 參數
+        [token_cache]: TokenCache，用於 query 分詞
+        '''
+        self.index = index
+        self.token_cache = token_cache if token_cache is not None else TokenCache()
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.names = np.array(index.names)
+        self.vocab_ids = {token: i for i, token in enumerate(index.vocab)}
+
+        # term frequency matrix，shape:(#pages, #vocab)
+        n_pages, n_vocab = len(index.names), len(index.vocab)
+        page_of_token = np.repeat(np.arange(n_pages), index.doc_len)
+        self.tf = csr_matrix(
+            (np.ones(len(index.tokens), dtype=np.float64), (page_of_token, index.tokens)),
+            shape=(n_pages, n_vocab),
+        )
+        self.tf.sum_duplicates()
+        self.doc_len = index.doc_len.astype(np.float64)
+
+        # 整個語料的 IDF 與長度正規化後的權重矩陣 (scope='corpus')
+        self.idf = self._idf(index.df, n_pages)
+        self.weights = self._weights(self.tf, self.doc_len)
+
+    def _idf(self, df, n_docs):
+        '''
+        與 BM25Okapi._calc_idf 相同: 未出現的 term 為 0，負的 idf 以 epsilon * average_idf 取代
+        '''
+        idf = np.zeros(len(df), dtype=np.float64)
+        present = df > 0
+        if not present.any():
+            return idf
+        freq = df[present].astype(np.float64)
+        raw_idf = np.log(n_docs - freq + 0.5) - np.log(freq + 0.5)
+        eps = self.epsilon * raw_idf.mean()
+        idf[present] = np.where(raw_idf < 0, eps, raw_idf)
+        return idf
+
+    def _weights(self, tf, doc_len):
+        '''
+        將 tf 矩陣中的每一個值轉換為 BM25 的飽和詞頻 tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+        '''
+        avgdl = doc_len.sum() / len(doc_len)
+        norm = self.k1 * (1 - self.b + self.b * doc_len / avgdl)
+        row_of_entry = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        data = tf.data * (self.k1 + 1) / (tf.data + norm[row_of_entry])
+        return csr_matrix((data, tf.indices, tf.indptr), shape=tf.shape)
+
+    def query_vector(self, query_tokens):
+        '''
+        將分詞後的 query 轉為 (vocab ids, 出現次數)，不在 vocab 中的 token 不影響分數
+        [query_tokens]: 分詞後的 query
+        '''
+        ids = [self.vocab_ids[token] for token in query_tokens if token in self.vocab_ids]
+        if not ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        term_ids, counts = np.unique(np.array(ids, dtype=np.int64), return_counts=True)
+        return term_ids, counts.astype(np.float64)
+
+    def get_scores(self, query_tokens, rows, scope='candidates'):
+        '''
+        以一次 sparse matrix-vector product 計算 candidate 頁面的 BM25 分數
+
+        [query_tokens]: 分詞後的 query
+        [rows]: candidate 頁面在索引中的 row
+        [scope]: 'candidates' 或 'corpus'，IDF 與平均文件長度的計算範圍
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        term_ids, counts = self.query_vector(query_tokens)
+        if len(rows) == 0 or len(term_ids) == 0:
+            return np.zeros(len(rows), dtype=np.float64)
+
+        if scope == 'corpus':
+            return self.weights[rows][:, term_ids] @ (counts * self.idf[term_ids])
+        elif scope == 'candidates':
+            sub_tf = self.tf[rows]
+            df = np.bincount(sub_tf.indices, minlength=sub_tf.shape[1])
+            idf = self._idf(df, len(rows))
+            weights = self._weights(sub_tf[:, term_ids], self.doc_len[rows])
+            return weights @ (counts * idf[term_ids])
+        else:
+            raise ValueError(f'Unknown scope: {scope}')
+
+    def rank(self, scores, rows, top_k=None):
+        '''
+        依分數由高到低排序，同分時依索引順序 (與 sorted(..., reverse=True) 相同)
+        top_k 小於 candidate 數量時先以 partition 找出第 top_k 高的分數，只排序分數不低於它的頁面 (包含同分的頁面)，結果與完整排序的前 top_k 筆相同
+
+        [scores]: candidate 頁面的 BM25 分數
+        [rows]: candidate 頁面在索引中的 row
+        [top_k]: 最多回傳幾頁，None 則回傳全部
+        '''
+        if top_k is not None and top_k < len(scores):
+            if top_k > 0:
+                threshold = -np.partition(-scores, top_k - 1)[top_k - 1]
+                selected = np.flatnonzero(scores >= threshold)
+                order = selected[np.lexsort((selected, -scores[selected]))][:top_k]
+            else:
+                order = np.zeros(0, dtype=np.int64)
+        else:
+            order = np.argsort(-scores, kind='stable')
+
+        sorted_file_names = tuple(self.names[np.asarray(rows)[order]].tolist())
+        sorted_scores = tuple(round(float(score), 4) for score in scores[order])
+        return sorted_file_names, sorted_scores
+
+    def retrieve(self, qs, candidate_ids, top_k=None, scope='candidates'):
+        '''
+        回傳 (sorted_file_names, sorted_scores)，格式與 finance_bm25_rank.BM25_retrieve 相同
+
+        [qs]: 使用者query
+        [candidate_ids]: 可能與user query相關的所有檔案名稱 (c_id)
+        [top_k]: 最多回傳幾頁，None 則回傳全部
+        [scope]: 'candidates' 或 'corpus'
+        '''
+        return self.retrieve_batch([qs], [candidate_ids], top_k, scope)[0]
+
+    def retrieve_batch(self, queries, candidate_lists, top_k=None, scope='candidates'):
+        '''
+        一次處理多個 (rewrite) query，回傳每個 query 的 (sorted_file_names, sorted_scores)
+
+        [queries]: 使用者query列表
+        [candidate_lists]: 每個query對應的 candidate c_id 列表
+        [top_k]: 最多回傳幾頁，None 則回傳全部
+        [scope]: 'candidates' 或 'corpus'
+        '''
+        results = []
+        for query_tokens, candidate_ids in zip(self.token_cache.tokenize_many(queries), candidate_lists):
+            rows = self.index.candidate_rows(candidate_ids)
+            if not rows:
+                results.append(((), ()))
+                continue
+            scores = self.get_scores(query_tokens, rows, scope)
+            results.append(self.rank(scores, rows, top_k))
+        return results
+
+
+if __name__ == "__main__":
+    # 離線建立 BM25 索引
+    source_path_finance = './reference/processed_finance/processed_finance_pdf'
+    index_path = './reference/processed_finance/bm25_index.npz'
+    token_cache_path = './reference/processed_finance/token_cache.jsonl' # jieba 分詞結果的 cache
+    segment_workers = os.cpu_count() # 平行分詞的 process 數量
+
+    token_cache = TokenCache(token_cache_path)
+    # 已有索引時，signature 沒有改變的頁面沿用舊索引的 token
+    previous = FinanceBM25Index.load(index_path) if os.path.exists(index_path) else None
+    print(f'Building BM25 index from {source_path_finance}')
+    index = FinanceBM25Index.build(source_path_finance, token_cache, segment_workers, previous)
+    index.save(index_path)
+    token_cache.save()
+    print(f'Saved {len(index.names)} pages, {len(index.vocab)} terms to {index_path}')
+    token_cache.report()
@@ -1,8 +1,7 @@
 import os
 import json
-import jieba 
-import pdfplumber
-from rank_bm25 import BM25Okapi
+from finance_bm25_index import FinanceBM25Index, SparseBM25
+from token_cache import TokenCache
 
 
 
@@ -34,6 +33,7 @@ def read_pdf(pdf_loc, page_infos = None):
     [pdf_loc]: pdf檔案路徑
     [page_infos]: 限制讀取某幾頁，無則設置為None
     '''
+    import pdfplumber
     pdf = pdfplumber.open(pdf_loc)  # 打開指定的PDF文件
 
     pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
@@ -57,6 +57,8 @@ def BM25_retrieve(qs, corpus_dict):
     [qs] : 使用者query, 
     [corpus_dict] : 存所有candidate PDF 文字的dict
     '''
+    import jieba
+    from rank_bm25 import BM25Okapi
 
     filtered_corpus = list(corpus_dict.values()) 
 
@@ -83,10 +85,45 @@ def BM25_retrieve(qs, corpus_dict):
 
     return sorted_file_names, sorted_scores
 
+def load_bm25(index_path, source_path, token_cache, workers=1):
+    '''
+    讀取BM25索引，若不存在、或 source_path 中的頁面在建立索引後有新增/移除/改變，則 (增量) 重建並儲存，回傳 SparseBM25
+
+    [index_path]: 索引 (.npz) 路徑
+    [source_path]: one-page PDF 資料夾 (建立索引時使用)
+    [token_cache]: TokenCache
+    [workers]: 建立索引時平行分詞的 process 數量
+    '''
+    bm25_index = None
+    if os.path.exists(index_path):
+        print(f'Loading BM25 index from {index_path}')
+        bm25_index = FinanceBM25Index.load(index_path)
+        # 只有索引、沒有 one-page PDF 時直接使用索引
+        if not os.path.isdir(source_path) or not bm25_index.is_stale(source_path):
+            return SparseBM25(bm25_index, token_cache=token_cache)
+        print(f'BM25 index is stale, updating from {source_path}')
+    else:
+        print(f'Building BM25 index from {source_path}')
+    # 舊索引中沒有改變的頁面沿用其 token
+    bm25_index = FinanceBM25Index.build(source_path, token_cache, workers, bm25_index)
+    bm25_index.save(index_path)
+    return SparseBM25(bm25_index, token_cache=token_cache)
+
+def load_rewrites(rewrite_question_path):
+    '''
+    讀取 finance_rewrite.py 產生的 rewrite query，回傳 {qid: rewrite query}
+    '''
+    with open(rewrite_question_path, 'rb') as f:
+        qs_rewrite = json.load(f)
+    return {int(key): value for key, value in qs_rewrite.items()}
+
 if __name__ == "__main__":
     question_path = './preliminary_test/questions_preliminary.json'
     rewrite_question_path = './preliminary_test/finance_query_rewrite.json'
     source_path_finance = './reference/processed_finance/processed_finance_pdf'
+    index_path = './reference/processed_finance/bm25_index.npz' # 離線建立的BM25索引 (python3 Model/finance_bm25_index.py)
+    token_cache_path = './reference/processed_finance/token_cache.jsonl' # jieba 分詞結果的 cache
+    segment_workers = os.cpu_count() # 建立索引時平行分詞的 process 數量
     output_path = './preliminary_test/bm25_rewrite.json'
 
     answer_dict = {"answers": []}
@@ -97,27 +134,31 @@ if __name__ == "__main__":
         qs_ref = json.load(f)
         
     print('Loading rewrite QUERY')
-    with open(rewrite_question_path, 'rb') as f:
-        qs_rewrite = json.load(f)  
-        qs_rewrite = {int(key): value for key, value in qs_rewrite.items()}
-    
-    for q_dict in qs_ref['questions']:
-        if q_dict['category'] == 'finance':
-            print(f'Ansewering Question {q_dict['qid']} : {q_dict['query']}')
-            
-            # 獲取cnadidate pdf
-            candidate_ids = q_dict['source']
-            print(f'Loading candidate PDFs...{candidate_ids}')
-            corpus_dict_finance = load_data(source_path_finance, candidate_ids)
-
-            # 用rewrite query進行檢索
-            retrieved, scores = BM25_retrieve(qs_rewrite[q_dict['qid']], corpus_dict_finance)
-            print(f'Retrieved...{retrieved}')
-            print(f'Scores...{scores}')
-            
-            # 將結果加入字典
-            answer_dict['answers'].append({"qid": q_dict['qid'], "retrieve": retrieved, "scores": scores})
+    qs_rewrite = load_rewrites(rewrite_question_path)
+
+    token_cache = TokenCache(token_cache_path)
+
+    # 讀取BM25索引，若不存在則先建立
+    bm25 = load_bm25(index_path, source_path_finance, token_cache, segment_workers)
+
+    # 一次處理所有finance問題的rewrite query (只對candidate頁面計分)
+    finance_questions = [q_dict for q_dict in qs_ref['questions'] if q_dict['category'] == 'finance']
+    results = bm25.retrieve_batch(
+        [qs_rewrite[q_dict['qid']] for q_dict in finance_questions],
+        [q_dict['source'] for q_dict in finance_questions],
+    )
+
+    for q_dict, (retrieved, scores) in zip(finance_questions, results):
+        print(f'Ansewering Question {q_dict["qid"]} : {q_dict["query"]}')
+        print(f'Retrieved...{retrieved}')
+        print(f'Scores...{scores}')
+
+        # 將結果加入字典
+        answer_dict['answers'].append({"qid": q_dict['qid'], "retrieve": retrieved, "scores": scores})
 
 
     with open(output_path, 'w', encoding='utf8') as f:
-        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
+
+    token_cache.save()
+    token_cache.report()
\ No newline at end of file
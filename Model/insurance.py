@@ -1,74 +1,138 @@
 import json
-from tqdm import tqdm
-import pdfplumber
+import time
 import os
-import numpy as np
-from sentence_transformers import SentenceTransformer
-from Model.util import get_chunks_by_headers, split_content_by_length, get_top_k_indices_insurance
+from Model.util import read_insurance_pdf, get_top_k_docs_insurance, l2_normalize
+from Model.encoder import get_encoder
+from Model.embedding_store import EmbeddingStore
+from Model.ann_index import IVFIndex, rows_to_docs
+from Model.quantization import QuantizedEmbeddings
 
-cache_dir= './Model/cache' # repo for storing HuggingFace Model
-
-'''Load the embedding model'''
-model_name = 'intfloat/multilingual-e5-large'
-print(model_name)
-model = SentenceTransformer(model_name, trust_remote_code=True, cache_folder=cache_dir, device='cuda:1')
-
-'''Load the Insurance PDFs'''
-def load_data(source_path):
+def load_insurance_store(model, model_name, source_path, store_dir, dtype='float32', update=True, workers=1):
     '''
-    Load all PDF, return a dict
-    [source_path]: A path that stores all Insurnace PDFs
+    讀取/更新 Insurance chunk embeddings 的 store，只有新增或內容改變的PDF會重新chunking與encode，其餘直接從store (mmap) 讀取
+
+    [model]: encoder (Model.encoder.get_encoder 或 SentenceTransformer)
+    [model_name]: embedding 模型名稱
+    [source_path]: 儲存所有 Insurance PDF 的資料夾
+    [store_dir]: store 資料夾
+    [dtype]: 'float32' 或 'float16' (可減少一半的硬碟與記憶體用量)
+    [update]: False: 直接讀取現有的store，不檢查PDF是否有變動 (store 不存在或以其他 encoder backend 建立時仍會更新)
+    [workers]: 平行解析PDF的 process 數量
     '''
-    masked_file_ls = os.listdir(source_path)  # 獲取資料夾中的檔案列表
-    corpus_dict = {int(file.replace('.pdf', '')): read_pdf(os.path.join(source_path, file)) for file in tqdm(masked_file_ls)}  # 讀取每個PDF文件的文本，並以檔案名作為鍵，文本內容作為值存入字典
-    return corpus_dict
-    
-def read_pdf(pdf_loc, page_infos: list = None):
+    encoder_backend = getattr(model, 'backend', 'torch')
+    insurance_store = EmbeddingStore.load(store_dir) if not update else None
+    if insurance_store is not None and insurance_store.encoder_backend != encoder_backend:
+        insurance_store = None
+    if insurance_store is None:
+        print('Updating Insurance embedding store')
+        insurance_sources = {int(file.replace('.pdf', '')): os.path.join(source_path, file)
+                             for file in os.listdir(source_path) if file.endswith('.pdf')}
+        insurance_store = EmbeddingStore.update(
+            store_dir,
+            insurance_sources,
+            read_insurance_pdf,
+            lambda texts: model.encode(["passage:" + text for text in texts]),
+            model_name,
+            dtype,
+            workers,
+            encoder_backend,
+        )
+    return insurance_store
+
+def retrieve_insurance(model, insurance_store, questions, retrieval_mode='candidates', batch_mode=True, encode_batch_size=32, ivf_index=None, ann_chunk_k=50,
+                       quantized=None, rescore_k=None):
     '''
-    讀取單個PDF，對其中文字進行Chunking
-    [pdf_loc]: PDF路徑
-    [page_infos]: 考慮的PDF頁面
+    對每個 Insurance 問題檢索最相關的PDF，回傳每題的PDF編號 (top 1)
+
+    [model]: encoder (Model.encoder.get_encoder 或 SentenceTransformer)
+    [insurance_store]: Insurance 的 EmbeddingStore
+    [questions]: 題目 dict 列表 (需有 query，candidates 模式需有 source)
+    [retrieval_mode]: 'candidates' / 'exact' / 'ann' (需提供 ivf_index，只適用於 batch_mode)
+    [batch_mode]: True: 一次encode所有query並批次檢索；False: 逐題encode與檢索
+    [encode_batch_size]: query encode 時的 batch size
+    [ivf_index]: IVFIndex
+    [ann_chunk_k]: ANN 先取出的 chunk 數量，再依文件取最大值
+    [quantized]: QuantizedEmbeddings，提供時 (candidates / exact 模式) 以量化後的 embeddings 計分
+    [rescore_k]: 量化計分後，以 store 中 float32 的 embeddings 重新計分的文件數量，None 或 0 則不重新計分
     '''
-    chunks = get_chunks_by_headers(pdf_loc, page_infos, 8)
-    processed_chunks = split_content_by_length(chunks, 512)
-    merged_texts = [(chunk['header'] + chunk['content']).replace('\n', '') if chunk['header'] is not None else chunk['content'].replace('\n', '') 
-                for chunk in processed_chunks]    
-    return merged_texts
+    if batch_mode:
+        # Embed all queries at once
+        query_embeddings = model.encode(['query: ' + q_dict['query'] for q_dict in questions], batch_size=encode_batch_size)
+        if retrieval_mode == 'ann':
+            top_k_rows, _ = ivf_index.search(l2_normalize(query_embeddings), ann_chunk_k)
+            retrieved = rows_to_docs(top_k_rows, insurance_store.offsets, insurance_store.doc_ids, 1)
+        else:
+            candidate_lists = [q_dict['source'] for q_dict in questions] if retrieval_mode == 'candidates' else None
+            if quantized is not None:
+                retrieved = quantized.search_docs(
+                    l2_normalize(query_embeddings), insurance_store.offsets, insurance_store.doc_ids,
+                    candidate_lists, 1, insurance_store.embeddings, rescore_k)
+            else:
+                retrieved = get_top_k_docs_insurance(
+                    insurance_store.embeddings, insurance_store.offsets, insurance_store.doc_ids,
+                    query_embeddings, candidate_lists, 1)
+    else:
+        retrieved = []
+        for q_dict in questions:
+            # Embed the query 
+            query_embedding = model.encode('query: ' + q_dict['query'])
+            retrieved.extend(get_top_k_docs_insurance(
+                insurance_store.embeddings, insurance_store.offsets, insurance_store.doc_ids,
+                query_embedding, [q_dict['source']], 1))
+    return [real_retrieved_indexes[0] for real_retrieved_indexes in retrieved]
+
+
+if __name__ == "__main__":
+    cache_dir= './Model/cache' # repo for storing HuggingFace Model
+    device = os.environ.get('EMBEDDING_DEVICE', 'cpu') # 例如 'cuda:1'
+    encoder_backend = os.environ.get('EMBEDDING_BACKEND', 'torch') # 'torch': SentenceTransformer；'onnx' / 'onnx-int8': onnxruntime (只支援 CPU)
+
+    '''Load the embedding model'''
+    # 第一次 encode 時才載入模型
+    model_name = 'intfloat/multilingual-e5-large'
+    print(model_name)
+    model = get_encoder(model_name, device, cache_dir, encoder_backend)
 
-print('Loading Insurance PDF')  
-source_path_insurance = './reference/insurance'  
-processed_insurance_texts = load_data(source_path_insurance)
+    '''Load / update the persisted Insurance chunk embeddings'''
+    source_path_insurance = './reference/insurance'
+    store_dir_insurance = './reference/processed_insurance/embedding_store'
+    embedding_dtype = 'float32' # 'float16' 可減少一半的硬碟與記憶體用量
+    update_store = True # False: 直接讀取現有的store，不檢查PDF是否有變動
+    ingest_workers = os.cpu_count() # 平行解析PDF的 process 數量
+    insurance_store = load_insurance_store(model, model_name, source_path_insurance, store_dir_insurance,
+                                           embedding_dtype, update_store, ingest_workers)
 
+    '''Embed Query'''
+    query_path = '../dataset/preliminary/questions_preliminary.json'
+    print('Loading QUERY')
+    with open(query_path, 'rb') as f:
+        query_ref = json.load(f)
 
-'''Embed Insurance Text'''
-insurance_embeddings = {}
-for doc_id, texts in processed_insurance_texts.items():
-    texts = ["passage:" + text for text in texts]
-    insurance_embeddings[doc_id] = model.encode(texts)
+    '''For all query, get most relavant Chunk in embedding space'''
+    # Use suggested candidate docs
+    batch_mode = True # True: 一次encode所有query並批次檢索；False: 逐題encode與檢索
+    encode_batch_size = 32 # query encode 時的 batch size
+    retrieval_mode = 'candidates' # 'candidates': 只在題目提供的source中檢索；'exact': 搜尋全部PDF；'ann': 以IVF index近似搜尋全部PDF (只適用於 batch_mode)
+    ann_nlist = None # IVF cluster 數量，None 則使用 4 * sqrt(#chunks)
+    ann_nprobe = 8 # 查詢時搜尋的 cluster 數量，越大 recall 越高、速度越慢
+    ann_chunk_k = 50 # ANN 先取出的 chunk 數量，再依文件取最大值
+    quantization = None # None: 以 store 的 dtype 計分；'float16' / 'int8': 以量化後常駐記憶體的 embeddings 計分 (只適用於 batch_mode)
+    rescore_k = 10 # 量化計分後，以 float32 重新計分的文件數量 (0 則不重新計分)
 
-'''Embed Query'''
-query_path = '../dataset/preliminary/questions_preliminary.json'
-print('Loading QUERY')
-with open(query_path, 'rb') as f:
-    query_ref = json.load(f)
+    insurance_questions = [q_dict for q_dict in query_ref['questions'] if q_dict['category'] == 'insurance']
+    ivf_index = IVFIndex.load_or_build(insurance_store, ann_nlist, ann_nprobe) if retrieval_mode == 'ann' else None
+    quantized = QuantizedEmbeddings.load_or_build(insurance_store, quantization) if quantization else None
+    answer_dict = {"answers": []}
+    start_time = time.perf_counter()
+    retrieved = retrieve_insurance(model, insurance_store, insurance_questions, retrieval_mode, batch_mode,
+                                   encode_batch_size, ivf_index, ann_chunk_k, quantized, rescore_k)
 
-'''For all query, get most relavant Chunk in embedding space'''
-# Use suggested candidate docs
-answer_dict = {"answers": []}
-for q_dict in query_ref['questions']:
-    if q_dict['category'] == 'finance':
-        continue
-    elif q_dict['category'] == 'insurance':
-        # Embed the query 
-        query_embedding = model.encode('query: ' + q_dict['query'])
-        candidate_insurance_embeddings = {doc_id: insurance_embeddings[str(doc_id)] for doc_id in q_dict['source']}
-        real_retrieved_indexes = get_top_k_indices_insurance(candidate_insurance_embeddings, query_embedding, 1)
-        answer_dict['answers'].append({"qid": q_dict['qid'], "retrieve": real_retrieved_indexes[0]})
-        print(f'qid : {q_dict["qid"]}, retrieved index : {real_retrieved_indexes[0]}')
-    elif q_dict['category'] == 'faq':
-        continue
+    for q_dict, real_retrieved_index in zip(insurance_questions, retrieved):
+        answer_dict['answers'].append({"qid": q_dict['qid'], "retrieve": real_retrieved_index})
+        print(f'qid : {q_dict["qid"]}, retrieved index : {real_retrieved_index}')
+    print(f'Retrieval wall-clock ({"batched" if batch_mode else "per-question"}): {time.perf_counter() - start_time:.2f}s for {len(insurance_questions)} queries')
 
-'''Store the answer to json file'''
-output_path = './preliminary_test/pred/insurance.json'
-with open(output_path, 'w', encoding='utf8') as f:
-    json.dump(answer_dict, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+    '''Store the answer to json file'''
+    output_path = './preliminary_test/pred/insurance.json'
+    with open(output_path, 'w', encoding='utf8') as f:
+        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,152 @@
+import json
+import time
+import hashlib
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockMessagesHandler(BaseHTTPRequestHandler):
+    '''
+    模擬 Anthropic Messages API (POST /v1/messages)，可設定回應延遲與錯誤注入
+    回應固定選擇 Image 1 作為 top 1
+    '''
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        config = self.server.config
+        request = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))) or b'{}')
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+
+        time.sleep(max(0.0, random.gauss(config['latency'], config['latency_jitter'])))
+
+        # 錯誤注入
+        r = random.random()
+        if r < config['rate_limit_rate']:
+            with self.server.lock:
+                self.server.stats['429'] += 1
+            return self._send_json(429, {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': 'mock rate limit'}},
+                                   {'retry-after': str(config['retry_after'])} if config['retry_after'] is not None else None)
+        if r < config['rate_limit_rate'] + config['server_error_rate']:
+            with self.server.lock:
+                self.server.stats['5xx'] += 1
+            return self._send_json(529, {'type': 'error', 'error': {'type': 'overloaded_error', 'message': 'mock overloaded'}})
+
+        text = '<analysis_steps>mock</analysis_steps>\n<output_format>{"top 1": "1"}</output_format>'
+        usage = self.server.prompt_cache.usage(request)
+        with self.server.lock:
+            for key, value in usage.items():
+                self.server.stats[key] += value
+        self._send_json(200, {
+            'id': f'msg_mock_{self.server.stats["requests"]}',
+            'type': 'message',
+            'role': 'assistant',
+            'model': request.get('model', 'mock'),
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'stop_sequence': None,
+            'usage': dict(usage, output_tokens=len(text)),
+        })
+
+
+class MockPromptCache:
+    '''
+    模擬 prompt caching: 以 cache_control 標記的位置作為 breakpoint，
+    命中最長的已快取 prefix 計為 cache read，其後到最後一個 breakpoint 計為 cache write
+    token 數以文字長度、每張影像 1600 粗略計算
+    '''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.entries = {} # prefix hash --> 到期時間
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _blocks(request):
+        system = request.get('system', [])
+        blocks = [{'type': 'text', 'text': system}] if isinstance(system, str) else list(system)
+        for message in request.get('messages', []):
+            content = message.get('content', [])
+            blocks.extend([{'type': 'text', 'text': content}] if isinstance(content, str) else content)
+        return blocks
+
+    def usage(self, request):
+        blocks = self._blocks(request)
+        digest = hashlib.sha1()
+        total = 0
+        breakpoints = [] # (prefix hash, 到此為止的 tokens)
+        for block in blocks:
+            content = {key: value for key, value in block.items() if key != 'cache_control'}
+            digest.update(json.dumps(content, sort_keys=True).encode('utf-8'))
+            total += len(block.get('text', '')) if block.get('type') == 'text' else 1600
+            if 'cache_control' in block:
+                breakpoints.append((digest.hexdigest(), total))
+
+        now = time.monotonic()
+        with self.lock:
+            read = max((tokens for key, tokens in breakpoints if self.entries.get(key, 0) > now), default=0)
+            for key, _ in breakpoints:
+                self.entries[key] = now + self.ttl
+        write = breakpoints[-1][1] - read if breakpoints and breakpoints[-1][1] > read else 0
+        return {'input_tokens': total - read - write, 'cache_creation_input_tokens': write, 'cache_read_input_tokens': read}
+
+
+def start_mock_server(port=0, latency=0.5, latency_jitter=0.1, rate_limit_rate=0.0, server_error_rate=0.0, retry_after=None):
+    '''
+    在背景 thread 啟動 mock server，回傳 server (server.base_url 可作為 anthropic client 的 base_url)
+
+    [port]: 0 則自動選擇可用的 port
+    [latency]: 平均回應延遲 (秒)
+    [latency_jitter]: 回應延遲的標準差
+    [rate_limit_rate]: 回傳 429 的機率
+    [server_error_rate]: 回傳 529 (overloaded) 的機率
+    [retry_after]: 429 回應中的 retry-after 秒數，None 則不回傳
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockMessagesHandler)
+    server.daemon_threads = True
+    server.config = {
+        'latency': latency,
+        'latency_jitter': latency_jitter,
+        'rate_limit_rate': rate_limit_rate,
+        'server_error_rate': server_error_rate,
+        'retry_after': retry_after,
+    }
+    server.stats = {'requests': 0, '429': 0, '5xx': 0,
+                    'input_tokens': 0, 'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}
+    server.prompt_cache = MockPromptCache()
+    server.lock = threading.Lock()
+    server.base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mock Anthropic Messages API')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--latency_jitter', type=float, default=0.1)
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0)
+    parser.add_argument('--server_error_rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, args.latency, args.latency_jitter, args.rate_limit_rate, args.server_error_rate)
+    print(f'Mock Messages API listening on {server.base_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,171 @@
+import os
+import numpy as np
+from Model.util import top_k_similarities, doc_max_similarities, rank_docs
+from Model.ann_index import store_signature
+
+QUANTIZED_DTYPES = ('float16', 'int8')
+
+
+def quantize_int8(embeddings):
+    '''
+    每個向量各自以 max(|x|) / 127 作為 scale 量化為 int8，回傳 (codes, scales)
+    [embeddings]: shape:(#data, #embedding dim)
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127 if len(embeddings) else np.zeros(0, dtype=np.float32)
+    scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+    codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+class QuantizedEmbeddings:
+    '''
+    常駐記憶體中的量化 embeddings (float16，或 int8 + 每個向量的 scale)，以量化後的內積計分
+    float32 的 embeddings 仍留在 store 的 mmap 中，只有 re-score 時會讀取 top candidates 的 row
+    '''
+
+    def __init__(self, codes, scales=None, signature=None):
+        '''
+        [codes]: 量化後的 embeddings，shape:(#data, #embedding dim)，dtype 為 float16 或 int8
+        [scales]: int8 每個向量的 scale，shape:(#data,)；float16 為 None
+        [signature]: 建立時的 store fingerprint
+        '''
+        self.codes = codes
+        self.scales = scales
+        self.signature = signature
+
+    @property
+    def dtype(self):
+        return str(self.codes.dtype)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def build(cls, embeddings, dtype='int8', signature=None, batch_size=65536):
+        '''
+        [embeddings]: 已正規化的 embeddings (可為 mmap，分批讀取)，shape:(#data, #embedding dim)
+        [dtype]: 'float16' 或 'int8'
+        [signature]: store fingerprint
+        '''
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError(f'Unsupported quantization dtype {dtype!r}, expected one of {QUANTIZED_DTYPES}')
+        codes = np.empty(embeddings.shape, dtype=dtype)
+        scales = np.empty(len(embeddings), dtype=np.float32) if dtype == 'int8' else None
+        for start in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            if dtype == 'int8':
+                codes[start:start + batch_size], scales[start:start + batch_size] = quantize_int8(batch)
+            else:
+                codes[start:start + batch_size] = batch
+        return cls(codes, scales, signature)
+
+    def save(self, path):
+        np.savez(path, codes=self.codes, scales=self.scales if self.scales is not None else np.zeros(0, dtype=np.float32),
+                 signature=np.array(self.signature or ''))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            scales = data['scales'] if data['codes'].dtype == np.int8 else None
+            return cls(data['codes'], scales, str(data['signature']) or None)
+
+    @classmethod
+    def load_or_build(cls, store, dtype='int8'):
+        '''
+        讀取 store 資料夾中的量化 embeddings (quantized_<dtype>.npz)，不存在或 store 已更新時重新建立
+
+        [store]: EmbeddingStore
+        [dtype]: 'float16' 或 'int8'
+        '''
+        path = os.path.join(store.store_dir, f'quantized_{dtype}.npz')
+        signature = store_signature(store)
+        if os.path.exists(path):
+            quantized = cls.load(path)
+            if quantized.signature == signature and quantized.dtype == dtype:
+                return quantized
+        print(f'Building {dtype} embeddings for {store.store_dir}')
+        quantized = cls.build(store.embeddings, dtype, signature)
+        quantized.save(path)
+        return quantized
+
+    def similarities(self, query_embeddings, batch_size=2048):
+        '''
+        量化後的內積 (int8 乘上每個向量的 scale)，分批反量化以限制暫存記憶體，回傳 shape:(#query, #data)
+        [query_embeddings]: 已正規化的 query embeddings，shape:(#query, #embedding dim) 或 (#embedding dim,)
+        '''
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        similarities = np.empty((len(query_embeddings), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), batch_size):
+            end = start + batch_size
+            block = query_embeddings @ self.codes[start:end].astype(np.float32).T
+            if self.scales is not None:
+                block *= self.scales[start:end]
+            similarities[:, start:end] = block
+        return similarities
+
+    def search(self, query_embeddings, top_k, candidate_lists=None, full_embeddings=None, rescore_k=None):
+        '''
+        以量化內積取出 top candidates，若提供 full_embeddings 則以 float32 重新計分前 rescore_k 筆後再取 top_k
+        回傳 (indices, scores)，格式與 util.top_k_dot 相同
+
+        [query_embeddings]: 已正規化的 query embeddings
+        [top_k]: 每個 query 取出幾筆
+        [candidate_lists]: 每個 query 的 candidate indices，None 則搜尋全部
+        [full_embeddings]: float32 (或 store 原本 dtype) 的 embeddings，通常為 store.embeddings (mmap)
+        [rescore_k]: 以 float32 重新計分的 candidate 數量，None 或 0 則不重新計分
+        '''
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        similarities = self.similarities(query_embeddings)
+        if full_embeddings is None or not rescore_k:
+            return top_k_similarities(similarities, top_k, candidate_lists)
+
+        indices, _ = top_k_similarities(similarities, max(top_k, rescore_k), candidate_lists)
+        scores = np.full(indices.shape, -np.inf, dtype=np.float32)
+        for q, row in enumerate(indices):
+            valid = row >= 0
+            scores[q, valid] = np.asarray(full_embeddings[row[valid]], dtype=np.float32) @ query_embeddings[q]
+        order = np.argsort(-scores, axis=1, kind='stable')[:, :top_k]
+        indices = np.take_along_axis(indices, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        indices[np.isneginf(scores)] = -1
+        return indices, scores
+
+    def search_docs(self, query_embeddings, doc_offsets, doc_ids, candidate_lists=None, top_k=1, full_embeddings=None, rescore_k=None):
+        '''
+        文件層級的檢索 (每份文件取 chunk 的最大相似度)，回傳格式與 util.get_top_k_docs_insurance 相同
+        若提供 full_embeddings，前 rescore_k 份文件的所有 chunk 以 float32 重新計分
+
+        [query_embeddings]: 已正規化的 query embeddings
+        [doc_offsets]: 每份文件在 embeddings 中的起始位置，shape:(#docs + 1,)
+        [doc_ids]: 每份文件的編號
+        [candidate_lists]: 每個query的candidate文件編號，None 則考慮所有文件
+        [top_k]: 每個query回傳幾份文件
+        [full_embeddings]: float32 (或 store 原本 dtype) 的 embeddings
+        [rescore_k]: 以 float32 重新計分的文件數量，None 或 0 則不重新計分
+        '''
+        query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        doc_max = doc_max_similarities(self.similarities(query_embeddings), doc_offsets, len(doc_ids))
+        if full_embeddings is None or not rescore_k:
+            return rank_docs(doc_max, doc_ids, candidate_lists, top_k)
+
+        doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        results = []
+        for q, candidates in enumerate(rank_docs(doc_max, doc_ids, candidate_lists, max(top_k, rescore_k))):
+            exact = []
+            for doc_id in candidates:
+                # 不在 store 中的 candidate (rank_docs 已印出警告) 維持 -inf
+                i = doc_index.get(doc_id)
+                if i is None:
+                    exact.append(-np.inf)
+                    continue
+                doc_embeddings = np.asarray(full_embeddings[doc_offsets[i]:doc_offsets[i + 1]], dtype=np.float32)
+                exact.append(float((doc_embeddings @ query_embeddings[q]).max()) if len(doc_embeddings) else -np.inf)
+            # 同分時保留量化分數的順序
+            order = np.argsort(-np.asarray(exact), kind='stable')[:top_k]
+            results.append([candidates[i] for i in order])
+        return results
@@ -0,0 +1,171 @@
+import time
+import random
+import asyncio
+import anthropic
+
+IMAGE_TOKENS_ESTIMATE = 1600 # 單張影像的 input tokens 上限估計 (1.15 megapixels / 750)
+
+
+def estimate_input_tokens(system_prompt, user_content, image_tokens=None):
+    '''
+    粗略估計一個 request 的 input tokens (繁體中文約每字一個 token)
+
+    [system_prompt]: system prompt
+    [user_content]: user message 的 content blocks
+    [image_tokens]: 依序每張影像估計的 tokens，None 則每張以 IMAGE_TOKENS_ESTIMATE 計
+    '''
+    tokens = len(system_prompt)
+    image_idx = 0
+    for block in user_content:
+        if block['type'] == 'text':
+            tokens += len(block['text'])
+        elif block['type'] == 'image':
+            tokens += image_tokens[image_idx] if image_tokens is not None else IMAGE_TOKENS_ESTIMATE
+            image_idx += 1
+    return tokens
+
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter: 每分鐘補充 rate_per_minute 個 token，最多累積 capacity 個
+    '''
+
+    def __init__(self, rate_per_minute, capacity=None):
+        '''
+        [rate_per_minute]: 每分鐘補充的 token 數量，None 表示不限制
+        [capacity]: bucket 容量 (允許的 burst)，預設為 rate_per_minute
+        '''
+        self.rate = rate_per_minute / 60.0 if rate_per_minute else None
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        '''
+        取得 amount 個 token，不足時等待；amount 超過容量時等到 bucket 全滿後取用
+        '''
+        if self.rate is None:
+            return
+        async with self.lock:
+            amount = min(amount, self.capacity)
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AsyncRerankClient:
+    '''
+    以 asyncio 併發呼叫 Anthropic Messages API
+    - 以 semaphore 限制同時進行的 request 數量
+    - 以 token bucket 限制每分鐘的 request 數量與 input tokens
+    - 遇到 429 / 5xx / 連線錯誤時，以 jittered exponential backoff 重試
+    '''
+    RETRY_STATUS = {408, 409, 429}
+
+    def __init__(self, client, max_concurrency=8, requests_per_minute=50, input_tokens_per_minute=40000,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        '''
+        [client]: anthropic.AsyncAnthropic (建議設定 max_retries=0，由此處負責重試)
+        [max_concurrency]: 同時進行的 request 數量上限
+        [requests_per_minute]: 每分鐘 request 數量上限
+        [input_tokens_per_minute]: 每分鐘 input tokens 上限
+        [max_retries]: 最多重試幾次
+        [base_delay]: 第一次重試前的最長等待秒數，之後每次加倍
+        [max_delay]: 單次等待秒數上限
+        '''
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(input_tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.usage_log = [] # 每個成功 request 的 usage 與 latency
+
+    def _should_retry(self, error):
+        if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+            return True
+        if isinstance(error, anthropic.APIStatusError):
+            return error.status_code in self.RETRY_STATUS or error.status_code >= 500
+        return False
+
+    def _retry_delay(self, error, attempt):
+        # 優先使用 server 回傳的 retry-after，否則使用 full jitter exponential backoff
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        try:
+            return min(self.max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def create(self, estimated_input_tokens, tag=None, **kwargs):
+        '''
+        呼叫 messages.create，依 rate limit 排程並在暫時性錯誤時重試
+        成功時將 usage (含 prompt cache 讀寫 tokens) 與 latency 記錄於 self.usage_log
+
+        [estimated_input_tokens]: 此 request 估計的 input tokens
+        [tag]: 記錄在 usage_log 中的識別 (例如 qid)
+        [kwargs]: messages.create 的參數
+        '''
+        for attempt in range(self.max_retries + 1):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimated_input_tokens)
+            try:
+                start = time.perf_counter()
+                message = await self.client.messages.create(**kwargs)
+                latency = time.perf_counter() - start
+                usage = message.usage
+                self.usage_log.append({
+                    'tag': tag,
+                    'latency': round(latency, 4),
+                    'attempts': attempt + 1,
+                    'estimated_input_tokens': estimated_input_tokens,
+                    'input_tokens': usage.input_tokens,
+                    'output_tokens': usage.output_tokens,
+                    'cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', None) or 0,
+                    'cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', None) or 0,
+                })
+                return message
+            except Exception as e:
+                if attempt == self.max_retries or not self._should_retry(e):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                self.retries += 1
+                print(f'{type(e).__name__}，{delay:.1f} 秒後重試 ({attempt + 1}/{self.max_retries})')
+                await asyncio.sleep(delay)
+
+    def usage_summary(self):
+        '''
+        彙總 usage_log: 總 input tokens、prompt cache 讀寫 tokens、平均 latency
+        '''
+        n = len(self.usage_log)
+        summary = {key: sum(record[key] for record in self.usage_log)
+                   for key in ['input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens']}
+        summary['requests'] = n
+        summary['mean_latency'] = round(sum(record['latency'] for record in self.usage_log) / n, 4) if n else 0.0
+        total_input = summary['input_tokens'] + summary['cache_creation_input_tokens'] + summary['cache_read_input_tokens']
+        summary['cache_read_ratio'] = round(summary['cache_read_input_tokens'] / total_input, 4) if total_input else 0.0
+        return summary
+
+    async def run_all(self, items, handler):
+        '''
+        併發處理所有 items，回傳結果的順序與 items 相同 (與完成順序無關)
+        單一 item 失敗時，該位置回傳 Exception，不影響其他 item
+
+        [items]: 要處理的資料
+        [handler]: async function，item --> 結果 (內部呼叫 self.create)
+        '''
+        async def run_one(item):
+            async with self.semaphore:
+                return await handler(item)
+        return await asyncio.gather(*(run_one(item) for item in items), return_exceptions=True)
@@ -0,0 +1,96 @@
+import json
+import time
+import sqlite3
+import hashlib
+
+
+def hash_image(base64_data):
+    '''
+    影像內容的 hash (以 base64 字串計算，與檔名無關)
+    '''
+    return hashlib.sha1(base64_data.encode('ascii')).hexdigest()
+
+
+def request_key(model, system_prompt, image_hashes, query, temperature, max_tokens):
+    '''
+    以 request 中會影響模型輸出的欄位計算 cache key
+
+    [model]: 模型名稱
+    [system_prompt]: system prompt
+    [image_hashes]: 依送入順序排列的影像 hash (順序不同視為不同 request)
+    [query]: 使用者查詢
+    [temperature], [max_tokens]: 生成參數
+    '''
+    payload = json.dumps([model, system_prompt, list(image_hashes), query, temperature, max_tokens],
+                         ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    '''
+    以 sqlite 儲存模型回應的 content-addressed cache，總大小超過 max_bytes 時依 LRU 淘汰
+    '''
+
+    def __init__(self, cache_path, max_bytes=64 * 1024 * 1024):
+        '''
+        [cache_path]: sqlite 檔案路徑
+        [max_bytes]: 回應內容總大小上限 (bytes)，None 表示不限制
+        '''
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(cache_path)
+        # WAL + synchronous=NORMAL: 每次 commit 不需 fsync，避免阻塞 event loop
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                 key TEXT PRIMARY KEY,
+                                 response TEXT NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 last_access REAL NOT NULL)''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)')
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        取得 cache 中的回應，沒有則回傳 None
+        命中時更新 last_access (不立即 commit，於下一次 put 或 close 時一併寫入)
+        '''
+        row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key, response):
+        '''
+        寫入回應，並淘汰最久未使用的項目直到總大小不超過 max_bytes
+        '''
+        size = len(response.encode('utf-8'))
+        self.conn.execute('INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)',
+                          (key, response, size, time.time()))
+        if self.max_bytes is not None:
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            for old_key, old_size in self.conn.execute(
+                    'SELECT key, size FROM responses WHERE key != ? ORDER BY last_access', (key,)).fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute('DELETE FROM responses WHERE key = ?', (old_key,))
+                total -= old_size
+                self.evictions += 1
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def report(self):
+        total = self.hits + self.misses
+        print(f'Response cache: {self.hits}/{total} hits, {self.misses} misses, '
+              f'{self.evictions} evicted, {len(self)} entries')
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
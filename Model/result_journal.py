@@ -0,0 +1,103 @@
+import os
+import json
+import time
+
+
+def truncate_torn_tail(journal_path, block_size=65536):
+    '''
+    截掉 journal 最後一個換行之後的內容 (中斷時寫到一半的最後一行)，回傳截掉的 bytes 數
+    續跑時若直接 append，下一筆紀錄會接在殘缺的行後面而無法解析
+    '''
+    if not os.path.exists(journal_path):
+        return 0
+    with open(journal_path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - block_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        f.truncate(end)
+    return size - end
+
+
+class ResultJournal:
+    '''
+    Append-only JSONL journal: 每完成一題即寫入一行，fsync 以批次方式進行
+    程式中斷後可由 load_journal 讀回已完成的題目並續跑
+    '''
+
+    def __init__(self, journal_path, resume=False, fsync_every=16, fsync_interval=2.0):
+        '''
+        [journal_path]: JSONL 檔案路徑
+        [resume]: True 則接續寫在既有 journal 之後 (先截掉寫到一半的最後一行)，False 則清空重寫
+        [fsync_every]: 累積幾筆未 fsync 的紀錄後 fsync 一次
+        [fsync_interval]: 距離上次 fsync 超過幾秒後，下一筆寫入時 fsync
+        '''
+        os.makedirs(os.path.dirname(journal_path) or '.', exist_ok=True)
+        if resume:
+            torn = truncate_torn_tail(journal_path)
+            if torn:
+                print(f'Journal: dropped {torn} bytes of an incomplete last record')
+        self.file = open(journal_path, 'a' if resume else 'w', encoding='utf8')
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        self.pending += 1
+        if self.pending >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def load_journal(journal_path):
+    '''
+    讀取 journal，回傳 {qid: record}；同一 qid 出現多次時以最後一筆為準
+    中斷時寫到一半的最後一行會被忽略
+    '''
+    records = {}
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, 'r', encoding='utf8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record['qid']] = record
+    return records
+
+
+def compact_journal(journal_path, output_path):
+    '''
+    將 journal 整理成原本的預測格式 {"answers": [...]} (依 qid 排序)，以暫存檔 + rename 寫入
+
+    [journal_path]: JSONL journal 路徑
+    [output_path]: 輸出的 json 路徑
+    '''
+    records = load_journal(journal_path)
+    answer_dict = {"answers": [records[qid] for qid in sorted(records)]}
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+    return answer_dict
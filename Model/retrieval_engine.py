@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import threading
+from Model.encoder import get_encoder
+
+# finance_bm25_rank 與其相依的 module 使用 Model 資料夾內的 flat import
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CATEGORIES = ('faq', 'insurance', 'finance')
+
+
+class LatencyStats:
+    '''
+    記錄每個 request 的 latency 與題數，回報 p50/p95/p99 latency 與 QPS
+    QPS 以第一個 request 開始到最後一個 request 結束的 wall-clock 計算
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = [] # 每個 request 的 latency (秒)
+        self.category_latencies = {} # category --> 每個 request 中該 category 的處理時間 (秒)
+        self.questions = 0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start, end, n_questions, category_latencies):
+        '''
+        [start], [end]: request 開始與結束的 time.perf_counter()
+        [n_questions]: request 中的題數
+        [category_latencies]: {category: 處理時間 (秒)}
+        '''
+        with self.lock:
+            self.latencies.append(end - start)
+            for category, latency in category_latencies.items():
+                self.category_latencies.setdefault(category, []).append(latency)
+            self.questions += n_questions
+            self.first_start = start if self.first_start is None else min(self.first_start, start)
+            self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    @staticmethod
+    def _percentiles(latencies):
+        import numpy as np
+        p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+        return {'p50_ms': round(float(p50), 2), 'p95_ms': round(float(p95), 2), 'p99_ms': round(float(p99), 2)}
+
+    def summary(self):
+        with self.lock:
+            wall = self.last_end - self.first_start if self.latencies else 0.0
+            summary = {
+                'requests': len(self.latencies),
+                'questions': self.questions,
+                **self._percentiles(self.latencies),
+                'qps': round(self.questions / wall, 2) if wall > 0 else 0.0,
+                'categories': {category: dict(requests=len(latencies), **self._percentiles(latencies))
+                               for category, latencies in self.category_latencies.items()},
+            }
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        print(f"Requests: {summary['requests']}, questions: {summary['questions']}, QPS: {summary['qps']}")
+        print(f"Latency p50/p95/p99: {summary['p50_ms']} / {summary['p95_ms']} / {summary['p99_ms']} ms")
+        for category, stats in summary['categories'].items():
+            print(f"  {category:<9}: p50/p95/p99 {stats['p50_ms']} / {stats['p95_ms']} / {stats['p99_ms']} ms ({stats['requests']} requests)")
+
+
+class RetrievalEngine:
+    '''
+    常駐的檢索引擎: embedding 模型、FAQ/Insurance 的 embedding store 與 Finance 的 BM25 索引只在啟動時載入一次，
+    之後每個 request 依題目的 category 分組，各 category 批次檢索後依原本的順序回傳
+    各 category 的 module (與其相依的 numpy、jieba 等套件) 只在 load 時才 import，只載入需要的 category
+    '''
+
+    def __init__(self, config):
+        '''
+        [config]: 設定 dict (見 main.py 的 engine_config)，categories 決定要載入哪些資料
+        '''
+        self.config = config
+        self.categories = tuple(config['categories'])
+        self.stats = LatencyStats()
+        # SentenceTransformer 與 token cache 不保證 thread-safe，檢索時以 lock 序列化 (模型本身已使用多執行緒計算)
+        self.lock = threading.Lock()
+        self.model = None
+        self.token_cache = None
+        self.load()
+
+    def load(self):
+        config = self.config
+        start_time = time.perf_counter()
+        if 'faq' in self.categories or 'insurance' in self.categories:
+            from Model.ann_index import IVFIndex
+            from Model.quantization import QuantizedEmbeddings
+            # FAQ 與 Insurance 共用 process 內同一個 embedding 模型，store 已是最新時第一次 encode query 才載入
+            self.model = get_encoder(config['model_name'], config['device'], config['cache_dir'],
+                                     config['encoder_backend'], config['encoder_threads'])
+            if config['preload_model']:
+                self.model.load()
+        if 'faq' in self.categories:
+            from Model.faq import load_faq_store
+            self.faq_store, self.faq_ids = load_faq_store(self.model, config['model_name'], config['faq_path'], config['faq_store_dir'])
+            self.faq_ivf = (IVFIndex.load_or_build(self.faq_store, config['ann_nlist'], config['ann_nprobe'])
+                            if config['retrieval_mode'] == 'ann' else None)
+            self.faq_quantized = (QuantizedEmbeddings.load_or_build(self.faq_store, config['quantization'])
+                                  if config['quantization'] else None)
+        if 'insurance' in self.categories:
+            from Model.insurance import load_insurance_store
+            self.insurance_store = load_insurance_store(
+                self.model, config['model_name'], config['insurance_source_path'], config['insurance_store_dir'],
+                config['embedding_dtype'], config['update_store'], config['ingest_workers'])
+            self.insurance_ivf = (IVFIndex.load_or_build(self.insurance_store, config['ann_nlist'], config['ann_nprobe'])
+                                  if config['retrieval_mode'] == 'ann' else None)
+            self.insurance_quantized = (QuantizedEmbeddings.load_or_build(self.insurance_store, config['quantization'])
+                                        if config['quantization'] else None)
+        if 'finance' in self.categories:
+            from finance_bm25_rank import load_bm25, load_rewrites
+            from token_cache import TokenCache
+            self.token_cache = TokenCache(config['token_cache_path'])
+            self.bm25 = load_bm25(config['finance_index_path'], config['finance_source_path'],
+                                  self.token_cache, config['ingest_workers'])
+            self.rewrites = load_rewrites(config['rewrite_path']) if os.path.exists(config['rewrite_path']) else {}
+        print(f'Retrieval engine ready ({", ".join(self.categories)}) in {time.perf_counter() - start_time:.2f}s')
+
+    def _retrieve_category(self, category, questions):
+        config = self.config
+        if category == 'faq':
+            from Model.faq import retrieve_faq
+            retrieved = retrieve_faq(self.model, self.faq_store, self.faq_ids, questions, config['retrieval_mode'],
+                                     True, config['encode_batch_size'], self.faq_ivf, self.faq_quantized, config['rescore_k'])
+            return [{"qid": q_dict['qid'], "retrieve": faq_ids} for q_dict, faq_ids in zip(questions, retrieved)]
+        if category == 'insurance':
+            from Model.insurance import retrieve_insurance
+            retrieved = retrieve_insurance(self.model, self.insurance_store, questions, config['retrieval_mode'],
+                                           True, config['encode_batch_size'], self.insurance_ivf, config['ann_chunk_k'],
+                                           self.insurance_quantized, config['rescore_k'])
+            return [{"qid": q_dict['qid'], "retrieve": doc_id} for q_dict, doc_id in zip(questions, retrieved)]
+        # finance: 優先使用題目中的 rewrite，其次為 finance_rewrite.py 產生的 rewrite，最後使用原本的 query
+        queries = [q_dict.get('rewrite') or self.rewrites.get(q_dict['qid'], q_dict['query']) for q_dict in questions]
+        results = self.bm25.retrieve_batch(queries, [q_dict['source'] for q_dict in questions])
+        return [{"qid": q_dict['qid'], "retrieve": list(retrieved), "scores": [float(score) for score in scores]}
+                for q_dict, (retrieved, scores) in zip(questions, results)]
+
+    def retrieve(self, questions):
+        '''
+        檢索一個 request 中的所有題目，回傳與 questions 順序相同的答案列表
+        [questions]: 題目 dict 列表 (qid, category, query, source)
+        '''
+        start = time.perf_counter()
+        groups = {}
+        for i, q_dict in enumerate(questions):
+            if q_dict.get('category') not in self.categories:
+                raise ValueError(f"Unsupported category {q_dict.get('category')!r} for qid {q_dict.get('qid')} (loaded: {', '.join(self.categories)})")
+            groups.setdefault(q_dict['category'], []).append(i)
+
+        answers = [None] * len(questions)
+        category_latencies = {}
+        with self.lock:
+            for category, indexes in groups.items():
+                category_start = time.perf_counter()
+                for i, answer in zip(indexes, self._retrieve_category(category, [questions[i] for i in indexes])):
+                    answers[i] = answer
+                category_latencies[category] = time.perf_counter() - category_start
+        self.stats.record(start, time.perf_counter(), len(questions), category_latencies)
+        return answers
+
+    def close(self):
+        '''
+        將新的 query 分詞結果寫入 token cache
+        '''
+        if self.token_cache is not None:
+            self.token_cache.save()
@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def segment(text):
+    '''
+    使用 jieba 搜尋引擎模式進行分詞
+    [text]: 要分詞的文字
+    '''
+    import jieba
+    return list(jieba.cut_for_search(text))
+
+def content_hash(text):
+    '''
+    文字內容的 hash，作為 cache 的 key
+    [text]: 要計算 hash 的文字
+    '''
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class TokenCache:
+    '''
+    以文字內容的 hash 為 key，將 jieba 分詞結果存在硬碟上 (JSONL，只做 append)
+    內容沒有改變的頁面不需要重新分詞；全部命中時也不會載入 jieba 字典
+    '''
+
+    def __init__(self, cache_path=None):
+        '''
+        [cache_path]: cache 檔案路徑，None 則只存在記憶體中
+        '''
+        self.cache_path = cache_path
+        self.entries = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 中斷寫入造成的不完整紀錄，略過即可
+                        continue
+                    self.entries[record['key']] = record['tokens']
+
+    def tokenize(self, text):
+        '''
+        分詞單一文字，優先使用 cache
+        [text]: 要分詞的文字
+        '''
+        return self.tokenize_many([text])[0]
+
+    def tokenize_many(self, texts, workers=1):
+        '''
+        分詞多筆文字，只對 cache 中沒有的文字進行分詞
+
+        [texts]: 要分詞的文字列表
+        [workers]: 大於1時使用 process pool 平行分詞 (適合第一次建立 cache)
+        '''
+        keys = [content_hash(text) for text in texts]
+
+        # 找出需要分詞的文字 (相同內容只分詞一次)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self.entries or key in missing:
+                self.hits += 1
+            else:
+                self.misses += 1
+                missing[key] = text
+
+        if missing:
+            if workers and workers > 1 and len(missing) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    chunksize = max(1, len(missing) // (workers * 4))
+                    segmented = list(executor.map(segment, missing.values(), chunksize=chunksize))
+            else:
+                segmented = [segment(text) for text in missing.values()]
+
+            for key, tokens in zip(missing, segmented):
+                self.entries[key] = tokens
+                self.pending[key] = tokens
+
+        return [self.entries[key] for key in keys]
+
+    def save(self):
+        '''
+        將新分詞的結果 append 至 cache 檔案
+        '''
+        if not self.cache_path or not self.pending:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        with open(self.cache_path, 'a', encoding='utf8') as f:
+            for key, tokens in self.pending.items():
+                f.write(json.dumps({'key': key, 'tokens': tokens}, ensure_ascii=False) + '\n')
+        self.pending = {}
+
+    def report(self):
+        '''
+        印出 cache 命中/未命中次數
+        '''
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        print(f'Token cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), {len(self.entries)} entries')
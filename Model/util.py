@@ -1,12 +1,73 @@
 
 import base64
 import os
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-import pdfplumber
-from collections import Counter
+import json
+import math
+import mmap
+import threading
+from collections import Counter, OrderedDict
+
+# numpy / sklearn / pdfplumber / PIL 只在第一次使用的函式中才 import，
+# 只需要 encode_image 等輕量函式的呼叫端不必等待載入 (見 Benchmark/import_time.py)
 
 ############################################## FAQ ##############################################
+def l2_normalize(embeddings):
+    '''
+    將每一個 embedding 正規化為長度 1，正規化後的內積即為 cosine similarity
+    [embeddings]: shape:(#data, #embedding dim) 或 (#embedding dim,)
+    '''
+    import numpy as np
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+def top_k_dot(corpus_embeddings, query_embeddings, top_k, candidate_lists=None):
+  '''
+  以內積 (embeddings 須先 L2 正規化，內積即 cosine similarity) 與 np.argpartition 取出每個 query 的 top_k
+  回傳 (indices, scores)，shape 皆為 (#query, top_k)，依分數由高到低排列；
+  candidate 數量不足 top_k 時，不足的位置 index 為 -1、score 為 -inf
+
+  [corpus_embeddings]: 已正規化的 corpus embeddings，shape:(#data, #embedding dim)
+  [query_embeddings]: 已正規化的 query embeddings，shape:(#query, #embedding dim) 或 (#embedding dim,)
+  [top_k]: 每個 query 取出幾筆
+  [candidate_lists]: 每個 query 的 candidate indices，None 則搜尋整個 corpus
+  '''
+  import numpy as np
+  query_embeddings = np.atleast_2d(query_embeddings)
+  similarities = query_embeddings @ np.asarray(corpus_embeddings).T
+  return top_k_similarities(similarities, top_k, candidate_lists)
+
+def top_k_similarities(similarities, top_k, candidate_lists=None):
+  '''
+  從相似度矩陣取出每個 query 的 top_k，回傳格式與 top_k_dot 相同
+
+  [similarities]: shape:(#query, #data)
+  [top_k]: 每個 query 取出幾筆
+  [candidate_lists]: 每個 query 的 candidate indices，None 則搜尋全部
+  '''
+  import numpy as np
+  # 非 candidate 的相似度設為 -inf
+  if candidate_lists is not None:
+    rows = np.repeat(np.arange(len(candidate_lists)), [len(candidates) for candidates in candidate_lists])
+    cols = np.concatenate([np.asarray(candidates, dtype=np.int64) for candidates in candidate_lists]) if len(rows) else rows
+    masked = np.full_like(similarities, -np.inf)
+    masked[rows, cols] = similarities[rows, cols]
+    similarities = masked
+
+  # 先以 argpartition 選出 top K，再只對這 K 筆排序
+  k = min(top_k, similarities.shape[1])
+  if k < similarities.shape[1]:
+    top_indices = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+  else:
+    top_indices = np.tile(np.arange(k), (len(similarities), 1))
+  top_scores = np.take_along_axis(similarities, top_indices, axis=1)
+  order = np.argsort(-top_scores, axis=1, kind='stable')
+  top_indices = np.take_along_axis(top_indices, order, axis=1)
+  top_scores = np.take_along_axis(top_scores, order, axis=1)
+  top_indices[np.isneginf(top_scores)] = -1
+
+  return top_indices, top_scores
+
 def get_top_k_indices(faq_embeddings, query_embedding, top_k):  
   '''
   依照cosine similarity，排序並取出top_k個與query_embedding最相關的faq_embedding之indices
@@ -14,18 +75,57 @@ def get_top_k_indices(faq_embeddings, query_embedding, top_k):
   [faq_embeddings]: 每一筆faq的embeddings，shape:(#faq data, #embedding dim)
   [query_embeddings]: user query的embedding，shape:(1, #embedding dim)
   '''
-  # 逐筆計算 cosine similarities
-  similarities = cosine_similarity(query_embedding.reshape(1, -1), faq_embeddings).flatten()
-
-  # 根據 cosine similarity 排序
-  sorted_indices = np.argsort(similarities)[::-1]
+  top_k_indices, _ = top_k_dot(l2_normalize(faq_embeddings), l2_normalize(query_embedding.reshape(1, -1)), top_k)
+  return top_k_indices[0]
 
-  # 取出 top K 的索引編號
-  top_k_indices = sorted_indices[:top_k]
+def get_top_k_indices_batch(faq_embeddings, query_embeddings, candidate_lists=None, top_k=1):
+  '''
+  一次計算所有 query 與所有 faq 的 cosine similarity，在每個 query 的 candidate 中 (None 則為全部 faq) 取出 top_k 個 indices
 
-  return top_k_indices
+  [faq_embeddings]: 每一筆faq的embeddings (已 L2 正規化)，shape:(#faq data, #embedding dim)
+  [query_embeddings]: 所有user query的embeddings，shape:(#query, #embedding dim)
+  [candidate_lists]: 每個 query 的 candidate faq indices
+  '''
+  top_k_indices, _ = top_k_dot(faq_embeddings, l2_normalize(query_embeddings), top_k, candidate_lists)
+  return [[int(i) for i in row if i >= 0] for row in top_k_indices]
 
 ############################################## Insurance ##############################################
+def detect_page_headers(lines):
+    """
+    檢測單一頁面中的header行
+
+    [lines]: page.extract_text_lines() 的結果 (不可為空)
+    """
+    # 移除最後一行（可能是頁碼）
+    if len(lines) > 1:
+        lines = lines[:-1]
+
+    # 統計每行的左右邊界帶位置，使用最常出現的值
+    right_margins = [line['x1'] for line in lines]
+    right_margin_counter = Counter(right_margins)
+    majority_right = right_margin_counter.most_common(1)[0][0]  # 最常出現的左右邊界
+
+    # 第一個 criteria：檢查右邊界較小且有【】格式的行
+    headers_criterion1 = [
+        line for line in lines
+        if line['x1'] < (majority_right - 30)  # 比 majority 小兩格（約10點）
+        and '【' in line['text'] and '】' in line['text']
+    ]
+
+    # 如果第一個 criteria 沒找到，使用第二個 criteria
+    if not headers_criterion1:
+        headers_criterion2 = [
+            line for line in lines
+            if '第' in line['text'] and '條' in line['text']
+            and any(c in line['text'] for c in '一二三四五六七八九十百千')
+            and line['x1'] < (majority_right - 30)  # 比 majority 小兩格（約10點）
+        ]
+        headers = headers_criterion2
+    else:
+        headers = headers_criterion1
+
+    return headers, majority_right
+
 def detect_headers(pdf_loc, page_infos = None):
     """
     檢測PDF中的header行，以利將Insurance PDF分段
@@ -33,6 +133,7 @@ def detect_headers(pdf_loc, page_infos = None):
     [pdf_loc]: PDF檔案路徑
     [page_infos]: 考慮之頁面範圍 [start, end]
     """
+    import pdfplumber
     with pdfplumber.open(pdf_loc) as pdf:
         pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
         all_headers = []
@@ -44,33 +145,7 @@ def detect_headers(pdf_loc, page_infos = None):
             if not lines:
                 continue
 
-            # 移除最後一行（可能是頁碼）
-            if len(lines) > 1:
-                lines = lines[:-1]
-
-            # 統計每行的左右邊界帶位置，使用最常出現的值
-            right_margins = [line['x1'] for line in lines]
-            right_margin_counter = Counter(right_margins)
-            majority_right = right_margin_counter.most_common(1)[0][0]  # 最常出現的左右邊界
-
-            # 第一個 criteria：檢查右邊界較小且有【】格式的行
-            headers_criterion1 = [
-                line for line in lines
-                if line['x1'] < (majority_right - 30)  # 比 majority 小兩格（約10點）
-                and '【' in line['text'] and '】' in line['text']
-            ]
-
-            # 如果第一個 criteria 沒找到，使用第二個 criteria
-            if not headers_criterion1:
-                headers_criterion2 = [
-                    line for line in lines
-                    if '第' in line['text'] and '條' in line['text']
-                    and any(c in line['text'] for c in '一二三四五六七八九十百千')
-                    and line['x1'] < (majority_right - 30)  # 比 majority 小兩格（約10點）
-                ]
-                headers = headers_criterion2
-            else:
-                headers = headers_criterion1
+            headers, majority_right = detect_page_headers(lines)
 
             # 將找到的 headers 加入結果列表
             for header in headers:
@@ -83,69 +158,91 @@ def detect_headers(pdf_loc, page_infos = None):
                 })
     return all_headers
 
+def page_body_lines(lines):
+    """
+    移除頁眉與頁碼，回傳頁面內文的文字行
+
+    [lines]: page.extract_text_lines() 的結果 (不可為空)
+    """
+    # 移除第一行 (頁眉)
+    heights = [round(line['bottom'] - line['top'], 1) for line in lines]
+    height_counter = Counter(heights)
+    major_height = height_counter.most_common(1)[0][0] 
+    if heights[0] < major_height * 0.90:
+        lines = lines[1:]
+    
+    # 移除最後一行（頁碼）
+    if len(lines) > 1:
+        lines = lines[:-1]
+
+    return [line['text'] for line in lines]
+
 def get_chunks_by_headers(pdf_loc, page_infos = None, min_length = 8):
     """
     根據檢測到header的，將PDF文字進行chunking。過濾掉過短的chunk。
+    每一頁只開啟、抽取文字行一次，同時找出header與移除頁眉頁碼。
     
     [pdf_loc]: PDF檔案路徑
     [page_infos]: 頁面範圍 [start, end]
     [min_length]: 最小字數限制
     """
-    headers = detect_headers(pdf_loc, page_infos)
-    chunks = []
-    
+    return list(iter_chunks_by_headers(pdf_loc, page_infos, min_length))
+
+def read_body_lines(pdf_loc, page_infos = None):
+    """
+    抽取PDF所有頁面的內文文字行 (已移除頁眉頁碼)，以及所有頁面中偵測到的header文字
+    """
+    import pdfplumber
+    header_texts = set()
+    all_lines = []
+
     with pdfplumber.open(pdf_loc) as pdf:
         pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
         
-        all_lines = []
         for page in pages:
             lines = page.extract_text_lines()
             if not lines:
                 continue
-            
-            # 移除第一行 (頁眉)
-            heights = [round(line['bottom'] - line['top'], 1) for line in lines]
-            height_counter = Counter(heights)
-            major_height = height_counter.most_common(1)[0][0] 
-            if heights[0] < major_height * 0.90:
-                lines = lines[1:]
-            
-            # 移除最後一行（頁碼）
-            if len(lines) > 1:
-                lines = lines[:-1]
-                
-            all_lines.extend(line['text'] for line in lines)
-        
-        current_chunk = []
-        current_header = None
-        
-        for line in all_lines:
-            is_header = False
-            for header in headers:
-                if header['text'] == line:
-                    # 如果已經收集了文字且長度足夠，保存為一個 chunk
-                    if current_chunk and len(''.join(current_chunk)) >= min_length:
-                        chunks.append({
-                            'header': current_header,
-                            'content': '\n'.join(current_chunk)
-                        })
-                    # 開始新的 chunk
-                    current_chunk = []
-                    current_header = line
-                    is_header = True
-                    break
-                    
-            if not is_header:
-                current_chunk.append(line)
-        
-        # 添加最後一個 chunk (如果長度足夠)
-        if current_chunk and len(''.join(current_chunk)) >= min_length:
-            chunks.append({
-                'header': current_header,
-                'content': '\n'.join(current_chunk)
-            })
+
+            headers, _ = detect_page_headers(lines)
+            header_texts.update(header['text'] for header in headers)
+            all_lines.extend(page_body_lines(lines))
+    return all_lines, header_texts
+
+def iter_chunks_by_headers(pdf_loc, page_infos = None, min_length = 8):
+    """
+    get_chunks_by_headers 的 generator 版本: 逐一產生 chunk，
+    以累計長度判斷 chunk 是否過短，每個 chunk 只在產生時 join 一次
+    (header 需在所有頁面都偵測完後才能判斷，因此仍會先抽取全部文字行)
+    """
+    all_lines, header_texts = read_body_lines(pdf_loc, page_infos)
+
+    current_chunk = []
+    current_length = 0
+    current_header = None
     
-    return chunks
+    for line in all_lines:
+        if line in header_texts:
+            # 如果已經收集了文字且長度足夠，產生一個 chunk
+            if current_chunk and current_length >= min_length:
+                yield {
+                    'header': current_header,
+                    'content': '\n'.join(current_chunk)
+                }
+            # 開始新的 chunk
+            current_chunk = []
+            current_length = 0
+            current_header = line
+        else:
+            current_chunk.append(line)
+            current_length += len(line)
+    
+    # 最後一個 chunk (如果長度足夠)
+    if current_chunk and current_length >= min_length:
+        yield {
+            'header': current_header,
+            'content': '\n'.join(current_chunk)
+        }
 
 def split_content_by_length(chunks, threshold_truncate = 512):
     '''
@@ -153,56 +250,71 @@ def split_content_by_length(chunks, threshold_truncate = 512):
     [chunks]: A list of texts(chunks)
     [threshold_truncate]: int
     '''
-    
-    processed_chunks = []
-    
+    return list(iter_split_content_by_length(chunks, threshold_truncate))
+
+def iter_split_content_by_length(chunks, threshold_truncate = 512):
+    '''
+    split_content_by_length 的 generator 版本: 每個部分以文字行列表與累計長度表示，產生時才 join 一次
+    最後剩餘的部分可能與前一個部分合併，因此每個 chunk 會保留最近一個部分，確定不需合併後才產生
+    [chunks]: chunk 的 iterable
+    [threshold_truncate]: int
+    '''
     for chunk in chunks:
         header = chunk['header']
-        content = chunk['content']
-        
-        # 先依據 '。\n' 分割文字
-        parts = []
-        current_part = ""
-        
+        pending = None # 尚未產生的前一個部分 (行列表, 長度)
+        current_part, current_length = [], 0 # 每行含換行符號計算長度
+
         # 用換行符分割文本以保持原始的行結構
-        lines = content.split('\n')
-        
-        for line in lines:
+        for line in chunk['content'].split('\n'):
+            line_length = len(line) + 1
             # 如果這行結束於句點
             if line.endswith('。'):
-                current_part += line + '\n'
-                # 如果當前部分已經足夠長，或者這是內容的最後一行
-                if len(current_part) >= threshold_truncate:
-                    parts.append(current_part)
-                    current_part = ""
+                current_part.append(line)
+                current_length += line_length
+                # 如果當前部分已經足夠長
+                if current_length >= threshold_truncate:
+                    if pending is not None:
+                        yield {'header': header, 'content': ''.join(l + '\n' for l in pending[0])}
+                    pending = (current_part, current_length)
+                    current_part, current_length = [], 0
+            # 如果加上這行會超過閾值，先保存當前部分
+            elif current_part and current_length + line_length > threshold_truncate:
+                if pending is not None:
+                    yield {'header': header, 'content': ''.join(l + '\n' for l in pending[0])}
+                pending = (current_part, current_length)
+                current_part, current_length = [line], line_length
             else:
-                # 如果加上這行會超過閾值，先保存當前部分
-                if len(current_part + line + '\n') > threshold_truncate and current_part:
-                    parts.append(current_part)
-                    current_part = line + '\n'
-                else:
-                    current_part += line + '\n'
-        
-        # 處理最後剩餘的部分
+                current_part.append(line)
+                current_length += line_length
+
+        # 處理最後剩餘的部分: 如果較短，嘗試與前一個部分合併
         if current_part:
-            # 如果最後的部分較短，嘗試與前一個部分合併
-            if parts and len(current_part) < threshold_truncate/2:
-                last_part = parts[-1]
-                if len(last_part + current_part) <= threshold_truncate:
-                    parts[-1] = last_part + current_part
-                else:
-                    parts.append(current_part)
+            if pending is not None and current_length < threshold_truncate / 2 and pending[1] + current_length <= threshold_truncate:
+                pending = (pending[0] + current_part, pending[1] + current_length)
             else:
-                parts.append(current_part)
-        
-        # 儲存處理後的chunk
-        for part in parts:
-            processed_chunks.append({
-                'header': header,
-                'content': part,  
-            })
-        
-    return processed_chunks
+                if pending is not None:
+                    yield {'header': header, 'content': ''.join(l + '\n' for l in pending[0])}
+                pending = (current_part, current_length)
+        if pending is not None:
+            yield {'header': header, 'content': ''.join(l + '\n' for l in pending[0])}
+
+def iter_insurance_chunks(pdf_loc, page_infos = None):
+    '''
+    讀取單個PDF，逐一產生 chunking 後的文字 (header 與內容合併，移除換行)
+    [pdf_loc]: PDF路徑
+    [page_infos]: 考慮的PDF頁面
+    '''
+    for chunk in iter_split_content_by_length(iter_chunks_by_headers(pdf_loc, page_infos, 8), 512):
+        text = chunk['content'].replace('\n', '')
+        yield chunk['header'] + text if chunk['header'] is not None else text
+
+def read_insurance_pdf(pdf_loc, page_infos = None):
+    '''
+    讀取單個PDF，對其中文字進行Chunking
+    [pdf_loc]: PDF路徑
+    [page_infos]: 考慮的PDF頁面
+    '''
+    return list(iter_insurance_chunks(pdf_loc, page_infos))
 
 def get_top_k_indices_insurance(insurance_embeddings, query_embedding, top_k=1):
     '''
@@ -211,6 +323,8 @@ def get_top_k_indices_insurance(insurance_embeddings, query_embedding, top_k=1):
     [insuracne_embeddings]: Dict, 每一筆insurance PDF中，每個chunk的embeddings，shape:{insurance IDs : array(#insurance chunk, #embedding dim)}
     [query_embeddings]: user query的embedding，shape:(1, #embedding dim)
     '''
+    import numpy as np
+    from sklearn.metrics.pairwise import cosine_similarity
     # 儲存每個key的最大相似度
     similarities_dict = {}
     query_2d = query_embedding.reshape(1, -1)
@@ -224,6 +338,74 @@ def get_top_k_indices_insurance(insurance_embeddings, query_embedding, top_k=1):
     sorted_keys = sorted(similarities_dict.items(), key=lambda x: x[1], reverse=True)
     return [key for key, sim in sorted_keys[:top_k]]
 
+def get_top_k_docs_insurance(chunk_embeddings, doc_offsets, doc_ids, query_embeddings, candidate_lists=None, top_k=1):
+    '''
+    以一次矩陣乘法計算所有 query 與所有 chunk 的 cosine similarity，
+    再以 np.maximum.reduceat 取得每份文件的最大相似度，排序並取出top_k份文件
+
+    [chunk_embeddings]: 所有文件的chunk embeddings 串接成的矩陣 (已 L2 正規化)，shape:(#chunks, #embedding dim)
+    [doc_offsets]: 每份文件在 chunk_embeddings 中的起始位置，shape:(#docs + 1,)
+    [doc_ids]: 每份文件的編號，長度為 #docs
+    [query_embeddings]: user query的embeddings，shape:(#query, #embedding dim) 或 (#embedding dim,)
+    [candidate_lists]: 每個query的candidate文件編號，None 則考慮所有文件
+    [top_k]: 每個query回傳幾份文件
+    '''
+    import numpy as np
+    query_embeddings = l2_normalize(np.atleast_2d(query_embeddings))
+
+    # 所有 query 與所有 chunk 的相似度，shape:(#query, #chunks)
+    similarities = query_embeddings @ np.asarray(chunk_embeddings).T
+    doc_max = doc_max_similarities(similarities, doc_offsets, len(doc_ids))
+    return rank_docs(doc_max, doc_ids, candidate_lists, top_k)
+
+def doc_max_similarities(similarities, doc_offsets, n_docs):
+    '''
+    以 np.maximum.reduceat 取得每份文件 chunk 的最大相似度，沒有chunk的文件為 -inf
+    回傳 shape:(#query, #docs)
+
+    [similarities]: query 與 chunk 的相似度，shape:(#query, #chunks)
+    [doc_offsets]: 每份文件在 chunk 中的起始位置，shape:(#docs + 1,)
+    [n_docs]: 文件數量
+    '''
+    import numpy as np
+    doc_offsets = np.asarray(doc_offsets)
+    counts = np.diff(doc_offsets)
+    non_empty = counts > 0
+    doc_max = np.full((len(similarities), n_docs), -np.inf, dtype=np.float32)
+    if non_empty.any():
+        doc_max[:, non_empty] = np.maximum.reduceat(similarities, doc_offsets[:-1][non_empty], axis=1)
+    return doc_max
+
+def rank_docs(doc_max, doc_ids, candidate_lists=None, top_k=1):
+    '''
+    依每份文件的相似度，在每個query的candidate文件中取出top_k份文件 (同分時保留candidate原本的順序)
+    不在 store 中的 candidate (例如解析失敗、記錄於 manifest failures 的PDF) 視為 -inf 排在最後，並印出警告
+
+    [doc_max]: 每份文件的相似度，shape:(#query, #docs)
+    [doc_ids]: 每份文件的編號
+    [candidate_lists]: 每個query的candidate文件編號，None 則考慮所有文件
+    [top_k]: 每個query回傳幾份文件
+    '''
+    import numpy as np
+    if candidate_lists is None:
+        candidate_lists = [doc_ids] * len(doc_max)
+    doc_index = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+
+    results = []
+    missing = set()
+    for q, candidates in enumerate(candidate_lists):
+        positions = np.array([doc_index.get(doc_id, -1) for doc_id in candidates], dtype=np.int64)
+        candidate_scores = doc_max[q, positions]
+        if (positions < 0).any():
+            candidate_scores[positions < 0] = -np.inf
+            missing.update(doc_id for doc_id, position in zip(candidates, positions) if position < 0)
+        # 依相似度排序，同分時保留candidate原本的順序
+        order = np.argsort(-candidate_scores, kind='stable')[:top_k]
+        results.append([candidates[i] for i in order])
+    if missing:
+        print(f'Warning: candidate docs not in the embedding store (failed or missing ingestion): {sorted(missing)}')
+    return results
+
 
 ############################################## Finance ##############################################
 def encode_image(image_path):
@@ -233,70 +415,260 @@ def encode_image(image_path):
     '''
     with open(image_path, "rb") as image_file:
         return base64.b64encode(image_file.read()).decode('utf-8')
+
+
+def resized_image_size(width, height, max_dimension=1568, max_megapixels=1.15):
+    '''
+    依 Anthropic API 的影像限制 (長邊不超過 1568 px、不超過 1.15 megapixels) 計算縮放後的尺寸
+    與 Preprocess/finance.py 的 resize_image_with_constraints 規則相同
+    '''
+    scale_ratio = min(1, max_dimension / width, max_dimension / height)
+    new_width = int(width * scale_ratio)
+    new_height = int(height * scale_ratio)
+
+    megapixels = (new_width * new_height) / 1_000_000
+    if megapixels > max_megapixels:
+        additional_scale = math.sqrt(max_megapixels / megapixels)
+        new_width = int(new_width * additional_scale)
+        new_height = int(new_height * additional_scale)
+    return new_width, new_height
+
+
+def estimate_image_tokens(width, height):
+    '''
+    估計一張影像的 input tokens: (縮放後的 width * height) / 750
+    '''
+    new_width, new_height = resized_image_size(width, height)
+    return math.ceil(new_width * new_height / 750)
+
+
+def pack_images_by_budget(names, image_tokens, token_budget, max_images=None):
+    '''
+    依排名 (第一階段 BM25 分數由高到低) 選取影像，使影像 tokens 總和不超過 token_budget
+    放不下的影像會被略過，繼續嘗試排名較後 (可能較小) 的影像；排名第一的影像一定保留
+
+    [names]: 依分數排序的影像名稱
+    [image_tokens]: function，影像名稱 --> 估計的 tokens
+    [token_budget]: 影像 tokens 總和上限
+    [max_images]: 影像數量上限，None 表示不限制
+    '''
+    selected, used = [], 0
+    for name in names:
+        if max_images is not None and len(selected) >= max_images:
+            break
+        tokens = image_tokens(name)
+        if selected and used + tokens > token_budget:
+            continue
+        selected.append(name)
+        used += tokens
+    return selected, used
     
 
-def load_docs(image_folder, c_ids, use_first_stage, truncate_num):
+def parse_image_name(filename):
+    '''
+    從影像檔名提取 (c_id, 頁碼)，例如 "123_p4.jpg" --> ("123", 4)
+    '''
+    parts = os.path.splitext(filename)[0].split('_p')
+    if len(parts) == 2:
+        return parts[0], int(parts[1])
+    else:
+        raise ValueError('Do not contain _pxx')
+
+
+class ImagePayloadCache:
+    '''
+    Finance 影像的檔名索引與 base64 payload cache
+    - 檔名索引只在建立時掃描一次資料夾: c_id --> 依頁碼排序的影像名稱
+    - 已編碼的 base64 放在記憶體 LRU 中，總大小不超過 max_bytes
+    - (可選) store_dir 中預先編碼好的 payload (見 build_image_payload_store)，以 mmap 讀取
+    '''
+
+    def __init__(self, image_folder, max_bytes=512 * 1024 * 1024, store_dir=None):
+        '''
+        [image_folder]: 存放所有前處理後影像的資料夾
+        [max_bytes]: 記憶體 LRU 的 base64 總大小上限
+        [store_dir]: 預先編碼的 payload store 路徑，None 或不存在則每次從影像檔編碼
+        '''
+        self.image_folder = image_folder
+        self.max_bytes = max_bytes
+        self.lru = OrderedDict()
+        self.lru_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sizes = {}
+        self.refresh_index()
+
+        self.store_index, self.store_blob = {}, None
+        if store_dir and os.path.exists(os.path.join(store_dir, 'index.json')):
+            with open(os.path.join(store_dir, 'index.json'), 'r', encoding='utf8') as f:
+                self.store_index = json.load(f)
+            if self.store_index:
+                with open(os.path.join(store_dir, 'payloads.b64'), 'rb') as f:
+                    self.store_blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def refresh_index(self):
+        '''
+        重新掃描影像資料夾 (資料夾內容改變時呼叫)
+        '''
+        self.files = {} # 影像名稱 (不含副檔名) --> (檔名, size, mtime)
+        pages = {}
+        with os.scandir(self.image_folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.jpg') or not entry.is_file():
+                    continue
+                try:
+                    c_id, page = parse_image_name(entry.name)
+                except ValueError:
+                    continue
+                stat = entry.stat()
+                base_name = os.path.splitext(entry.name)[0]
+                self.files[base_name] = (entry.name, stat.st_size, stat.st_mtime_ns)
+                pages.setdefault(c_id, []).append((page, base_name))
+        self.doc_pages = {c_id: [base_name for _, base_name in sorted(items)] for c_id, items in pages.items()}
+
+    def _read(self, base_name):
+        filename, size, mtime = self.files[base_name]
+        stored = self.store_index.get(base_name)
+        # 只有影像檔未改變時才使用預先編碼的 payload
+        if stored is not None and stored['size'] == size and stored['mtime'] == mtime:
+            return self.store_blob[stored['offset']:stored['offset'] + stored['length']].decode('ascii')
+        return encode_image(os.path.join(self.image_folder, filename))
+
+    def image_tokens(self, base_name):
+        '''
+        估計影像的 input tokens (只讀取影像 header 取得尺寸)
+        '''
+        if base_name not in self.sizes:
+            filename, size, mtime = self.files[base_name]
+            stored = self.store_index.get(base_name)
+            if stored is not None and stored['size'] == size and stored['mtime'] == mtime and 'width' in stored:
+                self.sizes[base_name] = (stored['width'], stored['height'])
+            else:
+                from PIL import Image
+                with Image.open(os.path.join(self.image_folder, filename)) as img:
+                    self.sizes[base_name] = img.size
+        return estimate_image_tokens(*self.sizes[base_name])
+
+    def get(self, base_name):
+        '''
+        取得影像的 base64 payload
+
+        [base_name]: 影像名稱 (不含副檔名)，例如 "123_p4"
+        '''
+        with self.lock:
+            payload = self.lru.get(base_name)
+            if payload is not None:
+                self.lru.move_to_end(base_name)
+                self.hits += 1
+                return payload
+            self.misses += 1
+
+        payload = self._read(base_name)
+        with self.lock:
+            if base_name not in self.lru and len(payload) <= self.max_bytes:
+                self.lru[base_name] = payload
+                self.lru_bytes += len(payload)
+                while self.lru_bytes > self.max_bytes:
+                    _, evicted = self.lru.popitem(last=False)
+                    self.lru_bytes -= len(evicted)
+        return payload
+
+    def report(self):
+        total = self.hits + self.misses
+        print(f'Image payload cache: {self.hits}/{total} hits, {len(self.lru)} images, {self.lru_bytes / 1024 ** 2:.1f} MB')
+
+
+def build_image_payload_store(image_folder, store_dir):
+    '''
+    將資料夾內所有影像預先編碼成 base64，存成 payloads.b64 (所有 payload 串接) 與 index.json (offset/length)
+    已存在的 store 只會 append 新增或改變的影像
+
+    [image_folder]: 存放所有前處理後影像的資料夾
+    [store_dir]: store 輸出路徑
+    '''
+    from PIL import Image
+    os.makedirs(store_dir, exist_ok=True)
+    index_path = os.path.join(store_dir, 'index.json')
+    store_index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf8') as f:
+            store_index = json.load(f)
+
+    files = ImagePayloadCache(image_folder, max_bytes=0).files
+    store_index = {name: info for name, info in store_index.items() if name in files}
+    stale = [name for name, (_, size, mtime) in files.items()
+             if name not in store_index or (store_index[name]['size'], store_index[name]['mtime']) != (size, mtime)]
+
+    with open(os.path.join(store_dir, 'payloads.b64'), 'ab') as f:
+        offset = f.tell()
+        for name in sorted(stale):
+            filename, size, mtime = files[name]
+            payload = encode_image(os.path.join(image_folder, filename)).encode('ascii')
+            with Image.open(os.path.join(image_folder, filename)) as img:
+                width, height = img.size
+            f.write(payload)
+            store_index[name] = {'offset': offset, 'length': len(payload), 'size': size, 'mtime': mtime,
+                                 'width': width, 'height': height}
+            offset += len(payload)
+
+    with open(index_path + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(store_index, f)
+    os.replace(index_path + '.tmp', index_path)
+    print(f'Image payload store: {len(stale)} encoded, {len(store_index)} total')
+
+
+_payload_caches = {}
+_payload_caches_lock = threading.Lock()
+
+def get_image_payload_cache(image_folder, max_bytes=512 * 1024 * 1024, store_dir=None):
+    '''
+    取得 (image_folder, max_bytes, store_dir) 對應的 ImagePayloadCache，相同參數在程式中只建立一次
+    (參數不同時建立另一個 cache，不會沿用先建立、設定不同的 cache)
+
+    [image_folder]: 影像資料夾
+    [max_bytes]: LRU 保留的 base64 總大小上限
+    [store_dir]: build_image_payload_store 建立的 store，None 則每次從影像檔編碼
+    '''
+    key = (os.path.abspath(image_folder), max_bytes, os.path.abspath(store_dir) if store_dir else None)
+    with _payload_caches_lock:
+        if key not in _payload_caches:
+            _payload_caches[key] = ImagePayloadCache(image_folder, max_bytes, store_dir)
+        return _payload_caches[key]
+
+
+def load_docs(image_folder, c_ids, use_first_stage, truncate_num, payload_cache=None, token_budget=None):
     '''
     Load all candidate images(base64 format) and filenames
     
     [image_folder]: path that stores all preprocessed images 
     [c_ids]: candidate 影像
     [use_first_stage]: (bool)，是否有使用第一階段得到的BM25分數進行篩選?
-    [truncate_num]: 最多回傳多少張影像
+    [truncate_num]: 最多回傳多少張不重複的影像 (None 表示不限制)
+    [payload_cache]: ImagePayloadCache，None 則使用 image_folder 對應的共用 cache
+    [token_budget]: 影像 tokens 總和上限 (只在 use_first_stage 時使用)，None 則只依 truncate_num 截斷
     '''
-    
-    result_dict = {}
-
-    def sort_key(filename):
-        # 從檔名中提取 c_id 和 p_x 頁碼
-        parts = os.path.splitext(filename)[0].split('_p')
-        if len(parts) == 2:
-            return (int(parts[0]), int(parts[1]))
-        else:
-            raise ValueError('Do not contain _pxx')
+    if payload_cache is None:
+        payload_cache = get_image_payload_cache(image_folder)
 
     if use_first_stage:
-        # 首先對所有符合 c_ids 的檔案進行收集和排序
-        all_files = []
-        for c_id in c_ids:
-            for filename in os.listdir(image_folder):
-                if filename.startswith(f"{c_id}") and filename.endswith('.jpg'):
-                    all_files.append(filename)
+        # c_ids 為第一階段排序後的頁面 (例如 "123_p4")，依排序保留前 truncate_num 張
+        # 重複的頁面只保留排序最前面的一次，不佔用 truncate_num 的名額 (原本的實作先截斷再去除重複，c_ids 有重複時回傳的影像較少)
+        all_files = list(dict.fromkeys(c_id for c_id in c_ids if c_id in payload_cache.files))
         print(all_files)
-        if len(all_files) > truncate_num:
+        if token_budget is not None:
+            n_candidates = len(all_files)
+            all_files, used = pack_images_by_budget(all_files, payload_cache.image_tokens, token_budget, truncate_num)
+            print(f'依 token budget 選取 {len(all_files)}/{n_candidates} 張影像 (估計 {used}/{token_budget} image tokens)')
+        elif truncate_num is not None and len(all_files) > truncate_num:
             print(f'Truncate 過多的影像數量 ({len(all_files)})')
             all_files = all_files[:truncate_num]
             print(all_files)
-
-        # 排序檔案名稱
-        all_files.sort(key=sort_key)
-
-        # 按排序後的順序處理檔案
-        for filename in all_files:
-            image_path = os.path.join(image_folder, filename)
-            if os.path.isfile(image_path):
-                base_name = os.path.splitext(filename)[0]
-                result_dict[base_name] = encode_image(image_path)
-
     else:
-        # 收集所有符合條件的檔案名稱並排序
-        all_files = []
-        for c_id in c_ids:
-            for filename in os.listdir(image_folder):
-                if filename.startswith(f"{c_id}_p") and filename.endswith('.jpg'):
-                    all_files.append(filename)
-
-        # 排序檔案名稱
-        all_files.sort(key=sort_key)
-
-        # 按排序後的順序處理檔案
-        for filename in all_files:
-            image_path = os.path.join(image_folder, filename)
-            if os.path.isfile(image_path):
-                base_name = os.path.splitext(filename)[0]
-                result_dict[base_name] = encode_image(image_path)
-
-    return list(result_dict.values()), list(result_dict.keys())
-
+        # c_ids 為文件編號，收集每份文件的所有頁面
+        all_files = list(dict.fromkeys(name for c_id in c_ids for name in payload_cache.doc_pages.get(str(c_id), [])))
 
+    # 排序檔案名稱
+    all_files.sort(key=lambda name: (int(parse_image_name(name)[0]), parse_image_name(name)[1]))
 
+    return [payload_cache.get(name) for name in all_files], all_files
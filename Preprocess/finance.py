@@ -1,13 +1,24 @@
 import os
 import fitz  
 import os
+import io
+import time
 import glob
-import pdfplumber
+import tempfile
+import argparse
 import subprocess
+import multiprocessing
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pdf2image import convert_from_path
 from tqdm import tqdm
 from PIL import Image
 import math
+from manifest import PreprocessManifest, page_ref, parse_page_ref
+
+# ocrmypdf 的併發上限 (由 run_pipeline 在每個 worker process 中設定)
+_ocr_semaphore = None
 
 
 def split_pdf_by_pages(input_folder, output_dir):
@@ -24,72 +35,131 @@ def split_pdf_by_pages(input_folder, output_dir):
     for filename in os.listdir(input_folder):
         print(filename)
         if filename.endswith('.pdf'):
-            input_pdf = os.path.join(input_folder, filename)
+            split_pdf(os.path.join(input_folder, filename), output_dir)
+
+def split_pdf(input_pdf, output_dir):
+    '''
+    Split one PDF document to one-page PDFs, return paths of the one-page PDFs
+
+    [input_pdf]: path of PDF document
+    [output_dir]: output folder for storing PDF documents after splitting
+    '''
+    # 取得原始PDF檔名（不含擴展名）
+    base_name = os.path.splitext(os.path.basename(input_pdf))[0]
+
+    output_pdfs = []
+    pdf_document = fitz.open(input_pdf)
+    for page_num in range(len(pdf_document)):
+        pdf_writer = fitz.open()  # 新建一個空的PDF
+        pdf_writer.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)  # 插入單頁
+
+        # 使用原始檔名加上 _p? 的格式
+        output_pdf = os.path.join(output_dir, f'{base_name}_p{page_num + 1}.pdf')
+        pdf_writer.save(output_pdf)  # 儲存為新的PDF文件
+        pdf_writer.close()
+        output_pdfs.append(output_pdf)
 
-            # 取得原始PDF檔名（不含擴展名）
-            base_name = os.path.splitext(filename)[0]
+    pdf_document.close()
+    return output_pdfs
 
-            pdf_document = fitz.open(input_pdf)
-            for page_num in range(len(pdf_document)):
-                pdf_writer = fitz.open()  # 新建一個空的PDF
-                pdf_writer.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)  # 插入單頁
+def split_pdf_in_memory(input_pdf):
+    '''
+    不寫出 one-page PDF，只回傳每一頁的 page ref (見 manifest.page_ref)，由後續 stage 直接從原始PDF讀取該頁
+    '''
+    with fitz.open(input_pdf) as pdf_document:
+        return [page_ref(input_pdf, page_num + 1) for page_num in range(len(pdf_document))]
 
-                # 使用原始檔名加上 _p? 的格式
-                output_pdf = os.path.join(output_dir, f'{base_name}_p{page_num + 1}.pdf')
-                pdf_writer.save(output_pdf)  # 儲存為新的PDF文件
-                pdf_writer.close()
+def load_page_pdf(item):
+    '''
+    page ref --> 只含該頁的PDF (bytes)；一般的PDF路徑則直接回傳路徑
+    '''
+    source_pdf, page_num = parse_page_ref(item)
+    if page_num is None:
+        return item
+    with fitz.open(source_pdf) as pdf_document, fitz.open() as pdf_writer:
+        pdf_writer.insert_pdf(pdf_document, from_page=page_num - 1, to_page=page_num - 1)
+        return pdf_writer.tobytes()
+
+def classify_pages(doc, large_image_ratio=0.8):
+    '''
+    判斷每一頁是否為掃描頁面 (有單張圖片佔頁面面積超過 large_image_ratio)，每頁只讀取一次圖片資訊
 
-            pdf_document.close()
+    [doc]: fitz document
+    '''
+    scanned = []
+    for page in doc:
+        page_area = page.rect.width * page.rect.height
+        image_areas = [fitz.Rect(info['bbox']).get_area() for info in page.get_image_info()]
+        scanned.append(any(area / page_area > large_image_ratio for area in image_areas))
+    return scanned
+
+def ocr_pdf(input_pdf, output_pdf, pages, ocr_lang='chi_tra'):
+    '''
+    只對指定頁面進行OCR (其餘頁面保持不變)
+    有安裝 ocrmypdf 套件時直接在目前的 process 中呼叫 (pipeline 的 worker process 會重複使用，不需每個檔案啟動一次 ocrmypdf)，
+    否則呼叫 ocrmypdf 指令
 
-def preprocess_pdf(input_pdf, output_pdf, page_infos=None):
+    [input_pdf]: path of pdf (或PDF內容 bytes)
+    [output_pdf]: path of pdf to save after OCR
+    [pages]: 需要OCR的頁面 (從0開始)
     '''
-    對於掃描得到的pdf --> 進行OCR
-    對於非掃描得到的pdf --> 移除頁面中的影像(很可能是印章，會影響模型判讀)
+    page_list = ','.join(str(page + 1) for page in pages)
+    # 平行處理時受 _ocr_semaphore 限制同時執行的數量
+    with _ocr_semaphore or nullcontext():
+        try:
+            import ocrmypdf
+        except ImportError:
+            ocrmypdf = None
+        if ocrmypdf is not None:
+            ocrmypdf.ocr(io.BytesIO(input_pdf) if isinstance(input_pdf, bytes) else input_pdf, output_pdf,
+                         language=ocr_lang, force_ocr=True, pages=page_list, jobs=1, use_threads=True, progress_bar=False)
+        elif isinstance(input_pdf, bytes):
+            # ocrmypdf 指令需要輸入檔案
+            with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp_pdf:
+                tmp_pdf.write(input_pdf)
+                tmp_pdf.flush()
+                subprocess.run(["ocrmypdf", "--force-ocr", "--pages", page_list, "-l", ocr_lang, tmp_pdf.name, output_pdf], check=True)
+        else:
+            subprocess.run(["ocrmypdf", "--force-ocr", "--pages", page_list, "-l", ocr_lang, input_pdf, output_pdf], check=True)
+
+def preprocess_pdf(input_pdf, output_pdf, page_infos=None, large_image_ratio=0.8, ocr_lang='chi_tra'):
+    '''
+    對於掃描得到的頁面 --> 進行OCR
+    對於非掃描得到的頁面 --> 移除頁面中的影像(很可能是印章，會影響模型判讀)
+    每一頁各自判斷，只有掃描頁面會進行OCR；回傳進行OCR的頁數
     
-    [input_pdf]: path of pdf to preprocess
+    [input_pdf]: path of pdf to preprocess (或PDF內容 bytes)
     [output_pdf]: path of pdf to save after preprocess
+    [page_infos]: 只處理 [start, end) 範圍內的頁面
+    [large_image_ratio]: 圖片佔頁面面積超過此比例時視為掃描頁面
+    [ocr_lang]: ocrmypdf 的語言
     '''
-    # 首先打開pdfplumber以提取圖像信息
-    with pdfplumber.open(input_pdf) as pdf:
-        # 檢查每一頁
-        pages = pdf.pages[page_infos[0]:page_infos[1]] if page_infos else pdf.pages
-        # for page_number in range(len(pdf.pages)):
-        for page_number, page in enumerate(pages): 
-            # page = pdf.pages[page_number]
-            # 獲取頁面尺寸
-            page_width = page.width
-            page_height = page.height
-            page_area = page_width * page_height
-            # print(f"頁面尺寸: {page_width} x {page_height}")
-
-            # 獲取頁面中的所有圖片
-            images = page.images
-
-            # 如果有某張圖片很大，代表這個PDF很可能是掃描得到的，不進行圖像刪除
-            for img in images:
-                img_width = img['x1'] - img['x0']  # 圖片的寬度
-                img_height = img['y1'] - img['y0']  # 圖片的高度
-                img_area = img_width * img_height
-
-                # 計算圖片佔頁面面積的比例
-                if img_area / page_area > 0.8:
-                    print(f"頁面 {page_number + 1} 是一張大圖片，直接對其進行OCR")
-                    # 使用subprocess呼叫ocrmypdf
-                    subprocess.run(["ocrmypdf", "--force-ocr", "-l", "chi_tra", input_pdf, output_pdf], check=True)
-                    return  # 退出函數，不進行圖像移除
-
-            # 打開該頁面進行圖像移除
-            with fitz.open(input_pdf) as doc:
-                pdf_page = doc[page_number]
-
-                # 移除頁面中的所有圖片
-                for img_index in range(len(images)):
-                    print(f"移除第{img_index + 1}張影像")
-                    xref = pdf_page.get_images(full=True)[img_index][0]  # 獲取圖片的xref
-                    pdf_page.delete_image(xref)
-
-                # 保存修改後的PDF
-                doc.save(output_pdf)
+    with (fitz.open(stream=input_pdf, filetype='pdf') if isinstance(input_pdf, bytes) else fitz.open(input_pdf)) as doc:
+        page_numbers = range(len(doc))[page_infos[0]:page_infos[1]] if page_infos else range(len(doc))
+        scanned = classify_pages(doc, large_image_ratio)
+
+        ocr_pages = []
+        for page_number in page_numbers:
+            if scanned[page_number]:
+                print(f"頁面 {page_number + 1} 是一張大圖片，對其進行OCR")
+                ocr_pages.append(page_number)
+                continue
+
+            # 移除頁面中的所有圖片 (每頁只讀取一次圖片列表)
+            pdf_page = doc[page_number]
+            xrefs = list(dict.fromkeys(image[0] for image in pdf_page.get_images(full=True)))
+            for img_index, xref in enumerate(xrefs):
+                print(f"移除第{img_index + 1}張影像")
+                pdf_page.delete_image(xref)
+
+        if not ocr_pages:
+            # 保存修改後的PDF
+            doc.save(output_pdf)
+            return 0
+        pdf_bytes = doc.tobytes()
+
+    ocr_pdf(pdf_bytes, output_pdf, ocr_pages, ocr_lang)
+    return len(ocr_pages)
 
 def process_all_pdfs(input_folder, output_folder):
     '''
@@ -112,6 +182,8 @@ def process_all_pdfs(input_folder, output_folder):
         preprocess_pdf(pdf_file, output_pdf)
 
 
+poppler_path = r"C:\Users\arthu\Downloads\Release-24.07.0-0\poppler-24.07.0\Library\bin" # change to your own poppler path here !
+
 def pdf_to_images(input_folder, output_folder):
     '''
     Conver one-page PDF to image(.jpeg)
@@ -120,23 +192,50 @@ def pdf_to_images(input_folder, output_folder):
     '''
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    poppler_path = r"C:\Users\arthu\Downloads\Release-24.07.0-0\poppler-24.07.0\Library\bin" # change to your own poppler path here !
 
     for filename in tqdm(os.listdir(input_folder)):
         if filename.endswith(".pdf"):
-            pdf_path = os.path.join(input_folder, filename)
-            
-            images = convert_from_path(pdf_path, poppler_path=poppler_path)
-            pdf_name = os.path.splitext(filename)[0]
+            pdf_to_image(os.path.join(input_folder, filename), output_folder)
+
+def pdf_to_image(pdf_path, output_folder):
+    '''
+    Conver the first page of a one-page PDF to image(.jpeg), return path of the image
+    '''
+    images = convert_from_path(pdf_path, poppler_path=poppler_path)
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
 
-            output_image_path = os.path.join(output_folder, f"{pdf_name}.jpg")
-            images[0].save(output_image_path, "JPEG")
+    output_image_path = os.path.join(output_folder, f"{pdf_name}.jpg")
+    images[0].save(output_image_path, "JPEG")
+    return output_image_path
+
+def render_pdf_direct(pdf_path, output_folder, dpi=200, max_dimension=1568, max_megapixels=1.15):
+    '''
+    以 PyMuPDF 直接將 one-page PDF 渲染成 resize 後尺寸的影像(.jpeg)，不產生原尺寸影像，也不需再 decode / resize
+    目標尺寸與 pdf2image (預設 200 dpi) 轉出的影像經過 resize_image_with_constraints 後的尺寸相同 (差距在 1 px 內)
+
+    [pdf_path]: path of one-page pdf
+    [output_folder]: path of images to save
+    [dpi]: 對應 pdf2image 的解析度，用以計算原尺寸
+    '''
+    with fitz.open(pdf_path) as doc:
+        page = doc[0]
+        original_width = round(page.rect.width * dpi / 72)
+        original_height = round(page.rect.height * dpi / 72)
+        new_width, new_height = resized_size(original_width, original_height, max_dimension, max_megapixels)
+        matrix = fitz.Matrix(new_width / page.rect.width, new_height / page.rect.height)
+        pix = page.get_pixmap(matrix=matrix, alpha=False, colorspace=fitz.csRGB)
+
+    img = Image.frombytes('RGB', (pix.width, pix.height), pix.samples)
+    if img.size != (new_width, new_height):
+        # 浮點誤差可能使邊長差 1 px
+        img = img.resize((new_width, new_height))
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    output_image_path = os.path.join(output_folder, f"{pdf_name}.jpg")
+    img.save(output_image_path, "JPEG")
+    return output_image_path
         
 
-def resize_image_with_constraints(img, max_dimension=1568, max_megapixels=1.15):
-   # 獲取原始尺寸
-   original_width, original_height = img.size
-   
+def resized_size(original_width, original_height, max_dimension=1568, max_megapixels=1.15):
    # 計算哪一邊需要縮放到 1568
    width_ratio = max_dimension / original_width
    height_ratio = max_dimension / original_height
@@ -160,7 +259,12 @@ def resize_image_with_constraints(img, max_dimension=1568, max_megapixels=1.15):
        new_width = int(new_width * additional_scale)
        new_height = int(new_height * additional_scale)
    
-   return img.resize((new_width, new_height))
+   return new_width, new_height
+
+def resize_image_with_constraints(img, max_dimension=1568, max_megapixels=1.15):
+   # 獲取原始尺寸
+   original_width, original_height = img.size
+   return img.resize(resized_size(original_width, original_height, max_dimension, max_megapixels))
 
 def resize_images_in_folder(input_folder, output_folder):
    # 確保輸出資料夾存在
@@ -203,24 +307,239 @@ def resize_images_in_folder(input_folder, output_folder):
    print(f"處理失敗: {errors} 張圖片")
 
 
+def resize_image(input_path, output_path, max_dimension=1568, max_megapixels=1.15):
+   '''
+   Resize one image with resize_image_with_constraints, return output_path
+   '''
+   with Image.open(input_path) as img:
+       resized_img = resize_image_with_constraints(img, max_dimension, max_megapixels)
+       resized_img.save(output_path)
+   return output_path
+
 
+############################################## Pipeline ##############################################
+STAGES = ['split', 'preprocess', 'render', 'resize']
 
-# Step 1: Split every finance PDF to one-page
-input_folder = '../reference/finance'
-output_dir = '../reference/finance_split'
-split_pdf_by_pages(input_folder, output_dir)
+# 各 stage 的參數，記錄於 manifest 中；參數改變時該 stage 及其後的 stage 會重新處理
+# 原本的流程: 寫出 one-page PDF，以 pdf2image 轉成原尺寸影像後再 resize
+STAGE_PARAMS = {
+    'split': {'in_memory': False},
+    'preprocess': {'large_image_ratio': 0.8, 'ocr_lang': 'chi_tra'},
+    'render': {'renderer': 'pdf2image', 'format': 'JPEG'},
+    'resize': {'max_dimension': 1568, 'max_megapixels': 1.15},
+}
 
-# Step 2: Preprocess every one-page PDF (OCR or Remove Stamp)
-input_folder = '../reference/finance_split/'  
-output_folder = '../reference/processed_finance/processed_finance_pdf'  
-process_all_pdfs(input_folder, output_folder)
+# Direct 流程: 不寫出 one-page PDF，以 PyMuPDF 直接渲染成 resize 後的尺寸 (不需 resize stage)
+DIRECT_STAGE_PARAMS = {
+    'split': {'in_memory': True},
+    'preprocess': STAGE_PARAMS['preprocess'],
+    'render': {'renderer': 'fitz', 'format': 'JPEG', 'dpi': 200, **STAGE_PARAMS['resize']},
+}
 
-# Step 3: .pdf --> .jpg 
-intput_folder = '../reference/processed_finance/processed_finance_pdf'  
-output_folder = '../reference/processed_finance/processed_finance_image'
-pdf_to_images(input_folder, output_folder)
+def active_stages(stage_params):
+    return [stage for stage in STAGES if stage in stage_params]
 
-# Step 4: Resize to reduce tokens needed when using Antropic API
-input_folder = './reference/processed_finance/processed_finance_image'
-output_folder = './reference/processed_finance/processed_finance_image_resize'
-resize_images_in_folder(input_folder, output_folder)
+def _init_worker(ocr_semaphore):
+    global _ocr_semaphore
+    _ocr_semaphore = ocr_semaphore
+
+def _run_stage(stage, path, output_dirs, stage_params):
+    '''
+    在 worker process 中執行單一 stage，回傳 (下一個 stage 的輸入, 耗時, OCR的頁數)
+    '''
+    start = time.perf_counter()
+    params = stage_params[stage]
+    ocr_pages = 0
+    if stage == 'split':
+        outputs = split_pdf_in_memory(path) if params['in_memory'] else split_pdf(path, output_dirs['split'])
+    elif stage == 'preprocess':
+        output_pdf = os.path.join(output_dirs['preprocess'], f'{_page_name(path)}.pdf')
+        ocr_pages = preprocess_pdf(load_page_pdf(path), output_pdf,
+                                   large_image_ratio=params['large_image_ratio'], ocr_lang=params['ocr_lang'])
+        outputs = [output_pdf]
+    elif stage == 'render' and params['renderer'] == 'fitz':
+        outputs = [render_pdf_direct(path, output_dirs['resize'], params['dpi'], params['max_dimension'], params['max_megapixels'])]
+    elif stage == 'render':
+        outputs = [pdf_to_image(path, output_dirs['render'])]
+    else:
+        outputs = [resize_image(path, os.path.join(output_dirs['resize'], os.path.basename(path)),
+                                params['max_dimension'], params['max_megapixels'])]
+    return outputs, time.perf_counter() - start, ocr_pages
+
+def _page_name(path):
+    source_pdf, page_num = parse_page_ref(path)
+    if page_num is not None:
+        return f'{os.path.splitext(os.path.basename(source_pdf))[0]}_p{page_num}'
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _plan_incremental(manifest, source_files, ready, output_dirs, stage_params):
+    '''
+    比對 manifest 與目前的原始PDF，決定每份PDF/每一頁要從哪個 stage 開始處理，並刪除已移除或改變的PDF的舊輸出
+    回傳 {原始PDF檔名: hash} (需要重新切頁的PDF)
+    '''
+    stages = active_stages(stage_params)
+    current = {os.path.basename(path): path for path in source_files}
+    removed_outputs = []
+    for name in list(manifest.sources):
+        if name not in current:
+            removed_outputs.extend(manifest.remove_source(name))
+
+    to_split = {}
+    skipped = 0
+    for name, path in current.items():
+        source_hash = manifest.source_hash(name, path)
+        resume = {}
+        if not manifest.source_changed(name, source_hash):
+            resume = {page: manifest.resume_stage(page, stages, stage_params) for page in manifest.sources[name]['pages']}
+        # 新增/改變的PDF，或切頁結果遺失時，整份PDF重新切頁
+        if manifest.source_changed(name, source_hash) or 'split' in resume.values():
+            removed_outputs.extend(manifest.remove_source(name))
+            to_split[name] = source_hash
+            ready['split'].append(path)
+            continue
+        for page, stage in resume.items():
+            if stage is None:
+                skipped += 1
+                continue
+            # 從上一個 stage 的輸出開始
+            ready[stage].append(manifest.stage_output(page, stages[stages.index(stage) - 1]))
+
+    for output in removed_outputs:
+        if os.path.exists(output):
+            os.remove(output)
+    print(f'Manifest: {len(to_split)} new/changed PDFs, {len(removed_outputs)} stale outputs removed, '
+          f'{skipped} pages up to date, {sum(len(ready[stage]) for stage in stages[1:])} pages resumed at a later stage')
+    return to_split
+
+def _report(stages, stats, ready, inflight, elapsed, final=False):
+    depth = {stage: len(ready[stage]) for stage in stages}
+    for stage, _ in inflight.values():
+        depth[stage] += 1
+    if not final:
+        print(f'[{elapsed:7.1f}s] ' + ' | '.join(
+            f"{stage} {stats[stage]['done']} done ({stats[stage]['done'] / elapsed:.1f}/s), depth {depth[stage]}" for stage in stages))
+        return
+    print(f'Pipeline finished in {elapsed:.1f}s')
+    for stage in stages:
+        stat = stats[stage]
+        mean_time = stat['busy'] / stat['done'] if stat['done'] else 0.0
+        print(f"{stage:>10}: {stat['done']} done, {stat['failed']} failed, {stat['done'] / elapsed:.2f}/s, "
+              f"mean {mean_time:.3f}s per item, max queue depth {stat['max_depth']}"
+              + (f", {stat['ocr_pages']} pages OCR'd" if stage == 'preprocess' else ''))
+
+def run_pipeline(input_folder, output_dirs, workers=None, ocr_workers=None, report_interval=10.0,
+                 manifest_path=None, stage_params=DIRECT_STAGE_PARAMS):
+    '''
+    Streaming 前處理: 每份PDF切頁後，每一頁各自依序經過 preprocess (OCR 或移除印章) --> render (.jpg) --> resize
+    (DIRECT_STAGE_PARAMS: 不寫出 one-page PDF，render 直接輸出 resize 後的影像)，
+    不需等待前一個 stage 處理完整個語料；所有 stage 共用一個 process pool，ocrmypdf 另有併發上限
+    只要 worker 有空就優先提交較後面的 stage，讓已切好的頁面盡快完成，而不是堆積在前面的 stage
+
+    [input_folder]: 原始 finance PDF 資料夾
+    [output_dirs]: 各 stage 的輸出資料夾 {'split', 'preprocess', 'render', 'resize'}
+    [workers]: process 數量，預設為 CPU 核心數
+    [ocr_workers]: 同時執行的 ocrmypdf 數量上限，預設為 workers // 2
+    [report_interval]: 每隔幾秒印出各 stage 的完成數量、throughput 與 queue depth
+    [manifest_path]: 前處理 manifest 路徑，None 則全部重新處理；有 manifest 時只處理新增/改變的PDF與參數改變的 stage
+    [stage_params]: 各 stage 的參數 (STAGE_PARAMS 或 DIRECT_STAGE_PARAMS)
+    '''
+    stages = active_stages(stage_params)
+    workers = workers or os.cpu_count()
+    ocr_workers = ocr_workers or max(1, workers // 2)
+    for output_dir in output_dirs.values():
+        os.makedirs(output_dir, exist_ok=True)
+
+    ready = {stage: deque() for stage in stages} # 等待提交的項目
+    source_files = sorted(glob.glob(os.path.join(input_folder, '*.pdf')))
+    manifest = PreprocessManifest(manifest_path) if manifest_path else None
+    if manifest is not None:
+        source_hashes = _plan_incremental(manifest, source_files, ready, output_dirs, stage_params)
+    else:
+        ready['split'].extend(source_files)
+    inflight = {} # future --> (stage, path)
+    stats = {stage: {'done': 0, 'failed': 0, 'busy': 0.0, 'max_depth': 0, 'ocr_pages': 0} for stage in stages}
+
+    start = last_report = time.perf_counter()
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(multiprocessing.Semaphore(ocr_workers),)) as executor:
+        while inflight or any(ready.values()):
+            # 保持 pool 忙碌但不一次提交全部，後面的 stage 優先
+            while len(inflight) < workers * 2:
+                stage = next((stage for stage in reversed(stages) if ready[stage]), None)
+                if stage is None:
+                    break
+                path = ready[stage].popleft()
+                inflight[executor.submit(_run_stage, stage, path, output_dirs, stage_params)] = (stage, path)
+
+            for stage in stages:
+                depth = len(ready[stage]) + sum(1 for s, _ in inflight.values() if s == stage)
+                stats[stage]['max_depth'] = max(stats[stage]['max_depth'], depth)
+
+            done, _ = wait(inflight, timeout=report_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, path = inflight.pop(future)
+                try:
+                    outputs, elapsed, ocr_pages = future.result()
+                except Exception as e:
+                    # 單一頁面失敗不影響其他頁面 (不寫入 manifest，下次執行會重試)
+                    stats[stage]['failed'] += 1
+                    print(f'{stage} 失敗: {path} ({type(e).__name__}: {e})')
+                    continue
+                stats[stage]['done'] += 1
+                stats[stage]['busy'] += elapsed
+                stats[stage]['ocr_pages'] += ocr_pages
+                if manifest is not None:
+                    if stage == 'split':
+                        name = os.path.basename(path)
+                        manifest.record_source(name, path, source_hashes[name], [_page_name(output) for output in outputs])
+                    for output in outputs:
+                        manifest.record_stage(_page_name(output), stage, stage_params[stage], output, stages)
+                next_index = stages.index(stage) + 1
+                if next_index < len(stages):
+                    ready[stages[next_index]].extend(outputs)
+
+            now = time.perf_counter()
+            if now - last_report >= report_interval:
+                _report(stages, stats, ready, inflight, now - start)
+                if manifest is not None:
+                    manifest.save()
+                last_report = now
+
+    if manifest is not None:
+        manifest.save()
+    _report(stages, stats, ready, inflight, time.perf_counter() - start, final=True)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Finance PDF 前處理: 切頁 --> OCR/移除印章 --> 轉成影像 --> resize')
+    parser.add_argument('--workers', type=int, default=None, help='process 數量，預設為 CPU 核心數')
+    parser.add_argument('--ocr_workers', type=int, default=None, help='同時執行的 ocrmypdf 數量上限')
+    parser.add_argument('--serial', action='store_true', help='依序執行四個步驟 (原本的流程)')
+    parser.add_argument('--rebuild', action='store_true', help='忽略 manifest，全部重新處理')
+    parser.add_argument('--renderer', choices=['fitz', 'pdf2image'], default='fitz',
+                        help='fitz: 不寫出 one-page PDF，直接渲染成 resize 後的影像；pdf2image: 原本的 切頁 --> 轉影像 --> resize')
+    args = parser.parse_args()
+
+    input_folder = '../reference/finance'
+    output_dirs = {
+        'split': '../reference/finance_split',
+        'preprocess': '../reference/processed_finance/processed_finance_pdf',
+        'render': '../reference/processed_finance/processed_finance_image',
+        'resize': '../reference/processed_finance/processed_finance_image_resize',
+    }
+
+    if args.serial:
+        # Step 1: Split every finance PDF to one-page
+        split_pdf_by_pages(input_folder, output_dirs['split'])
+        # Step 2: Preprocess every one-page PDF (OCR or Remove Stamp)
+        process_all_pdfs(output_dirs['split'], output_dirs['preprocess'])
+        # Step 3: .pdf --> .jpg 
+        pdf_to_images(output_dirs['preprocess'], output_dirs['render'])
+        # Step 4: Resize to reduce tokens needed when using Antropic API
+        resize_images_in_folder(output_dirs['render'], output_dirs['resize'])
+    else:
+        manifest_path = '../reference/processed_finance/preprocess_manifest.json'
+        if args.rebuild and os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        stage_params = DIRECT_STAGE_PARAMS if args.renderer == 'fitz' else STAGE_PARAMS
+        run_pipeline(input_folder, output_dirs, args.workers, args.ocr_workers, manifest_path=manifest_path, stage_params=stage_params)
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+
+PAGE_REF_SEP = '#page='
+
+
+def page_ref(source_pdf, page_num):
+    '''
+    指向原始PDF中某一頁的 reference (in-memory 切頁時取代 one-page PDF 檔案)，例如 "123.pdf#page=4"
+    '''
+    return f'{source_pdf}{PAGE_REF_SEP}{page_num}'
+
+
+def parse_page_ref(item):
+    '''
+    page ref --> (原始PDF路徑, 頁碼)；一般檔案路徑則回傳 (路徑, None)
+    '''
+    if PAGE_REF_SEP in item:
+        source_pdf, page_num = item.rsplit(PAGE_REF_SEP, 1)
+        return source_pdf, int(page_num)
+    return item, None
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''
+    計算檔案內容的 sha1
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessManifest:
+    '''
+    記錄每份原始PDF的 hash 與切出的頁面，以及每一頁在各 stage 的輸出與參數
+    用以在重新執行前處理時，只處理新增/改變的PDF或參數改變的 stage，並刪除已移除PDF的輸出
+
+    格式:
+    {
+        "sources": {"123.pdf": {"hash", "size", "mtime", "pages": ["123_p1", ...]}},
+        "pages": {"123_p1": {"split": {"params", "output"}, "preprocess": {...}, "render": {...}, ...}}
+    }
+    '''
+
+    def __init__(self, manifest_path):
+        '''
+        [manifest_path]: manifest (.json) 路徑，不存在則從空的 manifest 開始
+        '''
+        self.manifest_path = manifest_path
+        self.sources, self.pages = {}, {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf8') as f:
+                manifest = json.load(f)
+            self.sources, self.pages = manifest['sources'], manifest['pages']
+
+    def source_hash(self, name, path):
+        '''
+        回傳原始PDF的 hash (大小與修改時間都未改變時沿用 manifest 中的 hash，不重新讀檔)
+        '''
+        stat = os.stat(path)
+        record = self.sources.get(name)
+        if record is not None and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime_ns:
+            return record['hash']
+        return file_hash(path)
+
+    def source_changed(self, name, source_hash):
+        record = self.sources.get(name)
+        return record is None or record['hash'] != source_hash
+
+    def record_source(self, name, path, source_hash, pages):
+        stat = os.stat(path)
+        self.sources[name] = {'hash': source_hash, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'pages': pages}
+
+    def remove_source(self, name):
+        '''
+        從 manifest 移除原始PDF及其所有頁面，回傳需要刪除的輸出檔案
+        '''
+        record = self.sources.pop(name, None)
+        if record is None:
+            return []
+        outputs = []
+        for page in record['pages']:
+            # page ref 指向原始PDF本身，不可刪除
+            outputs.extend(stage['output'] for stage in self.pages.pop(page, {}).values()
+                           if parse_page_ref(stage['output'])[1] is None)
+        return outputs
+
+    def resume_stage(self, page, stages, stage_params):
+        '''
+        回傳該頁第一個需要重新處理的 stage (參數改變或輸出不存在)，全部都是最新的則回傳 None
+
+        [page]: 頁面名稱，例如 "123_p1"
+        [stages]: 依序的 stage 名稱
+        [stage_params]: {stage: 目前的參數}
+        '''
+        records = self.pages.get(page, {})
+        for stage in stages:
+            record = records.get(stage)
+            if (record is None or record['params'] != stage_params.get(stage, {})
+                    or not os.path.exists(parse_page_ref(record['output'])[0])):
+                return stage
+        return None
+
+    def stage_output(self, page, stage):
+        return self.pages[page][stage]['output']
+
+    def record_stage(self, page, stage, params, output, stages):
+        '''
+        記錄該頁某個 stage 的輸出，並清除其後所有 stage 的紀錄 (其輸入已經改變)
+        '''
+        records = self.pages.setdefault(page, {})
+        for later in stages[stages.index(stage) + 1:]:
+            records.pop(later, None)
+        records[stage] = {'params': params, 'output': output}
+
+    def save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'sources': self.sources, 'pages': self.pages}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,155 @@
+import os
+import json
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Model.retrieval_engine import RetrievalEngine, CATEGORIES
+from Model.encoder import ENCODER_BACKENDS
+
+'''Retrieval engine config'''
+engine_config = {
+    'categories': CATEGORIES, # 要載入的 category
+    'device': os.environ.get('EMBEDDING_DEVICE', 'cpu'), # embedding 模型的 device，例如 'cuda:1'
+    'encoder_backend': os.environ.get('EMBEDDING_BACKEND', 'torch'), # 'torch': SentenceTransformer；'onnx' / 'onnx-int8': onnxruntime (CPU，第一次使用時從 cache_dir export)
+    'encoder_threads': None, # encoder 的 CPU thread 數量，None 則使用環境變數 EMBEDDING_THREADS 或 backend 預設值
+    'model_name': 'intfloat/multilingual-e5-large',
+    'cache_dir': './Model/cache', # repo for storing HuggingFace Model
+    'preload_model': True, # True: 啟動時即載入 embedding 模型；False: 第一次需要 encode 時才載入
+    'retrieval_mode': 'candidates', # 'candidates': 只在題目提供的source中檢索；'exact': 搜尋全部語料；'ann': 以IVF index近似搜尋全部語料
+    'encode_batch_size': 32, # query encode 時的 batch size
+    'ann_nlist': None, # IVF cluster 數量，None 則使用 4 * sqrt(#rows)
+    'ann_nprobe': 8, # 查詢時搜尋的 cluster 數量
+    'ann_chunk_k': 50, # Insurance ANN 先取出的 chunk 數量，再依文件取最大值
+    'quantization': None, # None: 以 store 的 dtype 計分；'float16' / 'int8': 以量化後常駐記憶體的 embeddings 計分 (candidates / exact 模式)
+    'rescore_k': 10, # 量化計分後，以 float32 重新計分的 candidate 數量 (0 則不重新計分)
+    # FAQ
+    'faq_path': './reference/faq/pid_map_content.json',
+    'faq_store_dir': './reference/processed_faq/embedding_store',
+    # Insurance
+    'insurance_source_path': './reference/insurance',
+    'insurance_store_dir': './reference/processed_insurance/embedding_store',
+    'embedding_dtype': 'float32', # 'float16' 可減少一半的硬碟與記憶體用量
+    'update_store': True, # False: 直接讀取現有的store，不檢查PDF是否有變動
+    'ingest_workers': os.cpu_count(), # 平行解析PDF/分詞的 process 數量
+    # Finance (第一階段 BM25)
+    'finance_source_path': './reference/processed_finance/processed_finance_pdf',
+    'finance_index_path': './reference/processed_finance/bm25_index.npz',
+    'token_cache_path': './reference/processed_finance/token_cache.jsonl',
+    'rewrite_path': './preliminary_test/finance_query_rewrite.json',
+}
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    '''
+    POST /retrieve : {"questions": [{"qid", "category", "query", "source"}, ...]} 或單一題目 --> {"answers": [...]}
+    GET /stats     : latency (p50/p95/p99) 與 QPS
+    GET /health    : 已載入的 category
+    '''
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            return self._send_json(200, self.server.engine.stats.summary())
+        if self.path == '/health':
+            return self._send_json(200, {'status': 'ok', 'categories': list(self.server.engine.categories)})
+        self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/retrieve':
+            return self._send_json(404, {'error': f'Unknown path {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))) or b'{}')
+            questions = request['questions'] if 'questions' in request else [request]
+        except (json.JSONDecodeError, TypeError) as e:
+            return self._send_json(400, {'error': f'Invalid request: {e}'})
+        try:
+            answers = self.server.engine.retrieve(questions)
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send_json(400, {'error': f'{type(e).__name__}: {e}'})
+        self._send_json(200, {'answers': answers})
+
+
+class RetrievalServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # 預設的 listen backlog (5) 在大量併發連線時會 reset 連線
+
+
+def serve(engine, host, port):
+    '''
+    以 HTTP/JSON 提供檢索服務，直到 Ctrl+C 為止
+    '''
+    server = RetrievalServer((host, port), RetrievalHandler)
+    server.engine = engine
+    print(f'Retrieval service listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.close()
+        engine.stats.report()
+
+
+def run_batch(engine, question_path, output_path, batch_size):
+    '''
+    讀取題目 json，每 batch_size 題作為一個 request 送入 engine，結果依 qid 排序寫入 output_path
+
+    [question_path]: 題目 json ({"questions": [...]})
+    [output_path]: 輸出的 json 路徑
+    [batch_size]: 每個 request 的題數，1 則逐題檢索
+    '''
+    with open(question_path, 'rb') as f:
+        questions = [q_dict for q_dict in json.load(f)['questions'] if q_dict['category'] in engine.categories]
+
+    answers = []
+    for i in range(0, len(questions), batch_size):
+        answers.extend(engine.retrieve(questions[i:i + batch_size]))
+    engine.close()
+
+    answer_dict = {"answers": sorted(answers, key=lambda answer: answer['qid'])}
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf8') as f:
+        json.dump(answer_dict, f, ensure_ascii=False, indent=4)
+    print(f'{len(answers)} answers written to {output_path}')
+    engine.stats.report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='FAQ / Insurance / Finance 檢索服務')
+    parser.add_argument('--device', default=engine_config['device'], help='embedding 模型的 device (預設 cpu)')
+    parser.add_argument('--encoder_backend', choices=ENCODER_BACKENDS, default=engine_config['encoder_backend'])
+    parser.add_argument('--encoder_threads', type=int, default=engine_config['encoder_threads'], help='encoder 的 CPU thread 數量')
+    parser.add_argument('--categories', nargs='+', choices=CATEGORIES, default=list(engine_config['categories']))
+    parser.add_argument('--retrieval_mode', choices=['candidates', 'exact', 'ann'], default=engine_config['retrieval_mode'])
+    parser.add_argument('--quantization', choices=['float16', 'int8'], default=engine_config['quantization'])
+    parser.add_argument('--rescore_k', type=int, default=engine_config['rescore_k'])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='啟動 HTTP/JSON 服務')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+
+    batch_parser = subparsers.add_parser('batch', help='批次檢索題目 json')
+    batch_parser.add_argument('--questions', default='./preliminary_test/questions_preliminary.json')
+    batch_parser.add_argument('--output', default='./preliminary_test/pred/retrieval.json')
+    batch_parser.add_argument('--batch_size', type=int, default=32, help='每個 request 的題數，1 則逐題檢索')
+    args = parser.parse_args()
+
+    engine = RetrievalEngine(dict(engine_config, device=args.device, encoder_backend=args.encoder_backend,
+                                  encoder_threads=args.encoder_threads, categories=args.categories,
+                                  retrieval_mode=args.retrieval_mode, quantization=args.quantization,
+                                  rescore_k=args.rescore_k))
+    if args.command == 'serve':
+        serve(engine, args.host, args.port)
+    else:
+        run_batch(engine, args.questions, args.output, args.batch_size)